@@ -1,13 +1,38 @@
-import json
+import html
 import logging
 import asyncio
-import uuid  # Import the uuid module
+import os
+import sys
+from apicalls import CONNECT_TIMEOUT, KEEPALIVE_SECONDS, POOL_SIZE, REQUEST_TIMEOUT, CallSaver, TunedSession
+from broadcast import Broadcaster, subscribe_keyboard
+from bulkadd import BulkAdd
+from concurrency import UserOrderingMiddleware
+from fsm import FSM_TTL, StoreStorage
+from jobs import JobManager
+from callbacks import (
+    CONFIRM_DELETE, CONFIRM_DELETE_SONG, DELETE_PLAYLIST, DELETE_SONG, FINISH_ADD, MOVE_BOTTOM, MOVE_DOWN, MOVE_SONG,
+    MOVE_SONG_TO, MOVE_TARGETS, MOVE_TOP, MOVE_UP, PLAY_SONG, SELECT_PLAYLIST, SEND_ALL, SHARE_PLAYLIST,
+    SHUFFLE_PLAYLIST, SONG_MENU, SONGS_PAGE, VIEW_PLAYLIST, encode,
+)
+from metrics import ApiMetrics, HandlerMetrics, Registry, name_handler, serve_metrics, stats_families
+from keyboards import (
+    LIST_MODES, PLAYLISTS_PER_PAGE, SONGS_PER_PAGE, PageCache, clamp_page, done_keyboard, render_move_targets,
+    render_playlists_page, render_song_menu, render_songs_page,
+)
+from ratelimit import RateLimiter
+from routing import CallbackRoutes, TextRoute, TextRoutes
+from search import search_library
+from storage import DEFAULT_SHARDS, LEGACY_PLAYLIST, ShardedStore
+from watchdog import LoopMonitor, ReportFile, SlowUpdateProfiler
+from webhook import Peers, serve_webhook
 
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import InlineQuery, InlineQueryResultCachedAudio
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramAPIError
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
@@ -15,11 +40,48 @@ from aiogram.enums import ParseMode
 # Instead of from aiogram import Dispatcher
 from aiogram import Router
 
-TOKEN = "Your Bot Token" # Replace with your actual bot token
-bot = Bot(token=TOKEN, parse_mode=ParseMode.HTML)  # Added parse_mode
-dp = Dispatcher()  # Use Dispatcher for aiogram 3.x
-
-DATA_FILE = "music_data.json"
+TOKEN = os.getenv("BOT_TOKEN", "Your Bot Token") # Replace with your actual bot token
+
+# Set by webhook.py for its workers: this process owns the shards of its worker slot
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+
+# Point at a self-hosted or stand-in Bot API server instead of api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL")
+# Connection pool and timeouts of the shared HTTP session to the Bot API
+session = TunedSession(
+    api=TelegramAPIServer.from_base(BOT_API_URL) if BOT_API_URL else PRODUCTION,
+    pool_size=int(os.getenv("BOT_API_POOL_SIZE", str(POOL_SIZE))),
+    keepalive=float(os.getenv("BOT_API_KEEPALIVE", str(KEEPALIVE_SECONDS))),
+    timeout=float(os.getenv("BOT_API_TIMEOUT", str(REQUEST_TIMEOUT))),
+    connect_timeout=float(os.getenv("BOT_API_CONNECT_TIMEOUT", str(CONNECT_TIMEOUT))),
+)
+bot = Bot(token=TOKEN, parse_mode=ParseMode.HTML, session=session)  # Added parse_mode
+
+# Calls answered without Telegram (cached getMe, repeated callback answers, identical
+# reads already in flight) are settled first, before the rate limiter sees them
+api_calls = CallSaver()
+bot.session.middleware(api_calls)
+
+# Every outgoing call is throttled to the Bot API flood limits; interactive replies jump the queue.
+# Webhook workers split the global limit between them.
+rate_limiter = RateLimiter(workers=WORKER_COUNT)
+bot.session.middleware(rate_limiter)
+
+# Handler and Bot API latencies plus the components' own counters, on a local /metrics endpoint.
+# Each webhook worker listens on METRICS_PORT + its index; METRICS_PORT=0 turns it off.
+metrics = Registry()
+bot.session.middleware(ApiMetrics(metrics))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+
+# Users allowed to run admin commands such as /profiler (comma-separated ids)
+ADMIN_IDS = {user_id.strip() for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+
+DATA_FILE = os.getenv("MUSIC_DATA_FILE", "music_data.json")
+
+# Users are hashed across this many shard files; changing it reshards in the background
+STORAGE_SHARDS = int(os.getenv("STORAGE_SHARDS", DEFAULT_SHARDS))
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -34,31 +96,113 @@ class Form(StatesGroup):
 user_states = {}
 
 
-# Function to load and save data
-def load_data():
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
-    except json.JSONDecodeError:
-        logging.error("JSONDecodeError: Could not decode JSON. The file might be corrupted.")
-        return {}
+# Write-behind policy: changes reach disk at most this many seconds later,
+# or sooner once this many are waiting
+FLUSH_MAX_LATENCY = 0.5
+FLUSH_MAX_BATCH = 500
 
+# Users kept in memory; the rest are read from the shard record files when they return
+CACHE_USERS = int(os.getenv("STORAGE_CACHE_USERS", "50000"))
 
-def save_data(data):
-    try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-    except Exception as e:
-        logging.error(f"Error saving data to {DATA_FILE}: {e}")
+# Each shard keeps its playlists in an indexed record file plus an append-only
+# journal of small records; users are loaded on their first update, not at startup
+store = ShardedStore(
+    DATA_FILE, shards=STORAGE_SHARDS, worker=WORKER_INDEX, workers=WORKER_COUNT, cache_users=CACHE_USERS,
+    max_latency=FLUSH_MAX_LATENCY, max_batch=FLUSH_MAX_BATCH,
+)
+
+
+# FSM state (e.g. the playlist picked for an upload) is kept in the same shards, so a
+# half-finished flow survives a restart; abandoned flows expire after FSM_STATE_TTL seconds
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(FSM_TTL)))
+dp = Dispatcher(storage=StoreStorage(store, ttl=FSM_STATE_TTL))  # Use Dispatcher for aiogram 3.x
+
+# One user's updates are handled in order, one at a time; different users run in parallel
+user_ordering = UserOrderingMiddleware()
+dp.update.outer_middleware(user_ordering)
+
+
+# Function to load data
+def load_data():
+    return store.load()
 
 
 # Load data
 users_music = load_data()
 
+# Playlist sends run as background jobs with a progress message and a cancel button
+jobs = JobManager(bot, store)
+
+# Audio sent during 🎵 Add Music is saved in batches with one summary per batch
+bulk_add = BulkAdd(bot, store)
+
+# Subscribers of a shared playlist hear about the songs added to it, batched and rate limited.
+# Webhook workers hand unsubscribes for users in other workers' shards to their owners.
+peers = Peers(WORKER_INDEX, WORKER_COUNT) if WORKER_COUNT > 1 else None
+broadcasts = Broadcaster(bot, store, peers=peers)
+bulk_add.listeners.append(broadcasts.added)
+
 # Instead of dp.message_handler, use Router
 router = Router()
+handler_metrics = HandlerMetrics(metrics)
+
+# Updates slower than SLOW_UPDATE_SECONDS and event-loop stalls are written, with sampled
+# stacks, to SLOW_REPORT_FILE (one per worker); /profiler on|off switches the reports
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", "2.0"))
+SLOW_REPORT_FILE = os.getenv("SLOW_REPORT_FILE", "slow_updates.log")
+if WORKER_COUNT > 1:
+    SLOW_REPORT_FILE = f"{SLOW_REPORT_FILE}.{WORKER_INDEX}"
+slow_reports = ReportFile(SLOW_REPORT_FILE)
+profiler = SlowUpdateProfiler(slow_reports, SLOW_UPDATE_SECONDS, enabled=os.getenv("PROFILER", "on") == "on")
+loop_monitor = LoopMonitor(slow_reports, profiler, metrics.histogram(
+    "loop_lag_seconds", "How late the event loop ran a timer",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+))
+for observer in (router.message, router.callback_query, router.inline_query):
+    observer.middleware(handler_metrics)
+    observer.middleware(profiler)
+
+# Callback buttons and reply-keyboard texts are resolved through lookup tables
+# rather than one aiogram filter per handler
+callback_routes = CallbackRoutes(store)
+text_routes = TextRoutes()
+
+
+# Rendered inline keyboard pages, dropped whenever the playlist they show changes
+page_cache = PageCache()
+store.listeners.append(page_cache.drop)
+
+
+def playlists_page(user_id, mode, page):
+    playlists = users_music[user_id]
+    page, _ = clamp_page(page, len(playlists), PLAYLISTS_PER_PAGE)
+    key = (user_id, ("playlists", mode), store.version(user_id), page)
+    return page_cache.get(key, lambda: render_playlists_page(
+        [(playlist_name, store.playlist_id(user_id, playlist_name)) for playlist_name in playlists], mode, page
+    ))
+
+
+def songs_page(user_id, playlist_name, page):
+    songs = store.songs(user_id, playlist_name)
+    page, _ = clamp_page(page, len(songs), SONGS_PER_PAGE)
+    version = store.version(user_id, playlist_name)
+    key = (user_id, playlist_name, version, page)
+    return page_cache.get(key, lambda: render_songs_page(
+        playlist_name, store.playlist_id(user_id, playlist_name), version, songs, page
+    ))
+
+
+async def edit_page(query: CallbackQuery, text, keyboard, notice=None, alert=False):
+    # Navigation edits the message in place rather than sending a new one
+    try:
+        await query.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            logging.error(f"Could not edit page: {e}")
+            # Text Telegram couldn't parse would be rejected again, so it goes out as plain text
+            parse_mode = None if "can't parse entities" in str(e) else ParseMode.HTML
+            await query.message.answer(text, reply_markup=keyboard, parse_mode=parse_mode)
+    await query.answer(notice, show_alert=alert)
 
 
 # Helper function to create reply keyboard
@@ -79,54 +223,101 @@ def create_main_keyboard():
     return keyboard
 
 
+# The main menu never changes, so it is built once
+MAIN_KEYBOARD = create_main_keyboard()
+
+
 @router.message(Command("start"))
 async def start(message: Message):
     user_id = str(message.from_user.id)
     if user_id not in users_music:
-        users_music[user_id] = {}
-        save_data(users_music)
+        store.add_user(user_id)
 
     # Check if the start command has a payload (deep linking)
     if message.text and len(message.text.split()) > 1:
         payload = message.text.split()[1]
         if payload.startswith("playlist_"):
             unique_id = payload.split("_")[1]
-            shared_playlists = load_data()
-            if "shared_playlists" in shared_playlists and unique_id in shared_playlists["shared_playlists"]:
-                playlist_data = shared_playlists["shared_playlists"][unique_id]
-                user_id = playlist_data["user_id"]
-                playlist_name = playlist_data["playlist_name"]
-
-                if user_id not in users_music or playlist_name not in users_music[user_id]:
-                    await message.answer("Playlist not found or is no longer available.")
-                    return
-
-                songs = users_music[user_id][playlist_name]
-
-                if not songs:
-                    await message.answer(f"Playlist <b>{playlist_name}</b> is empty.", parse_mode=ParseMode.HTML)
-                    return
-
-                await message.answer(f"Playlist <b>{playlist_name}</b>:", parse_mode=ParseMode.HTML)
-                for index, song in enumerate(songs, start=1):
-                    try:
-                        await message.answer(f"{index}. <b>{song['file_name']}</b>", parse_mode=ParseMode.HTML)
-                        await bot.send_audio(message.chat.id, song["file_id"])
-                    except TelegramAPIError as e:
-                        logging.error(f"Telegram API Error sending audio: {e}")
-                        await message.answer("❌ Could not send this song due to an error.")
-                    except Exception as e:
-                        logging.error(f"General error sending audio: {e}")
-                        await message.answer("❌ An unexpected error occurred while sending this song.")
+            shared = store.shares.resolve(unique_id)
+            if shared is not None:
+                store.shares.opened(user_id, unique_id)
+                await send_shared_playlist(message, unique_id, *shared)
                 return  # Exit to prevent showing the default menu
 
     await message.answer(
         "🎵 Welcome!\nChoose an action:",
-        reply_markup=create_main_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
 
 
-@router.message(F.text == "➕ Create Playlist")
+async def send_shared_playlist(message: Message, token, user_id, playlist_name):
+    if user_id not in users_music or playlist_name not in users_music[user_id]:
+        await message.answer("Playlist not found or is no longer available.")
+        return
+
+    songs = users_music[user_id][playlist_name]
+    viewer_id = str(message.from_user.id)
+
+    if not songs:
+        await message.answer(f"Playlist <b>{html.escape(playlist_name)}</b> is empty.", parse_mode=ParseMode.HTML)
+    else:
+        await jobs.submit(viewer_id, message.chat.id, user_id, playlist_name, numbered=True)
+
+    if viewer_id != user_id and not store.subscribed(viewer_id, token):
+        await message.answer(
+            f"🔔 Subscribe to get the songs added to <b>{html.escape(playlist_name)}</b> from now on.",
+            reply_markup=subscribe_keyboard(token),
+        )
+
+
+@callback_routes.prefix("subscribe")
+async def subscribe_callback(query: CallbackQuery, payload):
+    user_id = str(query.from_user.id)
+    shared = store.shares.resolve(payload)
+    if shared is None:
+        await query.answer("This playlist is no longer shared.", show_alert=True)
+        return
+
+    store.subscribe(user_id, payload, query.message.chat.id)
+    await query.message.edit_text(
+        f"🔔 Subscribed to <b>{html.escape(shared[1])}</b>. New songs will be sent here.", reply_markup=None
+    )
+    await query.answer()
+
+
+@callback_routes.prefix("unsubscribe")
+async def unsubscribe_callback(query: CallbackQuery, payload):
+    store.unsubscribe(str(query.from_user.id), payload)
+    await query.message.edit_reply_markup(reply_markup=None)
+    await query.answer("🔕 Unsubscribed. You won't hear about this playlist anymore.")
+
+
+@callback_routes.prefix("open_shared")
+async def open_shared_callback(query: CallbackQuery, payload):
+    # ▶️ Open playlist under a subscription notice: the whole playlist, like the share link
+    shared = store.shares.resolve(payload)
+    if shared is None or store.songs(*shared) is None:
+        await query.answer("Playlist not found or is no longer available.", show_alert=True)
+        return
+
+    await jobs.submit(str(query.from_user.id), query.message.chat.id, *shared, numbered=True)
+    await query.answer()
+
+
+# Registered before the FSM state handlers so menu buttons always win, as they did before;
+# prefix routes only match outside a flow
+@router.message(TextRoute(text_routes))
+async def route_text(message: Message, text_handler, **data):
+    name_handler(text_handler.callback)
+    return await text_handler.call(message, **data)
+
+
+@router.callback_query()
+async def route_callback(query: CallbackQuery, **data):
+    return await callback_routes.dispatch(query, data)
+
+
+@text_routes.text("➕ Create Playlist")
 async def create_playlist_handler(message: Message, state: FSMContext):
     await message.answer("Please enter the name of the new playlist:")
     await state.set_state(Form.playlist_name)
@@ -142,243 +333,328 @@ async def playlist_name_handler(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    users_music[user_id][playlist_name] = []
-    save_data(users_music)
-    await message.answer(f"Playlist <b>{playlist_name}</b> created!")
+    store.create_playlist(user_id, playlist_name)
+    await message.answer(f"Playlist <b>{html.escape(playlist_name)}</b> created!")
     await state.clear()
 
 
-@router.message(F.text == "🎵 Add Music")
+@text_routes.text("🎵 Add Music")
 async def add_music_handler(message: Message, state: FSMContext):
     user_id = str(message.from_user.id)
     if not users_music[user_id]:
         await message.answer("You don't have any playlists. Create one first.")
         return
 
-    buttons = []
-    for playlist_name in users_music[user_id].keys():
-        buttons.append([InlineKeyboardButton(text=playlist_name, callback_data=f"select_playlist:{playlist_name}")])
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await message.answer("Select a playlist to add music to:", reply_markup=keyboard)
+    text, keyboard = playlists_page(user_id, "select", 0)
+    await message.answer(text, reply_markup=keyboard)
 
 
-@router.callback_query(lambda query: query.data.startswith("select_playlist:"))
-async def select_playlist_callback(query: CallbackQuery, state: FSMContext):
-    user_id = str(query.from_user.id)
-    playlist_name = query.data.split(":")[1]
-
-    await state.update_data(playlist_name=playlist_name)
+@callback_routes.action(SELECT_PLAYLIST)
+async def select_playlist_callback(query: CallbackQuery, state: FSMContext, playlist_name):
+    # Songs still waiting for the previous playlist are saved there first
+    await bulk_add.flush(str(query.from_user.id))
+    playlist_id = store.playlist_id(str(query.from_user.id), playlist_name)
+    # The session's playlist is only ever set here; browsing other playlists leaves it alone
     await state.set_state(Form.audio)
+    await state.set_data({"playlist_id": playlist_id, "added": 0})
 
-    await query.message.answer(f"Send me the audio file to add to <b>{playlist_name}</b>.")
+    await query.message.answer(
+        f"Send me audio files to add to <b>{html.escape(playlist_name)}</b>. Albums and forwarded batches are fine; "
+        f"tap ✅ Done when you're finished.",
+        reply_markup=done_keyboard(playlist_id),
+    )
     await query.answer()
 
 
 @router.message(Form.audio, F.audio)
 async def audio_handler(message: Message, state: FSMContext):
+    # Every audio of the session lands here; it is saved with the rest of its batch
     user_id = str(message.from_user.id)
     data = await state.get_data()
-    playlist_name = data.get("playlist_name")
+    playlist_id = data.get("playlist_id")
+    playlist_name = playlist_id is not None and store.playlist_name(user_id, playlist_id)
 
     if not playlist_name:
         await message.reply("Please select a playlist first.")
         await state.clear()
         return
 
-    try:
-        file_id = message.audio.file_id
-        file_name = message.audio.file_name or "Unknown.mp3"
-
-        users_music[user_id][playlist_name].append({"file_id": file_id, "file_name": file_name})
-        save_data(users_music)
+    bulk_add.add(user_id, message, state, playlist_name)
 
-        await message.answer(f"✅ Song <b>{file_name}</b> added to <b>{playlist_name}</b>!")
 
-    except Exception as e:
-        logging.error(f"Error saving music: {e}")
-        await message.reply("❌ Sorry, there was an error saving the song.")
+@callback_routes.action(FINISH_ADD)
+async def finish_add_callback(query: CallbackQuery, state: FSMContext, playlist_name):
+    user_id = str(query.from_user.id)
+    await bulk_add.flush(user_id)
+    data = await state.get_data()
+    if await state.get_state() != Form.audio.state or data.get("playlist_id") != store.playlist_id(user_id, playlist_name):
+        await query.answer("This session is already finished.")
+        return
 
     await state.clear()
+    added = data.get("added", 0)
+    await query.message.answer(
+        f"✅ Done. {added} song{'' if added == 1 else 's'} added to <b>{html.escape(playlist_name)}</b>.",
+        reply_markup=MAIN_KEYBOARD,
+    )
+    await query.answer()
 
 
-@router.message(F.text == "🎶 My Playlists")
+@text_routes.text("🎶 My Playlists")
 async def my_playlists_handler(message: Message):
     user_id = str(message.from_user.id)
     if not users_music[user_id]:
         await message.answer("You don't have any playlists.")
         return
 
-    buttons = []
-    for playlist_name in users_music[user_id].keys():
-        buttons.append([
-            InlineKeyboardButton(text=playlist_name, callback_data=f"view_playlist:{playlist_name}"),
-            InlineKeyboardButton(text="🔗 Share", callback_data=f"share_playlist:{playlist_name}"),  # Add share button
-            InlineKeyboardButton(text="❌ Delete Playlist", callback_data=f"confirm_delete:{playlist_name}")
-        ])
+    text, keyboard = playlists_page(user_id, "view", 0)
+    await message.answer(text, reply_markup=keyboard)
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await message.answer("Your playlists:", reply_markup=keyboard)
+
+@callback_routes.prefix("playlists_page")
+async def playlists_page_callback(query: CallbackQuery, payload):
+    mode, _, page_str = payload.partition(":")
+    user_id = str(query.from_user.id)
+    if mode not in LIST_MODES or not users_music.get(user_id):
+        await query.answer("You don't have any playlists.")
+        return
+
+    text, keyboard = playlists_page(user_id, mode, int(page_str))
+    await edit_page(query, text, keyboard)
 
 
-@router.callback_query(lambda query: query.data.startswith("view_playlist:"))
-async def view_playlist_callback(query: CallbackQuery, state: FSMContext):
-    playlist_name = query.data.split(":")[1]
+@callback_routes.action(VIEW_PLAYLIST)
+async def view_playlist_callback(query: CallbackQuery, playlist_name):
     user_id = str(query.from_user.id)
     if not users_music[user_id][playlist_name]:
-        await query.message.answer(f"Playlist <b>{playlist_name}</b> is empty.")
+        await query.answer(f"Playlist {playlist_name} is empty.")
         return
 
-    songs = users_music[user_id][playlist_name]
-    buttons = [[InlineKeyboardButton(text="🎧 Send All Music", callback_data=f"send_all_music:{playlist_name}")]]  # Add "Send All Music" button
-    for index, song in enumerate(songs, start=1):
-        buttons.append([
-            InlineKeyboardButton(text=f"🎵 {index}. {song['file_name']}", callback_data=f"play_song:{playlist_name}:{index}"),
-            InlineKeyboardButton(text="❌", callback_data=f"confirm_delete_song:{playlist_name}:{index}")
-        ])
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await query.message.answer(f"Songs in <b>{playlist_name}</b>:", reply_markup=keyboard)
-    await state.update_data(playlist_name=playlist_name)
+    text, keyboard = songs_page(user_id, playlist_name, 0)
+    await edit_page(query, text, keyboard)
 
 
-@router.callback_query(lambda query: query.data.startswith("send_all_music:"))
-async def send_all_music_callback(query: CallbackQuery):
-    playlist_name = query.data.split(":")[1]
+@callback_routes.action(SONGS_PAGE)
+async def songs_page_callback(query: CallbackQuery, playlist_name, arg):
     user_id = str(query.from_user.id)
+    text, keyboard = songs_page(user_id, playlist_name, arg)
+    await edit_page(query, text, keyboard)
 
-    if user_id not in users_music or playlist_name not in users_music[user_id]:
-        await query.answer("Playlist not found.")
-        return
+
+@callback_routes.prefix("noop")
+async def noop_callback(query: CallbackQuery):
+    await query.answer()
+
+
+@callback_routes.action(SEND_ALL)
+async def send_all_music_callback(query: CallbackQuery, playlist_name):
+    user_id = str(query.from_user.id)
 
     songs = users_music[user_id][playlist_name]
     if not songs:
         await query.answer("Playlist is empty.")
         return
 
-    for song in songs:
-        try:
-            await bot.send_audio(query.message.chat.id, song["file_id"], caption=song["file_name"])
-        except TelegramAPIError as e:
-            logging.error(f"Telegram API Error sending audio: {e}")
-            await query.answer("Could not send this song due to an error.")
-            return  # Stop sending if one song fails
-        except Exception as e:
-            logging.error(f"General error sending audio: {e}")
-            await query.answer("An unexpected error occurred while sending this song.")
-            return  # Stop sending if one song fails
-
-    await query.answer("All songs sent!")
+    # The send runs in the background and reports progress in its own message
+    await jobs.submit(user_id, query.message.chat.id, user_id, playlist_name)
+    await query.answer()
 
 
-@router.callback_query(lambda query: query.data.startswith("play_song:"))
-async def play_song_callback(query: CallbackQuery):
+@callback_routes.prefix("cancel_job")
+async def cancel_job_callback(query: CallbackQuery, payload):
+    job_id = payload
     user_id = str(query.from_user.id)
-    _, playlist_name, index_str = query.data.split(":")
-    index = int(index_str) - 1
 
-    if user_id not in users_music or playlist_name not in users_music[user_id]:
-        await query.answer("Playlist not found.")
-        return
+    if await jobs.cancel(user_id, job_id):
+        await query.answer("Cancelling...")
+    else:
+        await query.answer("This send has already finished.")
 
-    songs = users_music[user_id][playlist_name]
-    if 0 <= index < len(songs):
-        song = songs[index]
-        try:
-            await bot.send_audio(query.message.chat.id, song["file_id"], caption=song["file_name"])
-        except TelegramAPIError as e:
-            logging.error(f"Telegram API Error sending audio: {e}")
-            await query.answer("Could not send this song due to an error.")
-        except Exception as e:
-            logging.error(f"General error sending audio: {e}")
-            await query.answer("An unexpected error occurred while sending this song.")
+
+async def song_gone(query: CallbackQuery, user_id, playlist_name):
+    # The button's song was deleted or moved away since the page was shown
+    notice = "This song is no longer in the playlist."
+    if store.songs(user_id, playlist_name):
+        text, keyboard = songs_page(user_id, playlist_name, 0)
+        await edit_page(query, text, keyboard, notice, alert=True)
     else:
-        await query.answer("Invalid song number.")
+        await query.answer(notice, show_alert=True)
+
+
+@callback_routes.action(PLAY_SONG)
+async def play_song_callback(query: CallbackQuery, playlist_name, arg):
+    user_id = str(query.from_user.id)
+
+    song = store.songs(user_id, playlist_name).entry(arg)
+    if song is None:
+        await song_gone(query, user_id, playlist_name)
+        return
+    try:
+        await bot.send_audio(query.message.chat.id, song.file_id, caption=song.file_name)
+    except TelegramAPIError as e:
+        logging.error(f"Telegram API Error sending audio: {e}")
+        await query.answer("Could not send this song due to an error.")
+        return
+    except Exception as e:
+        logging.error(f"General error sending audio: {e}")
+        await query.answer("An unexpected error occurred while sending this song.")
+        return
 
     await query.answer()
 
 
-@router.callback_query(lambda query: query.data.startswith("confirm_delete_song:"))
-async def confirm_delete_song_callback(query: CallbackQuery):
-    _, playlist_name, index_str = query.data.split(":")
-    index = int(index_str)
+@callback_routes.action(CONFIRM_DELETE_SONG)
+async def confirm_delete_song_callback(query: CallbackQuery, playlist_name, arg):
     user_id = str(query.from_user.id)
+    song = store.songs(user_id, playlist_name).entry(arg)
+    if song is None:
+        await song_gone(query, user_id, playlist_name)
+        return
+    playlist_id = store.playlist_id(user_id, playlist_name)
 
+    # "Yes" names the same entry, so it deletes this song wherever it has moved to since
     buttons = [[
-        InlineKeyboardButton(text="✅ Yes", callback_data=f"delete_song:{playlist_name}:{index}"),
-        InlineKeyboardButton(text="❌ No", callback_data=f"view_playlist:{playlist_name}")
+        InlineKeyboardButton(text="✅ Yes", callback_data=encode(DELETE_SONG, playlist_id, 0, arg)),
+        InlineKeyboardButton(text="❌ No", callback_data=encode(VIEW_PLAYLIST, playlist_id, 0))
     ]]
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
     await query.message.answer(
-        f"Are you sure you want to delete song number <b>{index}</b> from <b>{playlist_name}</b>?",
+        f"Are you sure you want to delete <b>{html.escape(song.file_name)}</b> from <b>{html.escape(playlist_name)}</b>?",
         reply_markup=keyboard,
         parse_mode=ParseMode.HTML
     )
     await query.answer()
 
 
-@router.callback_query(lambda query: query.data.startswith("delete_song:"))
-async def delete_song_callback(query: CallbackQuery, state: FSMContext):
+@callback_routes.action(DELETE_SONG)
+async def delete_song_callback(query: CallbackQuery, playlist_name, arg):
     user_id = str(query.from_user.id)
-    _, playlist_name, index_str = query.data.split(":")
-    index = int(index_str)
-
-    data = await state.get_data()
-    playlist_name = data.get("playlist_name")
-
-    if not playlist_name:
-        await query.message.answer("Something went wrong. Please try again.")
-        return
 
     try:
-        index = int(index_str) - 1
-        if 0 <= index < len(users_music[user_id][playlist_name]):
-            deleted_song = users_music[user_id][playlist_name].pop(index)
-            save_data(users_music)
-            await query.message.answer(f"✅ Song <b>{deleted_song['file_name']}</b> deleted from <b>{playlist_name}</b>!")
+        deleted_song = store.remove_song(user_id, playlist_name, arg)
+        if deleted_song is not None:
+            await query.message.answer(f"✅ Song <b>{html.escape(deleted_song.file_name)}</b> deleted from <b>{html.escape(playlist_name)}</b>!")
         else:
-            await query.message.answer("Invalid song number.")
-    except ValueError:
-        await query.message.answer("Invalid song number.")
+            await query.message.answer("This song is no longer in the playlist.")
     except Exception as e:
         logging.error(f"Error deleting music: {e}")
         await query.message.answer("❌ Sorry, there was an error deleting the song.")
+    await query.answer()
+
+
+def song_menu(user_id, playlist_name, entry):
+    songs = store.songs(user_id, playlist_name)
+    song = songs.entry(entry)
+    if song is None:
+        return None
+    return render_song_menu(
+        playlist_name, store.playlist_id(user_id, playlist_name), entry, song, songs.position(entry), len(songs)
+    )
+
+
+@callback_routes.action(SONG_MENU)
+async def song_menu_callback(query: CallbackQuery, playlist_name, arg):
+    user_id = str(query.from_user.id)
+    page = song_menu(user_id, playlist_name, arg)
+    if page is None:
+        await song_gone(query, user_id, playlist_name)
+        return
+    await edit_page(query, *page)
+
+
+@callback_routes.action(MOVE_SONG)
+async def move_song_callback(query: CallbackQuery, playlist_name, arg, aux):
+    user_id = str(query.from_user.id)
+    songs = store.songs(user_id, playlist_name)
+    position = songs.position(arg)
+    if position is None:
+        await song_gone(query, user_id, playlist_name)
+        return
+
+    targets = {MOVE_UP: position - 1, MOVE_DOWN: position + 1, MOVE_TOP: 0, MOVE_BOTTOM: len(songs) - 1}
+    target = targets.get(aux, position)
+    if 0 <= target < len(songs) and target != position:
+        store.move_song(user_id, playlist_name, arg, target)
+    # The menu stays open, so the song can be nudged again
+    await edit_page(query, *song_menu(user_id, playlist_name, arg))
+
+
+@callback_routes.action(MOVE_TARGETS)
+async def move_targets_callback(query: CallbackQuery, playlist_name, arg):
+    user_id = str(query.from_user.id)
+    song = store.songs(user_id, playlist_name).entry(arg)
+    if song is None:
+        await song_gone(query, user_id, playlist_name)
+        return
+    targets = [(name, store.playlist_id(user_id, name)) for name in users_music[user_id] if name != playlist_name]
+    if not targets:
+        await query.answer("You don't have another playlist to move it to.", show_alert=True)
+        return
+    text, keyboard = render_move_targets(playlist_name, store.playlist_id(user_id, playlist_name), arg, song, targets)
+    await edit_page(query, text, keyboard)
+
+
+@callback_routes.action(MOVE_SONG_TO)
+async def move_song_to_callback(query: CallbackQuery, playlist_name, arg, aux):
+    user_id = str(query.from_user.id)
+    target_name = store.playlist_name(user_id, aux)
+    song = store.songs(user_id, playlist_name).entry(arg)
+    if target_name is None or song is None:
+        await query.answer("This menu is out of date. Open 🎶 My Playlists again.", show_alert=True)
+        return
+    if not store.transfer_song(user_id, playlist_name, arg, target_name):
+        await query.answer(f"{song.file_name} is already in {target_name}.", show_alert=True)
+        return
+
+    if store.songs(user_id, playlist_name):
+        text, keyboard = songs_page(user_id, playlist_name, 0)
+    else:
+        text, keyboard = playlists_page(user_id, "view", 0)
+    await edit_page(query, text, keyboard, f"Moved to {target_name}.")
+
+
+@callback_routes.action(SHUFFLE_PLAYLIST)
+async def shuffle_playlist_callback(query: CallbackQuery, playlist_name, arg):
+    user_id = str(query.from_user.id)
+    if len(store.songs(user_id, playlist_name)) < 2:
+        await query.answer()
+        return
+    store.shuffle_playlist(user_id, playlist_name)
+    text, keyboard = songs_page(user_id, playlist_name, arg)
+    await edit_page(query, text, keyboard, "🔀 Shuffled.")
 
 
-@router.callback_query(lambda query: query.data.startswith("confirm_delete:"))
-async def confirm_delete_callback(query: CallbackQuery):
-    playlist_name = query.data.split(":")[1]
+@callback_routes.action(CONFIRM_DELETE)
+async def confirm_delete_callback(query: CallbackQuery, playlist_name):
     user_id = str(query.from_user.id)
 
     # Create confirmation keyboard
     buttons = [[
-        InlineKeyboardButton(text="✅ Yes", callback_data=f"delete_playlist:{playlist_name}"),
+        InlineKeyboardButton(text="✅ Yes", callback_data=encode(DELETE_PLAYLIST, store.playlist_id(user_id, playlist_name), 0)),
         InlineKeyboardButton(text="❌ No", callback_data="cancel_delete")
     ]]
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
     await query.message.answer(
-        f"Are you sure you want to delete playlist <b>{playlist_name}</b>?",
+        f"Are you sure you want to delete playlist <b>{html.escape(playlist_name)}</b>?",
         reply_markup=keyboard
     )
     await query.answer()
 
 
-@router.callback_query(lambda query: query.data.startswith("delete_playlist:"))
-async def delete_playlist_callback(query: CallbackQuery):
-    playlist_name = query.data.split(":")[1]
+@callback_routes.action(DELETE_PLAYLIST)
+async def delete_playlist_callback(query: CallbackQuery, playlist_name):
     user_id = str(query.from_user.id)
-    if playlist_name in users_music[user_id]:
-        del users_music[user_id][playlist_name]
-        save_data(users_music)
-        await query.message.answer(f"Playlist <b>{playlist_name}</b> deleted.")
-    else:
-        await query.message.answer("Playlist not found.")
+    tokens = store.shares.tokens(user_id, playlist_name)
+    store.delete_playlist(user_id, playlist_name)
+    await query.message.answer(f"Playlist <b>{html.escape(playlist_name)}</b> deleted.")
     await query.answer()
+    # Nobody can open its links any more, so their subscriptions are dropped everywhere
+    await broadcasts.forget(tokens)
 
 
-@router.callback_query(F.data == "cancel_delete")
+@callback_routes.prefix("cancel_delete")
 async def cancel_delete_callback(query: CallbackQuery):
     await query.message.answer("Deletion cancelled.")
     await query.answer()
@@ -401,8 +677,39 @@ async def list_playlists_command(message: Message):
         await message.reply("This user has no playlists.")
         return
 
-    playlist_list = "\n".join(playlists)
-    await message.answer(f"Playlists for user <b>{target_user_id}</b>:\n{playlist_list}")
+    playlist_list = "\n".join(html.escape(playlist_name) for playlist_name in playlists)
+    await message.answer(f"Playlists for user <b>{html.escape(target_user_id)}</b>:\n{playlist_list}")
+
+
+@router.message(Command("profiler"))
+async def profiler_command(message: Message):
+    # /profiler [on|off] [seconds]: switch slow-update and stall reports, or set the threshold
+    if str(message.from_user.id) not in ADMIN_IDS:
+        return
+
+    for arg in message.text.split()[1:]:
+        if arg in ("on", "off"):
+            profiler.enabled = arg == "on"
+        else:
+            try:
+                profiler.threshold = float(arg)
+            except ValueError:
+                await message.reply("Usage: /profiler [on|off] [seconds]")
+                return
+
+    lag = loop_monitor.stats()
+    text = (
+        f"Profiler is {'on' if profiler.enabled else 'off'}, threshold {profiler.threshold:g}s.\n"
+        f"Slow updates: {profiler.slow}, loop stalls: {lag['stalls']}, max loop lag: {lag['max_lag'] * 1000:.0f}ms.\n"
+        f"Reports: {slow_reports.path} ({slow_reports.written} written)."
+    )
+    if WORKER_COUNT > 1:
+        # Each webhook worker has its own profiler, and an admin's updates always reach the same one
+        text += (
+            f"\nThis only affects webhook worker {WORKER_INDEX} of {WORKER_COUNT}; "
+            f"PROFILER and SLOW_UPDATE_SECONDS set every worker at startup."
+        )
+    await message.reply(text)
 
 
 @router.message(Command("help"))
@@ -418,45 +725,17 @@ async def help_command(message: Message):
     await message.answer(help_text)
 
 
-@router.message(F.audio, Form.audio)
-async def save_music(message: Message, state: FSMContext):
-    user_id = str(message.from_user.id)
-    data = await state.get_data()
-    playlist_name = data.get("playlist_name")
-
-    if not playlist_name:
-        await message.reply("Please select a playlist first.")
-        await state.clear()
-        return
-
-    file_id = message.audio.file_id
-    file_name = message.audio.file_name or "Unknown.mp3"
-
-    users_music[user_id][playlist_name].append({"file_id": file_id, "file_name": file_name})
-    save_data(users_music)
-
-    await message.answer(f"✅ Song <b>{file_name}</b> added to <b>{playlist_name}</b>!")
-    await state.clear()
-
-
+# /mylist, /getlist and /delete predate named playlists: they work on the "music"
+# playlist that each user's old song list was converted into
 @router.message(Command("mylist"))
 async def my_list(message: Message):
     user_id = str(message.from_user.id)
-    if user_id not in users_music or not users_music[user_id]["music"]:
+    if not store.songs(user_id, LEGACY_PLAYLIST):
         await message.reply("⛔ شما هیچ آهنگی ذخیره نکرده‌اید!")
         return
 
     await message.answer("🎵 لیست آهنگ‌های شما:")
-    for index, song in enumerate(users_music[user_id]["music"], start=1):
-        await message.answer(f"{index}. <b>{song['file_name']}</b>")
-        try:
-            await bot.send_audio(message.chat.id, song["file_id"])
-        except TelegramAPIError as e:
-            logging.error(f"Telegram API Error sending audio: {e}")
-            await message.answer("❌ Could not send this song due to an error.")
-        except Exception as e:
-            logging.error(f"General error sending audio: {e}")
-            await message.answer("❌ An unexpected error occurred while sending this song.")
+    await jobs.submit(user_id, message.chat.id, user_id, LEGACY_PLAYLIST, numbered=True)
 
 
 @router.message(Command("getlist"))
@@ -466,25 +745,16 @@ async def get_list(message: Message):
         await message.reply("⛔ لطفاً شناسه را وارد کنید. مثال: `/getlist abc12345`")
         return
 
+    # An old unique_id is a share link of its owner's "music" playlist, found by index
     unique_id = command_parts[1]
-    user_id = next(
-        (uid for uid, data in users_music.items() if data["unique_id"] == unique_id), None
-    )
-
-    if not user_id or not users_music[user_id]["music"]:
+    shared = store.shares.resolve(unique_id)
+    if shared is None or not store.songs(*shared):
         await message.reply("⛔ این کاربر هیچ آهنگی ذخیره نکرده است یا شناسه اشتباه است!")
         return
 
+    store.shares.opened(str(message.from_user.id), unique_id)
     await message.answer("🎵 لیست آهنگ‌های این کاربر:")
-    for song in users_music[user_id]["music"]:
-        try:
-            await bot.send_audio(message.chat.id, song["file_id"], caption=song["file_name"])
-        except TelegramAPIError as e:
-            logging.error(f"Telegram API Error sending audio: {e}")
-            await message.answer("❌ Could not send this song due to an error.")
-        except Exception as e:
-            logging.error(f"General error sending audio: {e}")
-            await message.answer("❌ An unexpected error occurred while sending this song.")
+    await send_shared_playlist(message, unique_id, *shared)
 
 
 @router.message(Command("delete"))
@@ -495,16 +765,17 @@ async def delete_music(message: Message, state: FSMContext):
         return
 
     user_id = str(message.from_user.id)
-    if user_id not in users_music or not users_music[user_id]["music"]:
+    songs = store.songs(user_id, LEGACY_PLAYLIST)
+    if not songs:
         await message.reply("⛔ لیست شما خالی است!")
         return
 
     try:
         index = int(command_parts[1]) - 1
-        if 0 <= index < len(users_music[user_id]["music"]):
-            deleted_song = users_music[user_id]["music"].pop(index)
-            save_data(users_music)
-            await message.answer(f"✅ آهنگ <b>{deleted_song['file_name']}</b> حذف شد!")
+        entries = songs.page(index, index + 1) if index >= 0 else []
+        if entries:
+            deleted_song = store.remove_song(user_id, LEGACY_PLAYLIST, entries[0][0])
+            await message.answer(f"✅ آهنگ <b>{html.escape(deleted_song.file_name)}</b> حذف شد!")
         else:
             await message.reply("⛔ شماره نامعتبر است!")
     except ValueError:
@@ -515,23 +786,12 @@ async def delete_music(message: Message, state: FSMContext):
     await state.clear()
 
 
-@router.callback_query(lambda query: query.data.startswith("share_playlist:"))
-async def share_playlist_callback(query: CallbackQuery):
-    playlist_name = query.data.split(":")[1]
+@callback_routes.action(SHARE_PLAYLIST)
+async def share_playlist_callback(query: CallbackQuery, playlist_name):
     user_id = str(query.from_user.id)
 
-    # Generate a unique ID for the playlist
-    unique_id = str(uuid.uuid4())
-
-    # Store the playlist data with the unique ID
-    shared_playlists = load_data()  # Load existing data
-    if "shared_playlists" not in shared_playlists:
-        shared_playlists["shared_playlists"] = {}
-    shared_playlists["shared_playlists"][unique_id] = {
-        "user_id": user_id,
-        "playlist_name": playlist_name
-    }
-    save_data(shared_playlists)  # Save updated data
+    # Reuse the playlist's existing link, or mint one the first time it's shared
+    unique_id = store.shares.share(user_id, playlist_name)
 
     # Fetch bot's username
     try:
@@ -546,50 +806,62 @@ async def share_playlist_callback(query: CallbackQuery):
     shareable_link = f"t.me/{bot_username}?start=playlist_{unique_id}"
 
     await query.message.answer(
-        f"Share this link to share your playlist <b>{playlist_name}</b>:\n"
+        f"Share this link to share your playlist <b>{html.escape(playlist_name)}</b>:\n"
         f"<code>{shareable_link}</code>",
         parse_mode=ParseMode.HTML  # Ensure HTML parsing for <code> tag
     )
     await query.answer()
 
 
-@router.message(lambda message: message.text.startswith("playlist_"))
+@callback_routes.stale_button
+async def stale_button_callback(query: CallbackQuery, decoded=None):
+    # Buttons whose playlist is gone, or from an older button format, end up here
+    user_id = str(query.from_user.id)
+    playlist_name = decoded and store.playlist_name(user_id, decoded[1])
+    if playlist_name is None:
+        await query.answer("This menu is out of date. Open 🎶 My Playlists again.", show_alert=True)
+        return
+
+    text, keyboard = songs_page(user_id, playlist_name, 0)
+    try:
+        await query.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        logging.error(f"Could not refresh stale page: {e}")
+    await query.answer("This playlist has changed, here is the updated list. Please try again.", show_alert=True)
+
+
+@text_routes.prefix("playlist_")
 async def handle_shared_playlist(message: Message):
     unique_id = message.text.split("_")[1]
 
-    shared_playlists = load_data()
-    if "shared_playlists" not in shared_playlists or unique_id not in shared_playlists["shared_playlists"]:
+    shared = store.shares.resolve(unique_id)
+    if shared is None:
         await message.answer("Playlist not found.")
         return
 
-    playlist_data = shared_playlists["shared_playlists"][unique_id]
-    user_id = playlist_data["user_id"]
-    playlist_name = playlist_data["playlist_name"]
+    store.shares.opened(str(message.from_user.id), unique_id)
+    await send_shared_playlist(message, unique_id, *shared)
 
-    if user_id not in users_music or playlist_name not in users_music[user_id]:
-        await message.answer("Playlist not found or is no longer available.")
-        return
 
-    songs = users_music[user_id][playlist_name]
+# Results are per user and change as songs are added, so Telegram shouldn't keep them long
+INLINE_CACHE_TIME = 10
 
-    if not songs:
-        await message.answer(f"Playlist <b>{playlist_name}</b> is empty.", parse_mode=ParseMode.HTML)
-        return
 
-    await message.answer(f"Playlist <b>{playlist_name}</b>:", parse_mode=ParseMode.HTML)
-    for index, song in enumerate(songs, start=1):
-        try:
-            await message.answer(f"{index}. <b>{song['file_name']}</b>", parse_mode=ParseMode.HTML)
-            await bot.send_audio(message.chat.id, song["file_id"])
-        except TelegramAPIError as e:
-            logging.error(f"Telegram API Error sending audio: {e}")
-            await message.answer("❌ Could not send this song due to an error.")
-        except Exception as e:
-            logging.error(f"General error sending audio: {e}")
-            await message.answer("❌ An unexpected error occurred while sending this song.")
+@router.inline_query()
+async def inline_search(query: InlineQuery):
+    # @bot <words>: the user's songs (and those of playlists shared with them) whose
+    # file names contain the words, sent as the cached audio itself
+    user_id = str(query.from_user.id)
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    songs, next_offset = await search_library(store, user_id, query.query, offset)
+    results = [InlineQueryResultCachedAudio(id=song_id, audio_file_id=song.file_id) for song_id, song in songs]
+    await query.answer(
+        results, cache_time=INLINE_CACHE_TIME, is_personal=True,
+        next_offset=str(next_offset) if next_offset is not None else "",
+    )
 
 
-@router.message(F.text == "❓ Help")
+@text_routes.text("❓ Help")
 async def help_command(message: Message):
     help_text = (
         "Here are the available commands:\n"
@@ -603,14 +875,78 @@ async def help_command(message: Message):
     await message.answer(help_text)
 
 
-async def main():
+def collect_stats():
+    # Read on every scrape of /metrics
+    flush = store.flush_stats()
+    flush["load_seconds"] = store.load_seconds
+    yield from stats_families("storage", "counter", "Journal writes", flush, (
+        "mutations", "flushes", "flushed_mutations", "flush_seconds", "journal_bytes", "compactions",
+        "compaction_seconds", "records_bytes", "reshards",
+    ))
+    yield from stats_families("storage", "gauge", "Storage", flush, ("pending", "max_batch", "shards", "load_seconds"))
+    cache = store.cache_stats()
+    yield from stats_families("cache", "counter", "User cache", cache, ("hits", "misses", "evictions"))
+    yield from stats_families("cache", "gauge", "User cache", cache, ("cached", "cached_songs", "pinned"))
+    yield from stats_families("memory", "gauge", "Held in memory", store.memory_stats(), ("users", "playlists", "entries", "songs"))
+    saved = api_calls.stats()
+    yield from stats_families("api_saved", "counter", "Bot API calls saved", saved, (
+        "cached", "coalesced", "duplicate_answers",
+    ))
+    yield "api_saved_per_minute", "gauge", "Bot API calls saved in the last minute", [({}, saved["saved_per_minute"])]
+    limits = rate_limiter.stats()
+    yield from stats_families("ratelimit", "counter", "Rate limiter", limits, ("retry_after_hits",))
+    yield from stats_families("ratelimit", "gauge", "Rate limiter", limits, ("global_queue", "chat_queue", "active_chats"))
+    for lane, lane_stats in limits["lanes"].items():
+        yield from stats_families(f"ratelimit_{lane}", "counter", f"Rate limiter {lane} lane", lane_stats, ("requests",))
+        yield from stats_families(f"ratelimit_{lane}", "gauge", f"Rate limiter {lane} lane", lane_stats, (
+            "queued", "avg_wait", "max_wait",
+        ))
+    yield from stats_families("updates", "gauge", "Update ordering", user_ordering.stats(), ("active", "waiting", "users"))
+    yield from stats_families("broadcast", "counter", "Subscriber notifications", broadcasts.stats(), (
+        "broadcasts", "notified", "pruned", "failed",
+    ))
+    yield from stats_families("broadcast", "gauge", "Subscriber notifications", broadcasts.stats(), ("pending", "queued"))
+    yield from stats_families("loop", "gauge", "Event loop", loop_monitor.stats(), ("last_lag", "max_lag"))
+    yield from stats_families("loop", "counter", "Event loop", loop_monitor.stats(), ("stalls",))
+    yield "slow_updates_total", "counter", "Updates slower than the profiler threshold", [({}, profiler.slow)]
+    yield "send_jobs", "gauge", "Playlist sends queued or running", [({}, len(jobs.jobs))]
+    yield "add_batches", "gauge", "Add Music batches waiting to be saved", [({}, len(bulk_add.batches))]
+
+
+metrics.collectors.append(collect_stats)
+
+
+async def main(mode="polling"):
     # Register the router with the dispatcher
     dp.include_router(router)
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    # Persist changes in the background instead of inside the handlers
+    store.start()
+    jobs.resume()
+    loop_monitor.start()
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = await serve_metrics(metrics, METRICS_HOST, METRICS_PORT + WORKER_INDEX)
+
+    try:
+        if mode == "webhook":
+            # Telegram (or the front process in webhook.py) POSTs updates to us
+            await serve_webhook(bot, dp, peer=broadcasts.peer_request if peers else None)
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        await bulk_add.shutdown()
+        await broadcasts.shutdown()
+        await jobs.shutdown()
+        await store.close()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        await loop_monitor.stop()
+        logging.info(f"Bot API calls: {api_calls.stats()}")
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    asyncio.run(main())
+    # python Bot.py [polling|webhook], or BOT_MODE in the environment
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else os.getenv("BOT_MODE", "polling")))
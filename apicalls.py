@@ -0,0 +1,138 @@
+# Bot API calls that never need to leave the process. CallSaver answers getMe from a
+# cache, drops a second answer to a callback query (Telegram would reject it anyway)
+# and lets identical read requests that are already in flight share one response.
+# TunedSession sizes the aiohttp connection pool and keeps connections alive.
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+from aiogram.methods import AnswerCallbackQuery
+from aiohttp import ClientTimeout
+
+# Connections kept to the Bot API; replies, bulk sends and polling share them
+POOL_SIZE = 100
+# Idle connections are kept this long, so a quiet minute doesn't cost a new TLS handshake
+KEEPALIVE_SECONDS = 60
+DNS_CACHE_SECONDS = 300
+REQUEST_TIMEOUT = 60
+CONNECT_TIMEOUT = 10
+
+# Responses that only change when the bot is reconfigured, and how long they're kept
+CACHED_METHODS = {"getMe": 3600}
+# Read-only methods whose identical concurrent calls can share one request
+COALESCED_METHODS = {"getMe", "getChat", "getChatMember", "getFile", "getWebhookInfo", "getMyCommands"}
+# Callback queries remembered as answered
+ANSWERED_QUERIES = 10000
+
+
+class TunedSession(AiohttpSession):
+    def __init__(self, pool_size=POOL_SIZE, keepalive=KEEPALIVE_SECONDS, connect_timeout=CONNECT_TIMEOUT,
+                 timeout=REQUEST_TIMEOUT, **kwargs):
+        super().__init__(timeout=timeout, **kwargs)
+        self.connect_timeout = connect_timeout
+        self._connector_init.update(
+            limit=pool_size, keepalive_timeout=keepalive, ttl_dns_cache=DNS_CACHE_SECONDS,
+        )
+
+    async def make_request(self, bot, method, timeout=None):
+        # aiohttp turns a bare number into a total-only timeout; keep the connect limit too
+        total = self.timeout if timeout is None else timeout
+        return await super().make_request(bot, method, ClientTimeout(total=total, connect=self.connect_timeout))
+
+
+class CallSaver(BaseRequestMiddleware):
+    # Registered first, so saved calls never wait for the rate limiter or count as API calls
+    def __init__(self, cached=CACHED_METHODS, coalesced=COALESCED_METHODS, answered=ANSWERED_QUERIES):
+        self.cached = cached
+        self.coalesced = coalesced
+        self.max_answered = answered
+        # (bot id, method, params) -> (expires, result)
+        self.cache = {}
+        # (bot id, method, params) -> future of the request in flight
+        self.in_flight = {}
+        self.answered = OrderedDict()
+        self.counters = {"requests": 0, "cached": 0, "coalesced": 0, "duplicate_answers": 0}
+        # [second, calls saved] for the last minute
+        self.window = deque()
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", None)
+        if isinstance(method, AnswerCallbackQuery):
+            if method.callback_query_id in self.answered:
+                self._saved("duplicate_answers")
+                return True
+            result = await self._coalesce(("answer", method.callback_query_id), make_request, bot, method)
+            self.answered[method.callback_query_id] = None
+            if len(self.answered) > self.max_answered:
+                self.answered.popitem(last=False)
+            return result
+        if name not in self.coalesced and name not in self.cached:
+            self.counters["requests"] += 1
+            return await make_request(bot, method)
+
+        key = (bot.id, name, method.model_dump_json(exclude_none=True))
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._saved("cached")
+            return entry[1]
+        try:
+            result = await self._coalesce(key, make_request, bot, method)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            if entry is None:
+                raise
+            # Refreshing failed: the old response is still good
+            logging.warning(f"Could not refresh {name}, using the cached response: {e}")
+            return entry[1]
+        if name in self.cached:
+            self.cache[key] = (time.monotonic() + self.cached[name], result)
+        return result
+
+    async def _coalesce(self, key, make_request, bot, method):
+        future = self.in_flight.get(key)
+        if future is not None:
+            self._saved("coalesced")
+            # Waiting on the leader's future leaves it alone if this caller is cancelled
+            await asyncio.wait((future,))
+            if not future.cancelled():
+                return future.result()
+            # The leader was cancelled, not this caller: make the request after all
+            self.counters["requests"] += 1
+            return await make_request(bot, method)
+        future = self.in_flight[key] = asyncio.get_running_loop().create_future()
+        self.counters["requests"] += 1
+        try:
+            result = await make_request(bot, method)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Marks it retrieved: followers re-raise it, the leader does below
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.in_flight[key]
+
+    def _saved(self, reason):
+        self.counters[reason] += 1
+        now = int(time.monotonic())
+        if self.window and self.window[-1][0] == now:
+            self.window[-1][1] += 1
+        else:
+            self.window.append([now, 1])
+
+    def saved_per_minute(self):
+        cutoff = int(time.monotonic()) - 60
+        while self.window and self.window[0][0] <= cutoff:
+            self.window.popleft()
+        return sum(count for _, count in self.window)
+
+    def stats(self):
+        return dict(self.counters, saved_per_minute=self.saved_per_minute())
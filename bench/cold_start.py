@@ -0,0 +1,154 @@
+# Cold start with many stored users: parsing the whole format 1 JSON file, as the
+# bot did before lazy loading, against opening the sharded record files and loading
+# users on first access. Every measurement runs in a fresh interpreter so the
+# reported peak RSS is that of the load alone.
+#
+#   python bench/cold_start.py [users] [songs_per_user] [--cache N] [--dir DIR]
+#
+# The generated files are kept in DIR (a new temporary directory by default) and
+# reused when the same DIR is passed again.
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from storage import (
+    DEFAULT_SHARDS, RecordWriter, ShardedStore, data_records, layout_path, records_path, shard_of,
+    shard_path, write_layout,
+)
+
+ACCESSES = 10000
+
+
+def user_data(user_id, songs):
+    return {"Favourites": [
+        {"file_id": f"CQACAgIAAxkBAAI{user_id:010d}{song:04d}", "file_name": f"track {song}.mp3"}
+        for song in range(songs)
+    ]}
+
+
+def generate(directory, users, songs):
+    legacy = os.path.join(directory, "legacy.json")
+    sharded = os.path.join(directory, "sharded.json")
+    if os.path.exists(legacy) and os.path.exists(layout_path(sharded, 0, 1)):
+        return legacy, sharded
+    started = time.perf_counter()
+    data = {str(user_id): user_data(user_id, songs) for user_id in range(1, users + 1)}
+    with open(legacy, "w", encoding="utf-8") as f:
+        json.dump({"format": 1, "seq": 0, "data": data}, f, ensure_ascii=False)
+
+    writers = [RecordWriter(records_path(shard_path(sharded, index, DEFAULT_SHARDS))) for index in range(DEFAULT_SHARDS)]
+    for key, value in data_records(data):
+        writers[shard_of(key[2:], DEFAULT_SHARDS)].add(key, value)
+    for writer in writers:
+        writer.finish(0)
+    write_layout(layout_path(sharded, 0, 1), DEFAULT_SHARDS)
+    print(f"generated {users} users in {time.perf_counter() - started:.1f}s")
+    return legacy, sharded
+
+
+def proc_status_mb(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    # ru_maxrss survives exec, so it would include the generating parent; VmHWM doesn't
+    peak = proc_status_mb("VmHWM")
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure_legacy(path):
+    started = time.perf_counter()
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)["data"]
+    return {"load_seconds": time.perf_counter() - started, "users": len(data), "rss_mb": peak_rss_mb()}
+
+
+def measure_sharded(path, users, cache):
+    store = ShardedStore(path, cache_users=cache)
+    started = time.perf_counter()
+    view = store.load()
+    result = {"load_seconds": time.perf_counter() - started, "rss_after_load_mb": peak_rss_mb()}
+
+    # First updates after a restart: every user is a miss
+    ids = [str(random.randint(1, users)) for _ in range(ACCESSES)]
+    started = time.perf_counter()
+    for user_id in ids:
+        view[user_id]
+    result["cold_access_us"] = (time.perf_counter() - started) / ACCESSES * 1e6
+
+    # A hot working set that fits the cache
+    hot = ids[:min(cache, ACCESSES) // 2]
+    started = time.perf_counter()
+    for user_id in random.choices(hot, k=ACCESSES):
+        view[user_id]
+    result["hot_access_us"] = (time.perf_counter() - started) / ACCESSES * 1e6
+    result["cache"] = store.cache_stats()
+    result["rss_mb"] = peak_rss_mb()
+    # Pages of the mmapped record files count towards RSS but are reclaimable page cache
+    result["anon_mb"] = proc_status_mb("RssAnon")
+    for shard in store.shards.values():
+        shard.abandon()
+    return result
+
+
+def run_child(args):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), *args], check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("users", type=int, nargs="?", default=1000000)
+    parser.add_argument("songs", type=int, nargs="?", default=3)
+    parser.add_argument("--cache", type=int, default=50000)
+    parser.add_argument("--dir")
+    parser.add_argument("--measure", choices=["legacy", "sharded"], help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure == "legacy":
+        print(json.dumps(measure_legacy(args.path)))
+        return
+    if args.measure == "sharded":
+        print(json.dumps(measure_sharded(args.path, args.users, args.cache)))
+        return
+
+    directory = args.dir or tempfile.mkdtemp(prefix="playlist-cold-start-")
+    os.makedirs(directory, exist_ok=True)
+    legacy, sharded = generate(directory, args.users, args.songs)
+    print(f"files in {directory}: legacy {os.path.getsize(legacy) / 1e6:.0f} MB")
+
+    result = run_child(["--measure", "legacy", "--path", legacy])
+    print(f"format 1 (one JSON): load {result['load_seconds']:.2f}s, peak RSS {result['rss_mb']:.0f} MB")
+
+    result = run_child([str(args.users), "--measure", "sharded", "--path", sharded, "--cache", str(args.cache)])
+    print(
+        f"record files ({DEFAULT_SHARDS} shards): load {result['load_seconds'] * 1000:.1f}ms, "
+        f"RSS after load {result['rss_after_load_mb']:.0f} MB, after {2 * ACCESSES} accesses {result['rss_mb']:.0f} MB "
+        f"({result['anon_mb']:.0f} MB not file-backed)"
+    )
+    print(
+        f"  cold access {result['cold_access_us']:.0f}us/user, hot access {result['hot_access_us']:.1f}us/user, "
+        f"cache {result['cache']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# Micro-benchmark: routing cost per callback update, old startswith chain vs the
+# dispatch table. Handlers are no-ops, so the numbers are pure routing overhead.
+#
+#   python bench/dispatch_cost.py [updates]
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from aiogram import F, Router
+from aiogram.types import CallbackQuery, Message, User
+
+from callbacks import CONFIRM_DELETE_SONG, PLAY_SONG, SEND_ALL, VIEW_PLAYLIST, encode
+from routing import CallbackRoutes, TextRoute, TextRoutes
+
+# The callback prefixes in the order Bot.py used to register them
+LEGACY_CALLBACKS = [
+    "select_playlist:", "view_playlist:", "send_all_music:", "play_song:", "confirm_delete_song:",
+    "delete_song:", "confirm_delete:", "delete_playlist:", "cancel_delete", "share_playlist:",
+]
+LEGACY_TEXTS = ["➕ Create Playlist", "🎵 Add Music", "🎶 My Playlists", "❓ Help"]
+
+
+class PlaylistIds:
+    # Stands in for MusicStore's interning table: one user with one playlist
+    def playlist_name(self, user_id, playlist_id):
+        return "rock" if playlist_id == 1 else None
+
+    def version(self, user_id, playlist_name=None):
+        return 7
+
+
+async def noop(event, **kwargs):
+    return None
+
+
+def legacy_router():
+    router = Router()
+    for prefix in LEGACY_CALLBACKS:
+        router.callback_query(lambda query, prefix=prefix: query.data.startswith(prefix))(noop)
+    for text in LEGACY_TEXTS[:-1]:
+        router.message(F.text == text)(noop)
+    router.message(lambda message: message.text.startswith("playlist_"))(noop)
+    router.message(F.text == LEGACY_TEXTS[-1])(noop)
+    return router
+
+
+def table_router():
+    router = Router()
+    callback_routes = CallbackRoutes(PlaylistIds())
+    text_routes = TextRoutes()
+    callback_routes.stale_button(noop)
+    for code in range(1, 11):
+        callback_routes.action(code)(noop)
+    callback_routes.prefix("cancel_delete")(noop)
+    for text in LEGACY_TEXTS:
+        text_routes.text(text)(noop)
+    text_routes.prefix("playlist_")(noop)
+
+    @router.message(TextRoute(text_routes))
+    async def route_text(message, text_handler, **data):
+        return await text_handler.call(message, **data)
+
+    @router.callback_query()
+    async def route_callback(query, **data):
+        return await callback_routes.dispatch(query, data)
+
+    return router
+
+
+def callback(data):
+    return CallbackQuery(id="1", from_user=User(id=1, is_bot=False, first_name="u"), chat_instance="c", data=data)
+
+
+def text_message(text):
+    return Message.model_validate({
+        "message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"},
+        "from": {"id": 1, "is_bot": False, "first_name": "u"}, "text": text,
+    })
+
+
+async def measure(router, event_type, events, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for event in events:
+            await router.propagate_event(event_type, event)
+    return (time.perf_counter() - started) / (rounds * len(events)) * 1e6
+
+
+async def main(updates):
+    # A mix dominated by play_song, the most frequent tap
+    legacy_callbacks = [callback(data) for data in (
+        ["play_song:rock:3"] * 6 + ["view_playlist:rock", "send_all_music:rock", "confirm_delete_song:rock:3", "share_playlist:rock"]
+    )]
+    table_callbacks = [callback(data) for data in (
+        [encode(PLAY_SONG, 1, 7, 3)] * 6 + [encode(VIEW_PLAYLIST, 1, 0), encode(SEND_ALL, 1, 7), encode(CONFIRM_DELETE_SONG, 1, 7, 3), encode(VIEW_PLAYLIST, 1, 0)]
+    )]
+    texts = [text_message(text) for text in LEGACY_TEXTS + ["playlist_abc"]]
+
+    rounds = max(1, updates // 10)
+    legacy, table = legacy_router(), table_router()
+    print(f"{'':24}{'before (us)':>14}{'after (us)':>14}")
+    before = await measure(legacy, "callback_query", legacy_callbacks, rounds)
+    after = await measure(table, "callback_query", table_callbacks, rounds)
+    print(f"{'callback_query':24}{before:14.2f}{after:14.2f}")
+    before = await measure(legacy, "message", texts, rounds)
+    after = await measure(table, "message", texts, rounds)
+    print(f"{'message (menu buttons)':24}{before:14.2f}{after:14.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
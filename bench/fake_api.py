@@ -0,0 +1,142 @@
+# Stand-in Bot API served over HTTP, for runs where the bot is a separate process
+# (BOT_API_URL=http://127.0.0.1:<port>). Answers every method with a plausible
+# result, counts calls, and hands out queued updates to getUpdates. It can also
+# answer a share of the calls with a flood-limit 429 or a failure, drawn from a
+# seeded generator.
+#
+#   python bench/fake_api.py [port] [--latency S] [--flood RATE] [--errors RATE]
+#
+# runs it on its own, so its CPU time doesn't count against the bot's event loop;
+# GET /stats returns the counters.
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter, deque
+
+from aiohttp import web
+
+# Calls the bot makes on its own rather than in reply to an update
+SETUP_METHODS = {"getupdates", "getme", "deletewebhook", "setwebhook", "close", "logout"}
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, flood_rate=0.0, error_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.floods = Counter()
+        self.failures = Counter()
+        self.replies = 0
+        self.updates = deque()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.arrived = asyncio.Event()
+        self.polled = asyncio.Event()
+        self.runner = None
+
+    def push(self, updates):
+        for update in updates:
+            self.updates.append(dict(update, update_id=next(self.update_ids)))
+        self.arrived.set()
+
+    def message(self, fields):
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(fields.get("chat_id") or 0), "type": "private"},
+            "text": fields.get("text"),
+        }
+
+    async def get_updates(self, fields):
+        self.polled.set()
+        if not self.updates:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), timeout=float(fields.get("timeout") or 0) or 0.1)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(fields.get("limit") or 100)
+        return [self.updates.popleft() for _ in range(min(limit, len(self.updates)))]
+
+    async def handle(self, request):
+        method = request.match_info["method"].lower()
+        fields = await request.post()
+        self.calls[method] += 1
+        if method == "getupdates":
+            return web.json_response({"ok": True, "result": await self.get_updates(fields)})
+        if self.latency:
+            await asyncio.sleep(self.random.uniform(0, 2 * self.latency))
+        if method not in SETUP_METHODS:
+            roll = self.random.random()
+            if roll < self.flood_rate:
+                self.floods[method] += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }, status=429)
+            if roll < self.flood_rate + self.error_rate:
+                self.failures[method] += 1
+                return web.json_response(
+                    {"ok": False, "error_code": 400, "description": "Bad Request: simulated failure"}, status=400
+                )
+            self.replies += 1
+        if method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "playlist_test_bot"}
+        elif method in ("sendmessage", "sendaudio", "editmessagetext"):
+            result = self.message(fields)
+        elif method == "sendmediagroup":
+            result = [self.message(fields)]
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def stats(self):
+        return {
+            "calls": dict(self.calls.most_common()),
+            "floods": dict(self.floods),
+            "failures": dict(self.failures),
+            "replies": self.replies,
+        }
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    async def start(self, port, host="127.0.0.1"):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/stats", self.handle_stats)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("port", type=int, nargs="?", default=8081)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--flood", type=float, default=0.0)
+    parser.add_argument("--errors", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    api = FakeBotAPI(args.latency, args.flood, args.errors, seed=args.seed)
+    await api.start(args.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,53 @@
+# In-process stand-in for the Bot API: records every call and answers with
+# plausible objects after an optional simulated latency.
+import asyncio
+import datetime
+import itertools
+import random
+
+from aiogram import methods
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message, User
+
+
+class FakeSession(BaseSession):
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = []
+        self.message_ids = itertools.count(1)
+
+    def message(self, chat_id, text=None):
+        return Message(
+            message_id=next(self.message_ids),
+            date=datetime.datetime.now(),
+            chat=Chat(id=chat_id, type="private"),
+            text=text,
+        )
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        if self.latency:
+            await asyncio.sleep(random.uniform(0, 2 * self.latency))
+        if isinstance(method, (methods.SendMessage, methods.SendAudio)):
+            return self.message(method.chat_id, getattr(method, "text", None))
+        if isinstance(method, methods.SendMediaGroup):
+            return [self.message(method.chat_id) for _ in method.media]
+        if isinstance(method, methods.EditMessageText):
+            return self.message(method.chat_id or 0, method.text)
+        if isinstance(method, methods.GetMe):
+            return User(id=1, is_bot=True, first_name="Bot", username="playlist_test_bot")
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def install(bot, session):
+    # Keep the request middlewares (rate limiter etc.) registered on the real session
+    for middleware in bot.session.middleware._middlewares:
+        session.middleware(middleware)
+    bot.session = session
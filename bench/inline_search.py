@@ -0,0 +1,108 @@
+# Inline search latency: one user holding every song of a shard (the worst case, as
+# every match is theirs to rank), queried with one to three words where the last one
+# is still being typed, paged the way Telegram asks for more results. The first search
+# builds the shard's index off the loop; the longest the loop went without running a
+# task meanwhile is reported too (what remains is the garbage collector's full passes
+# over the heap the build grows).
+#
+#   python bench/inline_search.py [songs] [queries]
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from search import search_library
+from storage import ShardedStore
+
+PLAYLISTS = 10
+WORDS = [
+    "love", "night", "dance", "blue", "river", "fire", "heart", "rain", "summer", "city", "dream", "light",
+    "road", "moon", "gold", "wild", "home", "sky", "ocean", "storm", "shadow", "echo", "silver", "paper",
+    "remix", "live", "acoustic", "edit", "feat", "version",
+]
+
+
+def song_name(rng, number):
+    return " ".join(rng.sample(WORDS, 3)) + f" {number}.mp3"
+
+
+def query(rng):
+    words = rng.sample(WORDS, rng.randint(1, 3))
+    # The word being typed
+    words[-1] = words[-1][:rng.randint(1, len(words[-1]))]
+    return " ".join(words)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def main(songs, queries):
+    rng = random.Random(1)
+    store = ShardedStore(os.path.join(tempfile.mkdtemp(prefix="playlist-search-"), "music_data.json"), shards=1)
+    store.load()
+    store.start()
+    user_id = "1"
+    store.add_user(user_id)
+    for playlist in range(PLAYLISTS):
+        store.create_playlist(user_id, f"playlist {playlist}")
+    for number in range(songs):
+        store.add_song(user_id, f"playlist {number % PLAYLISTS}", f"song{number}", f"file{number}", song_name(rng, number))
+
+    # A live shard's songs are mostly in its record file by the time anyone searches
+    for shard in store.shards.values():
+        await shard.checkpoint()
+
+    stalls = []
+
+    async def ticker():
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stalls.append(time.perf_counter() - started)
+
+    ticking = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await search_library(store, user_id, "")
+    built = time.perf_counter() - started
+    ticking.cancel()
+    print(
+        f"{songs} songs: index built on first search in {built * 1000:.0f}ms, "
+        f"longest loop stall meanwhile {max(stalls, default=0) * 1000:.1f}ms"
+    )
+
+    first, later = [], []
+    for _ in range(queries):
+        text = query(rng)
+        started = time.perf_counter()
+        page, offset = await search_library(store, user_id, text)
+        first.append(time.perf_counter() - started)
+        if offset is not None:
+            started = time.perf_counter()
+            await search_library(store, user_id, text, offset)
+            later.append(time.perf_counter() - started)
+    for label, times in (("first page", first), ("next page", later)):
+        if times:
+            print(
+                f"{label}: p50 {statistics.median(times) * 1000:.2f}ms, p99 {percentile(times, 0.99) * 1000:.2f}ms, "
+                f"max {max(times) * 1000:.2f}ms ({len(times)} queries)"
+            )
+
+    # Index upkeep rides along with every add and delete
+    started = time.perf_counter()
+    for number in range(songs, songs + 1000):
+        store.add_song(user_id, "playlist 0", f"song{number}", f"file{number}", song_name(rng, number))
+    print(f"add with index upkeep: {(time.perf_counter() - started) * 1000:.3f}us/song")
+    await store.close()
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    songs, queries = args + [100000, 2000][len(args):]
+    asyncio.run(main(songs, queries))
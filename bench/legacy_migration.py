@@ -0,0 +1,144 @@
+# Converting a snapshot of users in the pre-playlist shape ({"music": [...],
+# "unique_id": ...}) to record files: json.load of the whole document and
+# data_records, as the conversion did before, against the streaming converter; and
+# /getlist's old linear scan for a unique_id against the converted index. Every
+# measurement runs in a fresh interpreter so the reported peak RSS is that of the
+# step alone.
+#
+#   python bench/legacy_migration.py [users] [songs_per_user] [--dir DIR]
+#
+# The generated file is written a user at a time and kept in DIR (a new temporary
+# directory by default), so it can be made larger than memory.
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from storage import LEGACY_PLAYLIST, RecordWriter, ShardedStore, convert_snapshot, data_records, records_path
+
+LOOKUPS = 20
+
+
+def unique_id(user_id):
+    return f"{user_id * 2654435761 % 16 ** 8:08x}"
+
+
+def generate(directory, users, songs):
+    path = os.path.join(directory, "legacy.json")
+    if os.path.exists(path):
+        return path
+    started = time.perf_counter()
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{")
+        # About half the songs are held by two users
+        distinct = users * songs // 2 + 1
+        for user_id in range(1, users + 1):
+            music = [
+                {"file_id": f"CQACAgIAAxkBAAI{(user_id * songs + song) % distinct:010d}", "file_name": f"track {song}.mp3"}
+                for song in range(songs)
+            ]
+            separator = "," if user_id > 1 else ""
+            f.write(f'{separator}"{user_id}":{json.dumps({"music": music, "unique_id": unique_id(user_id)})}')
+        f.write("}")
+    print(f"generated {users} users in {time.perf_counter() - started:.1f}s")
+    return path
+
+
+def peak_rss_mb():
+    # ru_maxrss survives exec, so it would include the generating parent; VmHWM doesn't
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure_load(path, users):
+    started = time.perf_counter()
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    writer = RecordWriter(os.path.join(os.path.dirname(path), "in_memory.records"))
+    for key, value in data_records(data):
+        writer.add(key, value)
+    writer.finish(0)
+    result = {"convert_seconds": time.perf_counter() - started, "rss_mb": peak_rss_mb()}
+    wanted = [unique_id(random.randint(1, users)) for _ in range(LOOKUPS)]
+    started = time.perf_counter()
+    for token in wanted:
+        next((uid for uid, user in data.items() if user.get("unique_id") == token), None)
+    result["lookup_us"] = (time.perf_counter() - started) / LOOKUPS * 1e6
+    return result
+
+
+def measure_convert(path, users):
+    target = os.path.join(os.path.dirname(path), "music_data.json")
+    started = time.perf_counter()
+    convert_snapshot(path, records_path(target))
+    result = {"convert_seconds": time.perf_counter() - started, "rss_mb": peak_rss_mb()}
+    result["records_mb"] = os.path.getsize(records_path(target)) / 1e6
+
+    store = ShardedStore(target, shards=1)
+    store.load()
+    wanted = [unique_id(random.randint(1, users)) for _ in range(LOOKUPS * 100)]
+    started = time.perf_counter()
+    for token in wanted:
+        owner, playlist_name = store.shares.resolve(token)
+        assert playlist_name == LEGACY_PLAYLIST
+    result["lookup_us"] = (time.perf_counter() - started) / len(wanted) * 1e6
+    for shard in store.shards.values():
+        shard.abandon()
+    return result
+
+
+def run_child(args):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), *args], check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("users", type=int, nargs="?", default=200000)
+    parser.add_argument("songs", type=int, nargs="?", default=20)
+    parser.add_argument("--dir")
+    parser.add_argument("--measure", choices=["load", "convert"], help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure == "load":
+        print(json.dumps(measure_load(args.path, args.users)))
+        return
+    if args.measure == "convert":
+        print(json.dumps(measure_convert(args.path, args.users)))
+        return
+
+    directory = args.dir or tempfile.mkdtemp(prefix="playlist-legacy-")
+    os.makedirs(directory, exist_ok=True)
+    path = generate(directory, args.users, args.songs)
+    print(f"legacy file in {directory}: {os.path.getsize(path) / 1e6:.0f} MB")
+
+    result = run_child([str(args.users), "--measure", "load", "--path", path])
+    print(
+        f"json.load + data_records: {result['convert_seconds']:.2f}s, peak RSS {result['rss_mb']:.0f} MB; "
+        f"/getlist scan {result['lookup_us'] / 1000:.1f}ms per lookup"
+    )
+    result = run_child([str(args.users), "--measure", "convert", "--path", path])
+    print(
+        f"streaming convert: {result['convert_seconds']:.2f}s, peak RSS {result['rss_mb']:.0f} MB, "
+        f"{result['records_mb']:.0f} MB of records; /getlist index {result['lookup_us']:.1f}us per lookup"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+# Offline load test: Bot.py's router, in this process, against bench/fake_api.py
+# running in a process of its own, fed a synthetic update stream from many users at
+# once, in getUpdates-sized batches as fast as they are taken or at --rate updates/s.
+# The stream is built from a seed, so runs on different commits see the same workload:
+#
+#   build    every user starts the bot, creates a playlist or two, adds songs in one
+#            Add Music session, views their playlists and songs; some share a playlist
+#   open     other users open those share links (the playlist is sent to them) and
+#            some of them subscribe
+#   update   the sharers add more songs, which notifies the subscribers
+#
+# Reports throughput, per-handler p50/p99, outbound calls (and injected 429s and
+# failures), and what the storage wrote to disk.
+#
+#   python bench/load_test.py [users] [--rate N] [--latency S] [--flood RATE] [--errors RATE]
+#                             [--telegram-limits] [--json out.json] [--compare base.json]
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH, "..")
+sys.path.insert(0, BENCH)
+sys.path.insert(0, ROOT)
+
+from aiohttp import ClientSession
+
+API_PORT = 8182
+SEED = 1
+# Updates handed over at a time, like one getUpdates answer
+BATCH = 100
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Stream:
+    # Builds aiogram Update objects; imported lazily because Bot.py must only be
+    # imported once BOT_API_URL points at the fake server
+    def __init__(self):
+        from aiogram.types import Audio, CallbackQuery, Chat, Message, Update, User
+        self.types = Audio, CallbackQuery, Chat, Message, Update, User
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.query_ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return self.types[5](id=user_id, is_bot=False, first_name=f"user{user_id}")
+
+    def _chat(self, user_id):
+        return self.types[2](id=user_id, type="private")
+
+    def message(self, user_id, **fields):
+        Message, Update = self.types[3], self.types[4]
+        return Update(update_id=next(self.update_ids), message=Message(
+            message_id=next(self.message_ids), date=datetime.datetime.now(),
+            chat=self._chat(user_id), from_user=self._user(user_id), **fields,
+        ))
+
+    def text(self, user_id, text):
+        return self.message(user_id, text=text)
+
+    def audio(self, user_id, song):
+        return self.message(user_id, audio=self.types[0](
+            file_id=f"file-{song}", file_unique_id=f"song-{song}", duration=180, file_name=f"track {song}.mp3",
+        ))
+
+    def press(self, user_id, data):
+        CallbackQuery, Message, Update = self.types[1], self.types[3], self.types[4]
+        return Update(update_id=next(self.update_ids), callback_query=CallbackQuery(
+            id=str(next(self.query_ids)), from_user=self._user(user_id), chat_instance="load", data=data,
+            message=Message(message_id=next(self.message_ids), date=datetime.datetime.now(), chat=self._chat(user_id)),
+        ))
+
+
+def interleave(rng, per_user):
+    # Random arrival order across users that keeps each user's own updates in order
+    queues = [list(updates) for updates in per_user if updates]
+    merged = []
+    while queues:
+        index = rng.randrange(len(queues))
+        merged.append(queues[index].pop(0))
+        if not queues[index]:
+            queues[index] = queues[-1]
+            queues.pop()
+    return merged
+
+
+def add_session(stream, rng, user_id, playlist_id, songs, catalog):
+    from callbacks import FINISH_ADD, SELECT_PLAYLIST, encode
+    # Popular songs are shared between libraries, like real ones
+    picks = [min(int(rng.paretovariate(1.2)) - 1, catalog - 1) if rng.random() < 0.5 else rng.randrange(catalog)
+             for _ in range(songs)]
+    return (
+        [stream.text(user_id, "🎵 Add Music"), stream.press(user_id, encode(SELECT_PLAYLIST, playlist_id, 0))]
+        + [stream.audio(user_id, song) for song in picks]
+        + [stream.press(user_id, encode(FINISH_ADD, playlist_id, 0))]
+    )
+
+
+def build_phase(stream, rng, users, share_rate):
+    from callbacks import SHARE_PLAYLIST, SONGS_PAGE, VIEW_PLAYLIST, encode
+    catalog = len(users) * 20
+    per_user = []
+    sharers = []
+    for user_id in users:
+        updates = [stream.text(user_id, "/start"), stream.text(user_id, "➕ Create Playlist"), stream.text(user_id, "mix")]
+        updates += add_session(stream, rng, user_id, 1, rng.randint(5, 30), catalog)
+        if rng.random() < 0.3:
+            updates += [stream.text(user_id, "➕ Create Playlist"), stream.text(user_id, "chill")]
+            updates += add_session(stream, rng, user_id, 2, rng.randint(3, 10), catalog)
+        updates += [
+            stream.text(user_id, "🎶 My Playlists"),
+            stream.press(user_id, encode(VIEW_PLAYLIST, 1, 0)),
+            stream.press(user_id, encode(SONGS_PAGE, 1, 0, 1)),
+        ]
+        if rng.random() < share_rate:
+            updates.append(stream.press(user_id, encode(SHARE_PLAYLIST, 1, 0)))
+            sharers.append(user_id)
+        per_user.append(updates)
+    return interleave(rng, per_user), sharers
+
+
+def open_phase(stream, rng, users, tokens, opens):
+    per_user = []
+    for user_id in users:
+        updates = []
+        for token in rng.sample(tokens, min(opens, len(tokens))):
+            updates.append(stream.text(user_id, f"/start playlist_{token}"))
+            if rng.random() < 0.5:
+                updates.append(stream.press(user_id, f"subscribe:{token}"))
+        per_user.append(updates)
+    return interleave(rng, per_user)
+
+
+def update_phase(stream, rng, sharers, catalog):
+    return interleave(rng, [add_session(stream, rng, user_id, 1, rng.randint(1, 5), catalog) for user_id in sharers])
+
+
+async def settle(Bot):
+    # Background work the updates started: Add Music batches, playlist sends, notifications
+    while Bot.bulk_add.batches or Bot.jobs.jobs or Bot.broadcasts.pending:
+        await asyncio.sleep(0.05)
+    await Bot.broadcasts.queue.join()
+
+
+async def fire(Bot, updates, rate):
+    # Like polling: one task per update, created in arrival order, BATCH at a time
+    tasks = []
+    started = time.perf_counter()
+    for offset in range(0, len(updates), BATCH):
+        if rate:
+            await asyncio.sleep(max(0.0, started + offset / rate - time.perf_counter()))
+        else:
+            await asyncio.sleep(0)
+        tasks += [asyncio.create_task(Bot.dp.feed_update(Bot.bot, update)) for update in updates[offset:offset + BATCH]]
+    # A handler error fails its update, as it would under polling; the run goes on
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    return sum(1 for result in results if isinstance(result, Exception))
+
+
+async def port_open(port):
+    try:
+        _, writer = await asyncio.open_connection("127.0.0.1", port)
+    except OSError:
+        return False
+    writer.close()
+    return True
+
+
+async def start_api(args):
+    if await port_open(API_PORT):
+        raise RuntimeError(f"Port {API_PORT} is taken, is an earlier fake_api.py still running?")
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(BENCH, "fake_api.py"), str(API_PORT), "--latency", str(args.latency),
+        "--flood", str(args.flood), "--errors", str(args.errors), "--seed", str(SEED),
+    )
+    while not await port_open(API_PORT):
+        if process.returncode is not None:
+            raise RuntimeError("bench/fake_api.py did not start")
+        await asyncio.sleep(0.05)
+    return process, f"http://127.0.0.1:{API_PORT}"
+
+
+async def api_stats(api_url):
+    async with ClientSession() as session:
+        async with session.get(f"{api_url}/stats") as response:
+            return await response.json()
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def disk_bytes(workdir):
+    return sum(os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir) if name.startswith("music_data"))
+
+
+async def run(args):
+    api, api_url = await start_api(args)
+    try:
+        return await measure(args, api_url)
+    finally:
+        api.terminate()
+        await api.wait()
+
+
+async def measure(args, api_url):
+    workdir = tempfile.mkdtemp(prefix="playlist-load-")
+    os.chdir(workdir)
+    os.environ.update(
+        BOT_TOKEN="123456:TEST-TOKEN", BOT_API_URL=api_url,
+        MUSIC_DATA_FILE=os.path.join(workdir, "music_data.json"),
+    )
+
+    import ratelimit
+    if not args.telegram_limits:
+        # Outbound flood limits would make every run as slow as Telegram allows
+        ratelimit.GLOBAL_RATE = ratelimit.PRIVATE_CHAT_RATE = ratelimit.GROUP_CHAT_RATE = 1e9
+
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    import Bot
+    from metrics import current_span
+    logging.getLogger().setLevel(logging.WARNING)
+
+    handler_times = defaultdict(list)
+
+    async def timed(handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            span = current_span.get()
+            handler_times[span.handler if span is not None else "unnamed"].append(time.perf_counter() - started)
+
+    for observer in (Bot.router.message, Bot.router.callback_query, Bot.router.inline_query):
+        observer.middleware(timed)
+    Bot.dp.include_router(Bot.router)
+    # Notifications would otherwise wait a minute for more adds
+    Bot.broadcasts.delay = 0.2
+    Bot.store.start()
+    Bot.loop_monitor.start()
+
+    rng = random.Random(SEED)
+    stream = Stream()
+    users = list(range(100000, 100000 + args.users))
+    phases = {}
+    started = time.perf_counter()
+
+    async def phase(name, updates):
+        began = time.perf_counter()
+        failed = await fire(Bot, updates, args.rate)
+        await settle(Bot)
+        phases[name] = {"updates": len(updates), "failed": failed, "seconds": time.perf_counter() - began}
+
+    updates, sharers = build_phase(stream, rng, users, args.share)
+    await phase("build", updates)
+    tokens = [Bot.store.shares.tokens(str(user_id), "mix")[0] for user_id in sharers]
+    await phase("open", open_phase(stream, rng, [user_id for user_id in users if user_id not in set(sharers)], tokens, args.opens))
+    await phase("update", update_phase(stream, rng, sharers, len(users) * 20))
+    elapsed = time.perf_counter() - started
+
+    await Bot.loop_monitor.stop()
+    await Bot.store.close()
+    await Bot.bot.session.close()
+    calls = await api_stats(api_url)
+    storage = Bot.store.flush_stats()
+    total_updates = sum(entry["updates"] for entry in phases.values())
+    written = storage["journal_bytes"] + storage["records_bytes"]
+    on_disk = disk_bytes(workdir)
+    return {
+        "commit": commit(),
+        "workload": {
+            "users": args.users, "rate": args.rate, "share": args.share, "opens": args.opens, "latency": args.latency,
+            "flood": args.flood, "errors": args.errors, "telegram_limits": args.telegram_limits, "seed": SEED,
+        },
+        "updates": total_updates,
+        "seconds": elapsed,
+        "updates_per_s": total_updates / elapsed,
+        "phases": phases,
+        "handlers": {
+            name: {"count": len(times), "p50": statistics.median(times), "p99": percentile(times, 0.99)}
+            for name, times in sorted(handler_times.items(), key=lambda item: -len(item[1]))
+        },
+        "api": {
+            "calls": calls["calls"],
+            "floods": calls["floods"],
+            "failures": calls["failures"],
+            "retry_after_hits": Bot.rate_limiter.stats()["retry_after_hits"],
+            # Calls answered in the bot without reaching the API (results of older commits don't have it)
+            "saved": {key: value for key, value in Bot.api_calls.stats().items() if key != "saved_per_minute"},
+        },
+        "storage": {
+            "mutations": storage["mutations"],
+            "journal_bytes": storage["journal_bytes"],
+            "records_bytes": storage["records_bytes"],
+            "compactions": storage["compactions"],
+            "on_disk_bytes": on_disk,
+            "bytes_per_mutation": written / storage["mutations"] if storage["mutations"] else 0.0,
+            "write_amplification": written / on_disk if on_disk else 0.0,
+        },
+        "loop": {"max_lag": Bot.loop_monitor.max_lag, "stalls": Bot.loop_monitor.stalls},
+    }
+
+
+def report(result):
+    workload = result["workload"]
+    print(f"commit {result['commit']}: {workload['users']} users, seed {workload['seed']}, "
+          f"API latency {workload['latency'] * 1000:.0f}ms, 429s {workload['flood']:.2%}, failures {workload['errors']:.2%}")
+    print(f"{result['updates']} updates in {result['seconds']:.2f}s ({result['updates_per_s']:.0f} updates/s)")
+    for name, entry in result["phases"].items():
+        failed = f", {entry['failed']} failed" if entry["failed"] else ""
+        print(f"  {name:>7}: {entry['updates']:7} updates, {entry['seconds']:6.2f}s{failed}")
+    print("handlers:")
+    for name, entry in result["handlers"].items():
+        print(f"  {name:>28}: {entry['count']:7}  p50 {entry['p50'] * 1000:7.2f}ms  p99 {entry['p99'] * 1000:7.2f}ms")
+    api = result["api"]
+    print("Bot API calls: " + ", ".join(f"{method} {count}" for method, count in api["calls"].items()))
+    if api.get("saved"):
+        print("  saved without a request: " + ", ".join(f"{reason} {count}" for reason, count in api["saved"].items()
+                                                          if reason != "requests"))
+    if api["floods"] or api["failures"]:
+        print(f"  injected 429s {sum(api['floods'].values())}, failures {sum(api['failures'].values())}, "
+              f"retried after 429: {api['retry_after_hits']}")
+    storage = result["storage"]
+    print(f"storage: {storage['mutations']} mutations, journal {storage['journal_bytes']} bytes, "
+          f"record files {storage['records_bytes']} bytes over {storage['compactions']} compactions, "
+          f"{storage['on_disk_bytes']} bytes on disk")
+    print(f"  {storage['bytes_per_mutation']:.0f} bytes written per mutation, write amplification {storage['write_amplification']:.2f}x")
+    print(f"event loop: max lag {result['loop']['max_lag'] * 1000:.0f}ms, {result['loop']['stalls']} stalls")
+
+
+def compare(base, result):
+    # The headline numbers side by side; lower is better except for throughput
+    rows = [("updates/s", base["updates_per_s"], result["updates_per_s"])]
+    for name, entry in result["handlers"].items():
+        if name in base["handlers"]:
+            rows.append((f"{name} p50 ms", base["handlers"][name]["p50"] * 1000, entry["p50"] * 1000))
+            rows.append((f"{name} p99 ms", base["handlers"][name]["p99"] * 1000, entry["p99"] * 1000))
+    rows.append(("Bot API calls", sum(base["api"]["calls"].values()), sum(result["api"]["calls"].values())))
+    for key in ("bytes_per_mutation", "write_amplification"):
+        rows.append((key.replace("_", " "), base["storage"][key], result["storage"][key]))
+    if base["workload"] != result["workload"]:
+        print(f"note: workloads differ ({base['workload']} vs {result['workload']})")
+    print(f"{'':>36} {base['commit'] or 'base':>10} {result['commit'] or 'now':>10}")
+    for label, old, new in rows:
+        change = f"{(new - old) / old:+.1%}" if old else ""
+        print(f"{label:>36} {old:10.2f} {new:10.2f} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("users", type=int, nargs="?", default=2000)
+    parser.add_argument("--rate", type=float, default=0, help="updates/s to feed (default: as fast as taken)")
+    parser.add_argument("--share", type=float, default=0.2, help="share of users who share a playlist")
+    parser.add_argument("--opens", type=int, default=2, help="share links each other user opens")
+    parser.add_argument("--latency", type=float, default=0.005, help="mean simulated Bot API latency (s)")
+    parser.add_argument("--flood", type=float, default=0.0, help="share of calls answered with a 429")
+    parser.add_argument("--errors", type=float, default=0.0, help="share of calls that fail")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the outbound flood limits")
+    parser.add_argument("--json", help="write the results here")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    base = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            base = json.load(f)
+    result = asyncio.run(run(args))
+    report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=1)
+    if base is not None:
+        compare(base, result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# POSTs recorded updates (one JSON object per line) to a webhook server, the way
+# Telegram would, and reports throughput. Updates of one user stay in order on one
+# connection; different users are spread over --concurrency connections.
+#
+#   python bench/post_updates.py updates.jsonl http://127.0.0.1:8080/webhook [--secret S] [--concurrency 40]
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from aiohttp import ClientSession, TCPConnector
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def read_updates(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def sender_id(update):
+    for payload in update.values():
+        if isinstance(payload, dict) and payload.get("from"):
+            return payload["from"]["id"]
+    return 0
+
+
+async def post_all(url, updates, secret="", concurrency=40):
+    lanes = [[] for _ in range(concurrency)]
+    for update in updates:
+        lanes[sender_id(update) % concurrency].append(update)
+    headers = {SECRET_HEADER: secret} if secret else {}
+    failed = 0
+
+    async def send(lane, session):
+        nonlocal failed
+        for update in lane:
+            async with session.post(url, json=update, headers=headers) as response:
+                if response.status != 200:
+                    failed += 1
+
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+        await asyncio.gather(*(send(lane, session) for lane in lanes))
+    return failed
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("updates")
+    parser.add_argument("url")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--concurrency", type=int, default=40)
+    args = parser.parse_args()
+
+    updates = read_updates(args.updates)
+    started = time.perf_counter()
+    failed = await post_all(args.url, updates, args.secret, args.concurrency)
+    elapsed = time.perf_counter() - started
+    print(f"posted {len(updates)} updates in {elapsed:.2f}s ({len(updates) / elapsed:.0f}/s), {failed} rejected")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
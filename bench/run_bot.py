@@ -0,0 +1,22 @@
+# Runs Bot.py as a separate process for benchmarks, with the outbound flood limits
+# lifted so the numbers measure update handling rather than Telegram's caps.
+#
+#   BOT_API_URL=http://127.0.0.1:8081 python bench/run_bot.py [polling|webhook]
+import logging
+import os
+import runpy
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN")
+
+import ratelimit
+
+ratelimit.GLOBAL_RATE = ratelimit.PRIVATE_CHAT_RATE = ratelimit.GROUP_CHAT_RATE = 1e9
+
+# Per-update INFO lines would dominate the profile
+logging.basicConfig(level=logging.WARNING)
+
+sys.argv = [os.path.join(ROOT, "Bot.py")] + sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
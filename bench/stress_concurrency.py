@@ -0,0 +1,150 @@
+# Stress test for per-user ordering: many simulated users fire rapid add/delete
+# taps at once, the way long polling hands them over (one task per update).
+# Checks that no user ever has two handlers running at once and that double taps
+# on the same delete button remove exactly one song.
+#
+#   python bench/stress_concurrency.py [users] [songs_per_user] [--no-ordering]
+#
+# --no-ordering removes the per-user ordering middleware to show what it prevents.
+import asyncio
+import datetime
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN")
+os.chdir(tempfile.mkdtemp(prefix="playlist-stress-"))
+
+import ratelimit
+
+# Outbound throttling is not what's being measured here
+ratelimit.GLOBAL_RATE = ratelimit.PRIVATE_CHAT_RATE = 1e9
+
+import Bot
+from aiogram.types import Audio, CallbackQuery, Chat, Message, Update, User
+from callbacks import CONFIRM_DELETE_SONG, DELETE_SONG, FINISH_ADD, SELECT_PLAYLIST, encode
+from fake_session import FakeSession, install
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+query_ids = itertools.count(1)
+active = {}
+overlaps = 0
+
+
+async def track(handler, event, data):
+    global overlaps
+    user_id = data["event_from_user"].id
+    active[user_id] = active.get(user_id, 0) + 1
+    if active[user_id] > 1:
+        overlaps += 1
+    try:
+        # Yield inside the handler so interleavings actually happen
+        await asyncio.sleep(0)
+        return await handler(event, data)
+    finally:
+        active[user_id] -= 1
+
+
+def sender(user_id):
+    return User(id=user_id, is_bot=False, first_name=f"user{user_id}")
+
+
+def message(user_id, **fields):
+    return Update(update_id=next(update_ids), message=Message(
+        message_id=next(message_ids), date=datetime.datetime.now(),
+        chat=Chat(id=user_id, type="private"), from_user=sender(user_id), **fields,
+    ))
+
+
+def press(user_id, data):
+    return Update(update_id=next(update_ids), callback_query=CallbackQuery(
+        id=str(next(query_ids)), from_user=sender(user_id), chat_instance="stress", data=data,
+        message=Message(message_id=next(message_ids), date=datetime.datetime.now(), chat=Chat(id=user_id, type="private")),
+    ))
+
+
+async def fire(updates):
+    # Like polling: one task per update, created in arrival order
+    await asyncio.gather(*(asyncio.create_task(Bot.dp.feed_update(Bot.bot, update)) for update in updates))
+
+
+def interleave(per_user):
+    # Random arrival order across users that keeps each user's own updates in order
+    queues = [list(updates) for updates in per_user if updates]
+    merged = []
+    while queues:
+        queue = random.choice(queues)
+        merged.append(queue.pop(0))
+        if not queue:
+            queues.remove(queue)
+    return merged
+
+
+async def main(users, songs, ordering=True):
+    if not ordering:
+        Bot.dp.update.outer_middleware._middlewares.remove(Bot.user_ordering)
+    install(Bot.bot, FakeSession(latency=0.002))
+    Bot.dp.include_router(Bot.router)
+    Bot.router.message.middleware(track)
+    Bot.router.callback_query.middleware(track)
+    Bot.store.start()
+    user_ids = range(1000, 1000 + users)
+    started = time.perf_counter()
+
+    # Phase 1: every user creates a playlist and adds songs in one Add Music session
+    # (a burst of audio, then Done), all users at once
+    await fire(interleave([
+        [
+            message(user_id, text="/start"), message(user_id, text="➕ Create Playlist"), message(user_id, text="mix"),
+            press(user_id, encode(SELECT_PLAYLIST, 1, 0)),
+        ]
+        + [
+            message(user_id, audio=Audio(file_id=f"{user_id}-{song}", file_unique_id=f"{user_id}-{song}", duration=1, file_name=f"{song}.mp3"))
+            for song in range(songs)
+        ]
+        + [press(user_id, encode(FINISH_ADD, 1, 0))]
+        for user_id in user_ids
+    ]))
+
+    # Phase 2: each user double-taps delete on song 1 and taps delete on song 2 of the
+    # same keyboard, three times over. Buttons name entry ids, so each burst deletes
+    # exactly those two songs and the second tap on song 1 deletes nothing.
+    bursts = 3
+    for _ in range(bursts):
+        per_user = []
+        for user_id in user_ids:
+            (first, _), (second, _) = Bot.store.songs(str(user_id), "mix").page(0, 2)
+            per_user.append([
+                press(user_id, encode(CONFIRM_DELETE_SONG, 1, 0, first)),
+                press(user_id, encode(DELETE_SONG, 1, 0, first)),
+                press(user_id, encode(DELETE_SONG, 1, 0, first)),
+                press(user_id, encode(DELETE_SONG, 1, 0, second)),
+            ])
+        await fire(interleave(per_user))
+
+    elapsed = time.perf_counter() - started
+    updates = next(update_ids) - 1
+    wrong = [
+        user_id for user_id in user_ids
+        if [song.file_id for song in Bot.store.songs(str(user_id), "mix") or []]
+        != [f"{user_id}-{song}" for song in range(2 * bursts, songs)]
+    ]
+    await Bot.store.close()
+
+    print(f"users={users} songs/user={songs} updates={updates} time={elapsed:.2f}s ({updates / elapsed:.0f} updates/s)")
+    print(f"same-user handler overlaps: {overlaps}")
+    print(f"users with wrong final playlist: {len(wrong)}")
+    print(f"ordering: {Bot.user_ordering.stats()}")
+    return 1 if overlaps or wrong else 0
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:] if not arg.startswith("--")]
+    users, songs = args + [200, 10][len(args):]
+    sys.exit(asyncio.run(main(users, songs, ordering="--no-ordering" not in sys.argv)))
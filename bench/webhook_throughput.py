@@ -0,0 +1,164 @@
+# Compares update throughput of long polling, the single-process webhook server and
+# the sharded multi-worker front (webhook.py). Every mode runs the real Bot.py in
+# its own process(es) against bench/fake_api.py, on the same synthetic workload:
+# each user starts the bot, creates a playlist, opens My Playlists, then picks the
+# playlist and sends a song, a few times over. A run ends when every expected reply has been sent.
+#
+#   python bench/webhook_throughput.py [users] [songs_per_user] [--workers N] [--record updates.jsonl]
+#
+# --record writes the workload so it can be replayed with bench/post_updates.py.
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH)
+sys.path.insert(0, os.path.join(BENCH, ".."))
+
+import webhook
+from callbacks import SELECT_PLAYLIST, encode
+from fake_api import FakeBotAPI
+from post_updates import post_all
+
+API_PORT = 8181
+WEBHOOK_PORT = 8180
+RUN_TIMEOUT = 300
+
+
+def workload(users, songs):
+    # Returns the updates (without update_id) and how many replies they produce
+    updates = []
+    now = int(time.time())
+    for user_id in range(1000, 1000 + users):
+        sender = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        chat = {"id": user_id, "type": "private"}
+
+        def message(**fields):
+            return {"message": dict(message_id=len(updates) + 1, date=now, chat=chat, **{"from": sender}, **fields)}
+
+        updates += [message(text="/start"), message(text="➕ Create Playlist"), message(text="mix"), message(text="🎶 My Playlists")]
+        for song in range(songs):
+            # The add flow takes one audio per pick, so every song is pick + send
+            updates.append({"callback_query": {
+                "id": str(len(updates)), "from": sender, "chat_instance": "bench", "data": encode(SELECT_PLAYLIST, 1, 0),
+                "message": {"message_id": 1, "date": now, "chat": chat},
+            }})
+            updates.append(message(audio={"file_id": f"{user_id}-{song}", "file_unique_id": f"{user_id}-{song}", "duration": 1, "file_name": f"{song}.mp3"}))
+    # One reply per message; a pick is answered and prompts for the audio
+    return updates, users * (4 + 3 * songs)
+
+
+async def wait_for(api, expected):
+    deadline = time.perf_counter() + RUN_TIMEOUT
+    while api.replies < expected:
+        if time.perf_counter() > deadline:
+            raise RuntimeError(f"only {api.replies}/{expected} replies arrived")
+        await asyncio.sleep(0.01)
+    return time.perf_counter()
+
+
+async def wait_port(port):
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        return
+
+
+def bot_env(api_url, workdir):
+    return dict(os.environ, BOT_TOKEN="123456:TEST-TOKEN", BOT_API_URL=api_url, WEBHOOK_URL="",
+                WEBHOOK_HOST="127.0.0.1", WEBHOOK_PORT=str(WEBHOOK_PORT), WEBHOOK_SECRET="bench",
+                MUSIC_DATA_FILE=os.path.join(workdir, "music_data.json"))
+
+
+async def stop(process):
+    process.terminate()
+    await process.wait()
+
+
+async def run_polling(api, api_url, updates, expected, workdir):
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(BENCH, "run_bot.py"), "polling", env=bot_env(api_url, workdir),
+    )
+    try:
+        await api.polled.wait()
+        started = time.perf_counter()
+        api.push(updates)
+        return await wait_for(api, expected) - started
+    finally:
+        await stop(process)
+
+
+async def run_webhook(api, api_url, updates, expected, workdir):
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(BENCH, "run_bot.py"), "webhook", env=bot_env(api_url, workdir),
+    )
+    try:
+        await wait_port(WEBHOOK_PORT)
+        started = time.perf_counter()
+        await post_all(f"http://127.0.0.1:{WEBHOOK_PORT}/webhook", numbered(updates), "bench")
+        return await wait_for(api, expected) - started
+    finally:
+        await stop(process)
+
+
+async def run_workers(api, api_url, updates, expected, workdir, workers):
+    os.environ.update(bot_env(api_url, workdir))
+    front = asyncio.create_task(webhook.run_front(
+        workers, "127.0.0.1", WEBHOOK_PORT, "/webhook", "bench", "",
+        worker_argv=[sys.executable, os.path.join(BENCH, "run_bot.py"), "webhook"],
+    ))
+    try:
+        await wait_port(WEBHOOK_PORT)
+        started = time.perf_counter()
+        await post_all(f"http://127.0.0.1:{WEBHOOK_PORT}/webhook", numbered(updates), "bench")
+        return await wait_for(api, expected) - started
+    finally:
+        front.cancel()
+        await asyncio.gather(front, return_exceptions=True)
+
+
+def numbered(updates):
+    return [dict(update, update_id=update_id) for update_id, update in enumerate(updates, start=1)]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("users", type=int, nargs="?", default=500)
+    parser.add_argument("songs", type=int, nargs="?", default=5)
+    parser.add_argument("--workers", type=int, default=webhook.WEBHOOK_WORKERS)
+    parser.add_argument("--latency", type=float, default=0.005, help="mean simulated Bot API latency (s)")
+    parser.add_argument("--record")
+    args = parser.parse_args()
+
+    updates, expected = workload(args.users, args.songs)
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            for update in numbered(updates):
+                f.write(json.dumps(update, ensure_ascii=False) + "\n")
+
+    modes = [
+        ("polling", run_polling, ()),
+        ("webhook", run_webhook, ()),
+        (f"webhook x{args.workers} workers", run_workers, (args.workers,)),
+    ]
+    print(f"{len(updates)} updates from {args.users} users, {expected} replies, {os.cpu_count()} CPUs")
+    for name, run, extra in modes:
+        api = FakeBotAPI(latency=args.latency)
+        api_url = await api.start(API_PORT)
+        try:
+            elapsed = await run(api, api_url, updates, expected, tempfile.mkdtemp(prefix="playlist-webhook-"), *extra)
+        finally:
+            await api.stop()
+        print(f"{name:>22}: {elapsed:6.2f}s  {len(updates) / elapsed:7.0f} updates/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
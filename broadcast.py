@@ -0,0 +1,183 @@
+import asyncio
+import html
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from delivery import MEDIA_GROUP_LIMIT, deliver_songs
+from ratelimit import BULK, lane
+from storage import Song
+
+# Quiet time after the owner's last add before subscribers hear about it, so songs
+# added in several sittings a few minutes apart go out as one notification
+NOTIFY_DELAY = 60.0
+# A playlist that keeps growing still notifies at least this often
+NOTIFY_MAX_WAIT = 600.0
+# Subscribers served at once; the RateLimiter paces them to the per-chat and global limits
+FANOUT_WORKERS = 8
+# Songs sent along with a notification; the rest are a tap on ▶️ Open playlist away
+NOTIFY_SONGS = MEDIA_GROUP_LIMIT
+
+
+def subscribe_keyboard(token):
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="🔔 Subscribe", callback_data=f"subscribe:{token}")
+    ]])
+
+
+def notice_keyboard(token):
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="▶️ Open playlist", callback_data=f"open_shared:{token}"),
+        InlineKeyboardButton(text="🔕 Unsubscribe", callback_data=f"unsubscribe:{token}"),
+    ]])
+
+
+class PendingUpdate:
+    __slots__ = ("songs", "started", "timer")
+
+    def __init__(self, started):
+        # song_id -> Song, in the order they were added
+        self.songs = {}
+        self.started = started
+        self.timer = None
+
+
+class Broadcaster:
+    # Tells the subscribers of a shared playlist about songs added to it. Adds are
+    # collected per playlist until NOTIFY_DELAY passes without one (or NOTIFY_MAX_WAIT
+    # since the first), then one notification per subscriber goes on a queue that a
+    # few workers drain in the bulk lane. Subscribers who blocked the bot or deleted
+    # their chat are unsubscribed on the way. With webhook workers, `peers` (webhook.Peers)
+    # carries unsubscribes to the worker that owns the subscriber's shard.
+    def __init__(self, bot, store, delay=NOTIFY_DELAY, max_wait=NOTIFY_MAX_WAIT, workers=FANOUT_WORKERS, peers=None):
+        self.bot = bot
+        self.store = store
+        self.peers = peers
+        self.delay = delay
+        self.max_wait = max_wait
+        self.workers = workers
+        self.pending = {}
+        self.queue = asyncio.Queue()
+        self.tasks = []
+        # Gone subscribers whose owning worker couldn't be reached; skipped until a restart
+        self.gone = set()
+        self.closing = False
+        self.counters = {"broadcasts": 0, "notified": 0, "pruned": 0, "failed": 0}
+
+    def added(self, owner_id, playlist_name, songs):
+        # songs: (song_id, file_id, file_name) of the songs just added. Playlists that
+        # were never shared cost one lookup here and nothing more.
+        if not songs or self.closing or not self.store.shares.tokens(owner_id, playlist_name):
+            return
+        key = (owner_id, playlist_name)
+        now = time.monotonic()
+        update = self.pending.get(key)
+        if update is None:
+            update = self.pending[key] = PendingUpdate(now)
+        for song_id, file_id, file_name in songs:
+            update.songs.setdefault(song_id, Song(file_id, file_name))
+        if update.timer is not None:
+            update.timer.cancel()
+        delay = max(0.0, min(self.delay, update.started + self.max_wait - now))
+        update.timer = asyncio.create_task(self._fan_out_later(key, update, delay))
+
+    async def _fan_out_later(self, key, update, delay):
+        await asyncio.sleep(delay)
+        update.timer = None
+        if self.pending.get(key) is update:
+            del self.pending[key]
+        self._fan_out(key, update)
+
+    def _fan_out(self, key, update):
+        owner_id, playlist_name = key
+        if self.store.songs(owner_id, playlist_name) is None:
+            return
+        # A user subscribed through several links of the playlist is told once
+        recipients = {}
+        for token in self.store.shares.tokens(owner_id, playlist_name):
+            for user_id, chat_id in self.store.subscribers(token).items():
+                if user_id != owner_id and user_id not in self.gone:
+                    recipients.setdefault(user_id, (chat_id, token))
+        if not recipients:
+            return
+        songs = list(update.songs.values())
+        for user_id, (chat_id, token) in recipients.items():
+            self.queue.put_nowait((user_id, chat_id, token, playlist_name, songs))
+        self.counters["broadcasts"] += 1
+        while len(self.tasks) < self.workers:
+            self.tasks.append(asyncio.create_task(self._work()))
+
+    async def _work(self):
+        while True:
+            user_id, chat_id, token, playlist_name, songs = await self.queue.get()
+            try:
+                await self._notify(user_id, chat_id, token, playlist_name, songs)
+            except Exception as e:
+                self.counters["failed"] += 1
+                logging.error(f"Could not notify subscriber {user_id} of {playlist_name}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _notify(self, user_id, chat_id, token, playlist_name, songs):
+        count = len(songs)
+        text = f"🔔 <b>{html.escape(playlist_name)}</b> has {count} new song{'' if count == 1 else 's'}"
+        text += "." if count <= NOTIFY_SONGS else f", here are the first {NOTIFY_SONGS}."
+        with lane(BULK):
+            try:
+                await self.bot.send_message(chat_id, text, reply_markup=notice_keyboard(token))
+            except TelegramForbiddenError:
+                await self._prune(user_id, token)
+                return
+            except TelegramBadRequest as e:
+                if "chat not found" not in e.message.lower():
+                    raise
+                await self._prune(user_id, token)
+                return
+        await deliver_songs(self.bot, chat_id, songs[:NOTIFY_SONGS])
+        self.counters["notified"] += 1
+
+    async def _prune(self, user_id, token):
+        self.counters["pruned"] += 1
+        try:
+            self.store.unsubscribe(user_id, token)
+            return
+        except RuntimeError:
+            pass
+        # Their shard belongs to another worker, which journals the unsubscribe
+        message = {"op": "unsubscribe", "user": user_id, "token": token}
+        if self.peers is None or not await self.peers.send(self.peers.owner(user_id), message):
+            self.gone.add(user_id)
+
+    async def forget(self, tokens):
+        # The share links of a deleted playlist: their subscription records go too, in
+        # this worker's shards and (through the peers) in everyone else's
+        for token in tokens:
+            self.store.drop_subscribers(token)
+            if self.peers is not None:
+                await self.peers.send_all({"op": "drop_subscribers", "token": token})
+
+    async def peer_request(self, message):
+        # Another worker's change to the shards this worker owns
+        if message.get("op") == "unsubscribe":
+            self.store.unsubscribe(message["user"], message["token"])
+        elif message.get("op") == "drop_subscribers":
+            self.store.drop_subscribers(message["token"])
+
+    def stats(self):
+        return dict(self.counters, pending=len(self.pending), queued=self.queue.qsize())
+
+    async def shutdown(self):
+        # Unsent notifications are dropped: the songs are in the playlist either way
+        self.closing = True
+        for update in self.pending.values():
+            if update.timer is not None:
+                update.timer.cancel()
+        self.pending.clear()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.peers is not None:
+            await self.peers.close()
+        logging.info(f"Broadcasts: {self.stats()}")
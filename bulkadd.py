@@ -0,0 +1,119 @@
+import asyncio
+import html
+import logging
+
+from aiogram.exceptions import TelegramAPIError
+
+from keyboards import done_keyboard
+
+# Quiet time after the last audio before a batch is saved. Album parts (one
+# media_group_id each) and forwarded bursts arrive as separate updates well within it.
+BATCH_DELAY = 1.0
+
+
+class Batch:
+    __slots__ = ("playlist_name", "chat_id", "state", "songs", "timer")
+
+    def __init__(self, playlist_name, chat_id, state):
+        self.playlist_name = playlist_name
+        self.chat_id = chat_id
+        # The user's FSMContext; the session totals live in its data
+        self.state = state
+        self.songs = []
+        self.timer = None
+
+
+class BulkAdd:
+    # Collects the audio of an open 🎵 Add Music session per user and saves it in
+    # batches: every audio restarts the user's timer, and when it runs out the whole
+    # batch is committed back to back (one journal write) and answered with a single
+    # summary. The session stays open until the user taps Done.
+    def __init__(self, bot, store, delay=BATCH_DELAY):
+        self.bot = bot
+        self.store = store
+        self.delay = delay
+        self.batches = {}
+        # Called with (user_id, playlist_name, songs) for the songs each batch added
+        self.listeners = []
+
+    def add(self, user_id, message, state, playlist_name):
+        batch = self.batches.get(user_id)
+        if batch is None or batch.playlist_name != playlist_name:
+            if batch is not None:
+                self._schedule(user_id, batch, 0)
+            batch = self.batches[user_id] = Batch(playlist_name, message.chat.id, state)
+        audio = message.audio
+        batch.songs.append((audio.file_unique_id, audio.file_id, audio.file_name or "Unknown.mp3"))
+        self._schedule(user_id, batch, self.delay)
+
+    def _schedule(self, user_id, batch, delay):
+        if batch.timer is not None:
+            batch.timer.cancel()
+        batch.timer = asyncio.create_task(self._save_later(user_id, batch, delay))
+
+    async def _save_later(self, user_id, batch, delay):
+        await asyncio.sleep(delay)
+        # From here on the batch is saved even if a newer timer or Done comes along
+        batch.timer = None
+        await self._save(user_id, batch)
+
+    async def flush(self, user_id):
+        # Saves the user's pending batch now (Done, a new playlist picked); the summary
+        # goes out before this returns
+        batch = self.batches.get(user_id)
+        if batch is not None and batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+            await self._save(user_id, batch)
+
+    async def _save(self, user_id, batch):
+        if self.batches.get(user_id) is batch:
+            del self.batches[user_id]
+        if not batch.songs:
+            return
+        playlist_name = batch.playlist_name
+        try:
+            if self.store.songs(user_id, playlist_name) is None:
+                await batch.state.clear()
+                text, keyboard = f"❌ Playlist <b>{html.escape(playlist_name)}</b> no longer exists, nothing was added.", None
+            else:
+                results = self.store.add_songs(user_id, playlist_name, batch.songs)
+                new = [song for song, added in zip(batch.songs, results) if added]
+                added = len(new)
+                for listener in self.listeners:
+                    listener(user_id, playlist_name, new)
+                playlist_id = self.store.playlist_id(user_id, playlist_name)
+                data = await batch.state.get_data()
+                total = None
+                if data.get("playlist_id") == playlist_id:
+                    total = data.get("added", 0) + added
+                    await batch.state.update_data(added=total)
+                text = self._summary(playlist_name, added, len(batch.songs) - added, total)
+                keyboard = done_keyboard(playlist_id)
+        except Exception as e:
+            logging.error(f"Error saving {len(batch.songs)} songs for {user_id}: {e}")
+            text, keyboard = "❌ Sorry, there was an error saving the songs.", None
+        try:
+            await self.bot.send_message(batch.chat_id, text, reply_markup=keyboard)
+        except TelegramAPIError as e:
+            logging.error(f"Could not send add summary to {user_id}: {e}")
+
+    @staticmethod
+    def _summary(playlist_name, added, duplicates, total):
+        name = html.escape(playlist_name)
+        if added == 1:
+            text = f"✅ Added 1 song to <b>{name}</b>."
+        elif added:
+            text = f"✅ Added {added} songs to <b>{name}</b>."
+        else:
+            text = f"ℹ️ Nothing new for <b>{name}</b>."
+        if duplicates:
+            text += f" {duplicates} already there."
+        if total is not None and total != added:
+            text += f"\n{total} added in this session."
+        return text + "\nSend more, or tap ✅ Done."
+
+    async def shutdown(self):
+        # Pending batches are saved rather than dropped
+        for user_id in list(self.batches):
+            await self.flush(user_id)
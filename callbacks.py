@@ -0,0 +1,61 @@
+import base64
+import binascii
+import struct
+
+# Playlist buttons carry a fixed 12-byte record instead of the playlist name:
+# format, action, interned playlist id, a 16-bit field (the low bits of the playlist
+# version, a move direction or a target playlist id) and an argument (song entry id
+# or page). Base64url makes it a constant 17-character callback_data however long the
+# name is. Bump CALLBACK_FORMAT when the layout or the meaning of a field changes;
+# format 1 song buttons carried positions rather than entry ids.
+CALLBACK_FORMAT = 2
+PREFIX = "~"
+_LAYOUT = struct.Struct(">BBIHI")
+ENCODED_LENGTH = len(PREFIX) + 16
+
+(
+    VIEW_PLAYLIST,
+    SONGS_PAGE,
+    SEND_ALL,
+    PLAY_SONG,
+    CONFIRM_DELETE_SONG,
+    DELETE_SONG,
+    SHARE_PLAYLIST,
+    CONFIRM_DELETE,
+    DELETE_PLAYLIST,
+    SELECT_PLAYLIST,
+    SONG_MENU,
+    MOVE_SONG,
+    MOVE_TARGETS,
+    MOVE_SONG_TO,
+    SHUFFLE_PLAYLIST,
+    FINISH_ADD,
+) = range(1, 17)
+
+# MOVE_SONG directions, carried in the 16-bit field
+MOVE_UP, MOVE_DOWN, MOVE_TOP, MOVE_BOTTOM = range(1, 5)
+
+# Name-carrying callback_data from before compact buttons existed
+LEGACY_PREFIXES = (
+    "view_playlist:", "send_all_music:", "play_song:", "confirm_delete_song:", "delete_song:",
+    "share_playlist:", "confirm_delete:", "delete_playlist:", "select_playlist:", "songs_page:",
+)
+
+
+def encode(action, playlist_id, version, arg=0):
+    raw = _LAYOUT.pack(CALLBACK_FORMAT, action, playlist_id, version & 0xFFFF, arg)
+    return PREFIX + base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode(data):
+    if data is None or len(data) != ENCODED_LENGTH or not data.startswith(PREFIX):
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(data[len(PREFIX):])
+    except (binascii.Error, ValueError):
+        return None
+    # Padding and stray characters are skipped, not rejected, so the size can still be off
+    if len(raw) != _LAYOUT.size or raw[0] != CALLBACK_FORMAT:
+        return None
+    _, action, playlist_id, version, arg = _LAYOUT.unpack(raw)
+    return action, playlist_id, version, arg
@@ -0,0 +1,76 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+# How many updates may be handled at the same time across all users
+MAX_CONCURRENT_UPDATES = 64
+
+
+class UserLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # Updates holding or waiting for this lock; the entry is dropped at zero
+        self.users = 0
+
+
+class UserOrderingMiddleware(BaseMiddleware):
+    # Outer update middleware: updates from one user are handled one at a time in the
+    # order they arrived (asyncio.Lock wakes waiters FIFO), different users run in
+    # parallel, and a semaphore bounds how many handlers run at once overall.
+    def __init__(self, max_concurrent=MAX_CONCURRENT_UPDATES):
+        self.locks = {}
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self.waiting = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            async with self.slots:
+                return await handler(event, data)
+
+        entry = self.locks.get(user.id)
+        if entry is None:
+            entry = self.locks[user.id] = UserLock()
+        entry.users += 1
+        self.waiting += 1
+        started = False
+        try:
+            async with entry.lock:
+                # Take the user's turn first so queued updates don't hold global slots
+                async with self.slots:
+                    self.waiting -= 1
+                    self.active += 1
+                    started = True
+                    # The FSM middleware read the state before we queued; re-read it now
+                    # that this user's earlier updates are done
+                    if "state" in data:
+                        data["raw_state"] = await data["state"].get_state()
+                    try:
+                        return await handler(event, data)
+                    finally:
+                        self.active -= 1
+        finally:
+            if not started:
+                self.waiting -= 1
+            entry.users -= 1
+            if not entry.users:
+                del self.locks[user.id]
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "users": len(self.locks),
+            "max_concurrent": self.max_concurrent,
+        }
@@ -0,0 +1,72 @@
+import html
+import logging
+
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import InputMediaAudio
+
+from ratelimit import BULK, lane
+
+# Telegram accepts 2-10 items per sendMediaGroup call
+MEDIA_GROUP_LIMIT = 10
+
+
+class DeliveryReport:
+    def __init__(self, total):
+        self.total = total
+        self.delivered = 0
+        self.failed = []
+
+
+def song_caption(index, song, numbered):
+    name = html.escape(song.file_name)
+    return f"{index}. <b>{name}</b>" if numbered else name
+
+
+async def _send_one(bot, chat_id, index, song, numbered, report):
+    try:
+        await bot.send_audio(chat_id, song.file_id, caption=song_caption(index, song, numbered))
+        report.delivered += 1
+    except TelegramAPIError as e:
+        logging.error(f"Telegram API Error sending audio: {e}")
+        report.failed.append(song)
+    except Exception as e:
+        logging.error(f"General error sending audio: {e}")
+        report.failed.append(song)
+
+
+async def deliver_songs(bot, chat_id, songs, numbered=False, start=0, on_progress=None):
+    # Sends songs[start:] as audio albums of up to MEDIA_GROUP_LIMIT items. If an album
+    # is rejected its songs are retried one by one, so one bad file never stops the rest.
+    # on_progress(next_index, report) is awaited after every album so callers can save a cursor.
+    # Pacing and flood-limit retries are left to the session's RateLimiter (bulk lane).
+    with lane(BULK):
+        return await _deliver(bot, chat_id, songs, numbered, start, on_progress)
+
+
+async def _deliver(bot, chat_id, songs, numbered, start, on_progress):
+    report = DeliveryReport(len(songs) - start)
+    for offset in range(start, len(songs), MEDIA_GROUP_LIMIT):
+        chunk = list(enumerate(songs[offset:offset + MEDIA_GROUP_LIMIT], start=offset + 1))
+        await _deliver_chunk(bot, chat_id, chunk, numbered, report)
+        if on_progress is not None:
+            await on_progress(offset + len(chunk), report)
+    return report
+
+
+async def _deliver_chunk(bot, chat_id, chunk, numbered, report):
+    if len(chunk) == 1:
+        index, song = chunk[0]
+        await _send_one(bot, chat_id, index, song, numbered, report)
+        return
+
+    media = [
+        InputMediaAudio(media=song.file_id, caption=song_caption(index, song, numbered))
+        for index, song in chunk
+    ]
+    try:
+        await bot.send_media_group(chat_id, media)
+        report.delivered += len(chunk)
+    except Exception as e:
+        logging.error(f"Error sending album to chat {chat_id}, retrying songs one by one: {e}")
+        for index, song in chunk:
+            await _send_one(bot, chat_id, index, song, numbered, report)
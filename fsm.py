@@ -0,0 +1,56 @@
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import DEFAULT_DESTINY, BaseStorage, StateType, StorageKey
+
+# A flow nobody touches for this long (e.g. "Add Music" tapped, no audio sent) is dropped
+FSM_TTL = 24 * 60 * 60
+
+
+class StoreStorage(BaseStorage):
+    # aiogram FSM storage kept in the user's storage shard: each change is a journal
+    # record next to the user's playlists, so a half-finished flow survives a restart.
+    # Entries carry an expiry that every change pushes forward; expired ones read as
+    # empty and are left out of the next record file. Reads never create entries and
+    # writes that change nothing are skipped, so users without a flow cost nothing.
+    def __init__(self, store, ttl=FSM_TTL):
+        self.store = store
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(key: StorageKey):
+        # The bot and user are implied by the store and the shard; keep the rest short
+        parts = [str(key.chat_id)]
+        if key.thread_id is not None:
+            parts.append(str(key.thread_id))
+        if key.destiny != DEFAULT_DESTINY:
+            parts.append(key.destiny)
+        return ":".join(parts)
+
+    def _read(self, key: StorageKey):
+        entry = self.store.fsm_entry(str(key.user_id), self._key(key))
+        return (None, {}) if entry is None else (entry[0], entry[1])
+
+    def _write(self, key: StorageKey, state, data):
+        if (state, data) == self._read(key):
+            return
+        expires = time.time() + self.ttl if state is not None or data else None
+        self.store.set_fsm(str(key.user_id), self._key(key), state, data, expires)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        self._write(key, state, self._read(key)[1])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._read(key)[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._write(key, self._read(key)[0], dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict(self._read(key)[1])
+
+    async def close(self) -> None:
+        # The store is flushed and closed by the bot's shutdown
+        pass
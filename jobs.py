@@ -0,0 +1,189 @@
+import asyncio
+import html
+import logging
+import time
+import uuid
+from collections import deque
+
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from delivery import deliver_songs
+
+# How many sends one user can have running at once; the rest wait in their queue
+MAX_JOBS_PER_USER = 2
+
+# Progress edits are throttled to one per this many seconds (the last one always goes out)
+PROGRESS_EDIT_INTERVAL = 3.0
+
+
+class SendJob:
+    def __init__(self, record):
+        self.id = record["id"]
+        self.user_id = record["user"]
+        self.chat_id = record["chat"]
+        self.owner_id = record["owner"]
+        self.playlist_name = record["playlist"]
+        self.numbered = record.get("numbered", False)
+        self.cursor = record.get("cursor", 0)
+        self.delivered = record.get("delivered", 0)
+        self.failed = record.get("failed", 0)
+        self.message_id = record.get("message")
+        self.cancelled = False
+        self.last_edit = 0.0
+
+    def to_record(self):
+        return {
+            "id": self.id,
+            "user": self.user_id,
+            "chat": self.chat_id,
+            "owner": self.owner_id,
+            "playlist": self.playlist_name,
+            "numbered": self.numbered,
+            "cursor": self.cursor,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "message": self.message_id,
+        }
+
+
+def cancel_keyboard(job_id):
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="⏹ Cancel", callback_data=f"cancel_job:{job_id}")
+    ]])
+
+
+class JobManager:
+    # Runs playlist sends as background jobs: per-user FIFO queues, at most
+    # max_per_user running per user, one progress message edited in place, and a
+    # cursor journaled after every album so a restart resumes where it stopped.
+    def __init__(self, bot, store, max_per_user=MAX_JOBS_PER_USER):
+        self.bot = bot
+        self.store = store
+        self.max_per_user = max_per_user
+        self.queued = {}
+        self.running = {}
+        self.jobs = {}
+        self.closing = False
+
+    async def submit(self, user_id, chat_id, owner_id, playlist_name, numbered=False):
+        job = SendJob({
+            "id": uuid.uuid4().hex[:12],
+            "user": user_id,
+            "chat": chat_id,
+            "owner": owner_id,
+            "playlist": playlist_name,
+            "numbered": numbered,
+        })
+        message = await self.bot.send_message(
+            chat_id, self._progress_text(job, "⏳ Queued"), reply_markup=cancel_keyboard(job.id)
+        )
+        job.message_id = message.message_id
+        self.store.save_job(job.to_record())
+        self._enqueue(job)
+        return job
+
+    def resume(self):
+        # Re-queue sends that were interrupted by a restart
+        for record in self.store.send_jobs():
+            self._enqueue(SendJob(record))
+        if self.jobs:
+            logging.info(f"Resumed {len(self.jobs)} interrupted send jobs")
+
+    def _enqueue(self, job):
+        self.jobs[job.id] = job
+        self.queued.setdefault(job.user_id, deque()).append(job)
+        self._pump(job.user_id)
+
+    def _pump(self, user_id):
+        running = self.running.setdefault(user_id, {})
+        queue = self.queued.get(user_id)
+        while queue and len(running) < self.max_per_user and not self.closing:
+            job = queue.popleft()
+            task = asyncio.create_task(self._run(job))
+            running[job.id] = task
+            task.add_done_callback(lambda _, job=job: self._finished(job))
+        if not queue:
+            self.queued.pop(user_id, None)
+        if not running:
+            self.running.pop(user_id, None)
+
+    def _finished(self, job):
+        self.running.get(job.user_id, {}).pop(job.id, None)
+        self._pump(job.user_id)
+
+    async def cancel(self, user_id, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.user_id != user_id:
+            return False
+        job.cancelled = True
+        task = self.running.get(user_id, {}).get(job_id)
+        if task is not None:
+            task.cancel()
+        else:
+            queue = self.queued.get(user_id)
+            if queue and job in queue:
+                queue.remove(job)
+            await self._close(job, "⏹ Cancelled")
+        return True
+
+    async def _run(self, job):
+        songs = self.store.songs(job.owner_id, job.playlist_name)
+        if songs is None:
+            await self._close(job, "❌ Playlist is no longer available")
+            return
+
+        async def on_progress(cursor, report):
+            job.cursor = cursor
+            job.delivered = delivered_before + report.delivered
+            job.failed = failed_before + len(report.failed)
+            self.store.save_job(job.to_record())
+            if time.monotonic() - job.last_edit >= PROGRESS_EDIT_INTERVAL and cursor < len(songs):
+                await self._edit(job, f"🎧 Sending {cursor}/{len(songs)}", cancel_keyboard(job.id))
+
+        delivered_before, failed_before = job.delivered, job.failed
+        try:
+            await self._edit(job, f"🎧 Sending {job.cursor}/{len(songs)}", cancel_keyboard(job.id))
+            await deliver_songs(self.bot, job.chat_id, songs, job.numbered, start=job.cursor, on_progress=on_progress)
+        except asyncio.CancelledError:
+            # A user cancel ends the job; a shutdown leaves it journaled to resume later
+            if job.cancelled:
+                await self._close(job, f"⏹ Cancelled after {job.cursor}/{len(songs)}")
+            raise
+        except Exception as e:
+            logging.error(f"Send job {job.id} failed: {e}")
+            await self._close(job, f"❌ Stopped after {job.cursor}/{len(songs)} because of an error")
+            return
+
+        if job.failed:
+            await self._close(job, f"⚠️ Sent {job.delivered} of {len(songs)} songs. {job.failed} could not be sent.")
+        else:
+            await self._close(job, f"✅ Sent all {len(songs)} songs.")
+
+    async def _close(self, job, status):
+        self.jobs.pop(job.id, None)
+        self.store.finish_job(job.user_id, job.id)
+        await self._edit(job, status, None)
+
+    def _progress_text(self, job, status):
+        return f"Playlist <b>{html.escape(job.playlist_name)}</b>: {status}"
+
+    async def _edit(self, job, status, reply_markup):
+        job.last_edit = time.monotonic()
+        try:
+            await self.bot.edit_message_text(
+                self._progress_text(job, status),
+                chat_id=job.chat_id,
+                message_id=job.message_id,
+                reply_markup=reply_markup,
+            )
+        except TelegramAPIError as e:
+            logging.error(f"Could not update progress of send job {job.id}: {e}")
+
+    async def shutdown(self):
+        # Stop without finishing: cursors stay journaled and resume() picks them up
+        self.closing = True
+        tasks = [task for running in self.running.values() for task in running.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
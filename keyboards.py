@@ -0,0 +1,165 @@
+import html
+from collections import OrderedDict
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from callbacks import (
+    CONFIRM_DELETE, CONFIRM_DELETE_SONG, FINISH_ADD, MOVE_BOTTOM, MOVE_DOWN, MOVE_SONG, MOVE_SONG_TO, MOVE_TARGETS, MOVE_TOP,
+    MOVE_UP, PLAY_SONG, SELECT_PLAYLIST, SEND_ALL, SHARE_PLAYLIST, SHUFFLE_PLAYLIST, SONG_MENU, SONGS_PAGE,
+    VIEW_PLAYLIST, encode,
+)
+
+SONGS_PER_PAGE = 10
+PLAYLISTS_PER_PAGE = 8
+
+# Playlist list views: "view" is My Playlists, "select" is the Add Music picker
+LIST_MODES = ("view", "select")
+
+
+class PageCache:
+    # Rendered (text, markup) pages keyed by (user, scope, version, page), where scope is
+    # a playlist name or ("playlists", mode). Entries are dropped when their scope changes.
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.pages = OrderedDict()
+        self.by_scope = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        page = self.pages.get(key)
+        if page is not None:
+            self.pages.move_to_end(key)
+            self.hits += 1
+            return page
+        self.misses += 1
+        page = render()
+        self.pages[key] = page
+        self.by_scope.setdefault(key[:2], set()).add(key)
+        if len(self.pages) > self.max_entries:
+            old_key, _ = self.pages.popitem(last=False)
+            self._unindex(old_key)
+        return page
+
+    def _unindex(self, key):
+        keys = self.by_scope.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_scope[key[:2]]
+
+    def drop(self, user_id, playlist_name):
+        # Store listener: a playlist changed, or (playlist_name=None) the playlist list did
+        if playlist_name is None:
+            scopes = [(user_id, ("playlists", mode)) for mode in LIST_MODES]
+        else:
+            scopes = [(user_id, playlist_name)]
+        for scope in scopes:
+            for key in self.by_scope.pop(scope, ()):
+                self.pages.pop(key, None)
+
+
+def clamp_page(page, count, per_page):
+    pages = max(1, -(-count // per_page))
+    return min(max(page, 0), pages - 1), pages
+
+
+def nav_row(page, pages, page_callback):
+    if pages <= 1:
+        return []
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton(text="◀️", callback_data=page_callback(page - 1)))
+    row.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="noop"))
+    if page < pages - 1:
+        row.append(InlineKeyboardButton(text="▶️", callback_data=page_callback(page + 1)))
+    return [row]
+
+
+def render_playlists_page(playlists, mode, page):
+    # playlists is a list of (playlist_name, playlist_id) pairs
+    page, pages = clamp_page(page, len(playlists), PLAYLISTS_PER_PAGE)
+    start = page * PLAYLISTS_PER_PAGE
+
+    buttons = []
+    for playlist_name, playlist_id in playlists[start:start + PLAYLISTS_PER_PAGE]:
+        if mode == "select":
+            buttons.append([InlineKeyboardButton(text=playlist_name, callback_data=encode(SELECT_PLAYLIST, playlist_id, 0))])
+        else:
+            buttons.append([
+                InlineKeyboardButton(text=playlist_name, callback_data=encode(VIEW_PLAYLIST, playlist_id, 0)),
+                InlineKeyboardButton(text="🔗 Share", callback_data=encode(SHARE_PLAYLIST, playlist_id, 0)),
+                InlineKeyboardButton(text="❌ Delete Playlist", callback_data=encode(CONFIRM_DELETE, playlist_id, 0)),
+            ])
+    buttons += nav_row(page, pages, lambda target: f"playlists_page:{mode}:{target}")
+
+    text = "Select a playlist to add music to:" if mode == "select" else "Your playlists:"
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def render_songs_page(playlist_name, playlist_id, version, songs, page):
+    page, pages = clamp_page(page, len(songs), SONGS_PER_PAGE)
+    start = page * SONGS_PER_PAGE
+
+    buttons = [[
+        InlineKeyboardButton(text="🎧 Send All Music", callback_data=encode(SEND_ALL, playlist_id, version)),
+        InlineKeyboardButton(text="🔀 Shuffle", callback_data=encode(SHUFFLE_PLAYLIST, playlist_id, version, page)),
+    ]]
+    # Song buttons carry the song's entry id, so they stay right however the playlist changes
+    for index, (entry, song) in enumerate(songs.page(start, start + SONGS_PER_PAGE), start=start + 1):
+        buttons.append([
+            InlineKeyboardButton(text=f"🎵 {index}. {song.file_name}", callback_data=encode(PLAY_SONG, playlist_id, 0, entry)),
+            InlineKeyboardButton(text="↕️", callback_data=encode(SONG_MENU, playlist_id, 0, entry)),
+            InlineKeyboardButton(text="❌", callback_data=encode(CONFIRM_DELETE_SONG, playlist_id, 0, entry)),
+        ])
+    buttons += nav_row(page, pages, lambda target: encode(SONGS_PAGE, playlist_id, version, target))
+    buttons.append([InlineKeyboardButton(text="⬅️ Back", callback_data="playlists_page:view:0")])
+
+    return f"Songs in <b>{html.escape(playlist_name)}</b>:", InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def done_keyboard(playlist_id):
+    # Closes a 🎵 Add Music session
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ Done", callback_data=encode(FINISH_ADD, playlist_id, 0))
+    ]])
+
+
+def render_song_menu(playlist_name, playlist_id, entry, song, position, count):
+    # position is 0-based; moving past either end is not offered
+    move = lambda direction: encode(MOVE_SONG, playlist_id, direction, entry)
+    buttons = []
+    if position > 0:
+        buttons.append([
+            InlineKeyboardButton(text="⏫ Top", callback_data=move(MOVE_TOP)),
+            InlineKeyboardButton(text="⬆️ Up", callback_data=move(MOVE_UP)),
+        ])
+    if position < count - 1:
+        buttons.append([
+            InlineKeyboardButton(text="⬇️ Down", callback_data=move(MOVE_DOWN)),
+            InlineKeyboardButton(text="⏬ Bottom", callback_data=move(MOVE_BOTTOM)),
+        ])
+    buttons.append([InlineKeyboardButton(text="📂 Move to another playlist", callback_data=encode(MOVE_TARGETS, playlist_id, 0, entry))])
+    buttons.append([InlineKeyboardButton(
+        text="⬅️ Back", callback_data=encode(SONGS_PAGE, playlist_id, 0, position // SONGS_PER_PAGE)
+    )])
+
+    text = (
+        f"🎵 <b>{html.escape(song.file_name)}</b>\n"
+        f"Position {position + 1} of {count} in <b>{html.escape(playlist_name)}</b>"
+    )
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def render_move_targets(playlist_name, playlist_id, entry, song, targets):
+    # targets is a list of (playlist_name, playlist_id) pairs; the id rides in the
+    # 16-bit field, so the (very rare) playlists past that are left out
+    buttons = [
+        [InlineKeyboardButton(text=target_name, callback_data=encode(MOVE_SONG_TO, playlist_id, target_id, entry))]
+        for target_name, target_id in targets
+        if target_id <= 0xFFFF
+    ]
+    buttons.append([InlineKeyboardButton(text="⬅️ Back", callback_data=encode(SONG_MENU, playlist_id, 0, entry))])
+
+    text = f"Move <b>{html.escape(song.file_name)}</b> from <b>{html.escape(playlist_name)}</b> to:"
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
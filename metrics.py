@@ -0,0 +1,205 @@
+# In-process metrics in the Prometheus text format, served on a local /metrics
+# endpoint. Handlers and Bot API calls are measured by middlewares; everything the
+# other components already count (storage, rate limiter, jobs, ...) is read from
+# their stats() when the endpoint is scraped, so it costs nothing in between.
+import contextvars
+import logging
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject
+from aiohttp import web
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+PREFIX = "playlist_bot_"
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = (f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    # Bucket counts are kept per bucket and summed up only when rendered
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket (+Inf last), sum]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labels + ("le",)
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(names, labels + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # Called on every scrape; each returns (name, type, help, [(labels dict, value)])
+        self.collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(PREFIX + name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(PREFIX + name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                logging.error(f"Metrics collector {collector.__name__} failed: {e}")
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {PREFIX}{name} {help}")
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{PREFIX}{name}{_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class Span:
+    __slots__ = ("handler",)
+
+    def __init__(self, handler):
+        self.handler = handler
+
+
+# The update being handled; routing tables name the handler they picked
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def name_handler(callback):
+    span = current_span.get()
+    if span is not None:
+        span.handler = callback.__name__
+
+
+class HandlerMetrics(BaseMiddleware):
+    # Inner middleware on the router's observers: one latency sample per handled
+    # update, labelled with the handler that ran (the one a routing table picked,
+    # not route_text/route_callback), and an error count by exception type
+    def __init__(self, registry):
+        self.latency = registry.histogram(
+            "handler_seconds", "Time spent in update handlers", ("handler",)
+        )
+        self.errors = registry.counter(
+            "handler_errors_total", "Exceptions raised by update handlers", ("handler", "error")
+        )
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        span = Span(data["handler"].callback.__name__)
+        token = current_span.set(span)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            self.errors.inc(span.handler, type(e).__name__)
+            raise
+        finally:
+            self.latency.observe(time.perf_counter() - started, span.handler)
+            current_span.reset(token)
+
+
+class ApiMetrics(BaseRequestMiddleware):
+    # Session middleware, registered after the RateLimiter so it times the request
+    # itself (each flood-limit retry is a call of its own); waits are in the limiter's stats
+    def __init__(self, registry):
+        self.latency = registry.histogram(
+            "api_call_seconds", "Bot API request latency", ("method",)
+        )
+        self.errors = registry.counter(
+            "api_errors_total", "Failed Bot API requests", ("method", "error")
+        )
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            self.errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            self.latency.observe(time.perf_counter() - started, name)
+
+
+def stats_families(prefix, kind, help, stats, keys):
+    # One family per key of a stats() dict, e.g. storage_flushes_total
+    suffix = "_total" if kind == "counter" else ""
+    for key in keys:
+        if key in stats:
+            yield f"{prefix}_{key}{suffix}", kind, f"{help}: {key.replace('_', ' ')}", [({}, stats[key])]
+
+
+async def serve_metrics(registry, host, port):
+    # GET /metrics on a local port; returns the runner to clean up on shutdown
+    async def metrics(request):
+        return web.Response(body=registry.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,191 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendAudio, SendDocument, SendMediaGroup
+
+# Lanes in priority order: interactive replies are always served before bulk sends
+INTERACTIVE = 0
+BULK = 1
+LANE_NAMES = ("interactive", "bulk")
+
+# Bot API flood limits: about 30 messages a second overall, about one a second
+# per private chat and 20 a minute per group
+GLOBAL_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+CHAT_BURST = 3
+
+# Methods that go to the bulk lane unless the caller chose a lane explicitly
+BULK_METHODS = (SendAudio, SendDocument, SendMediaGroup)
+
+
+def cost(method):
+    # Telegram counts every message of an album against the flood limits
+    if isinstance(method, SendMediaGroup):
+        return len(method.media)
+    return 1
+
+
+MAX_RETRIES = 5
+
+current_lane = contextvars.ContextVar("current_lane", default=None)
+
+
+@contextmanager
+def lane(value):
+    token = current_lane.set(value)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+
+class TokenBucket:
+    # Token bucket whose waiters queue per lane; a freed token always goes to the
+    # highest-priority waiter, so bulk sends never hold up interactive replies.
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiters = (deque(), deque())
+        self._timer = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds):
+        # Telegram told us to back off: no tokens until the penalty has passed
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def queued(self):
+        return len(self.waiters[INTERACTIVE]) + len(self.waiters[BULK])
+
+    def _affordable(self, tokens):
+        # A request larger than the bucket goes once it is full and leaves it in debt
+        return self.tokens >= min(tokens, self.capacity)
+
+    async def acquire(self, priority, tokens=1):
+        self._refill()
+        if not self.queued() and self._affordable(tokens):
+            self.tokens -= tokens
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[priority].append((future, tokens))
+        self._dispatch()
+        await future
+
+    def _wake(self):
+        self._timer = None
+        self._dispatch()
+
+    def _dispatch(self):
+        self._refill()
+        for waiters in self.waiters:
+            while waiters:
+                future, tokens = waiters[0]
+                if future.done():
+                    waiters.popleft()
+                    continue
+                if not self._affordable(tokens):
+                    # Lower lanes wait too, so a large interactive request isn't starved
+                    if self._timer is None:
+                        delay = (min(tokens, self.capacity) - self.tokens) / self.rate
+                        self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+                    return
+                waiters.popleft()
+                self.tokens -= tokens
+                future.set_result(None)
+
+
+class LaneStats:
+    def __init__(self):
+        self.requests = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait):
+        self.requests += 1
+        self.waited += wait
+        self.max_wait = max(self.max_wait, wait)
+
+
+class RateLimiter(BaseRequestMiddleware):
+    # Session middleware in front of every Bot API call: waits for a per-chat and a
+    # global token, then retries automatically when Telegram answers with retry_after.
+    # The global limit is per bot, so each of `workers` processes gets its share of it.
+    def __init__(self, workers=1):
+        rate = GLOBAL_RATE / workers
+        self.global_bucket = TokenBucket(rate, max(rate, 1))
+        self.chat_buckets = {}
+        self.lanes = (LaneStats(), LaneStats())
+        self.retry_after_hits = 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(GROUP_CHAT_RATE if is_group else PRIVATE_CHAT_RATE, CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune(self):
+        # Drop idle, full chat buckets so the table only holds recently active chats
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            bucket._refill()
+            if not bucket.queued() and bucket.tokens >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+
+    async def __call__(self, make_request, bot, method):
+        priority = current_lane.get()
+        if priority is None:
+            priority = BULK if isinstance(method, BULK_METHODS) else INTERACTIVE
+        chat_id = getattr(method, "chat_id", None)
+        tokens = cost(method)
+
+        if len(self.chat_buckets) > 10000:
+            self._prune()
+
+        for attempt in range(MAX_RETRIES + 1):
+            started = time.monotonic()
+            chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+            if chat_bucket is not None:
+                await chat_bucket.acquire(priority, tokens)
+            await self.global_bucket.acquire(priority, tokens)
+            self.lanes[priority].record(time.monotonic() - started)
+
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after_hits += 1
+                if attempt == MAX_RETRIES:
+                    raise
+                logging.warning(f"Flood limit on {type(method).__name__} (chat {chat_id}), retrying in {e.retry_after}s")
+                (chat_bucket or self.global_bucket).pause(e.retry_after)
+
+    def stats(self):
+        return {
+            "global_queue": self.global_bucket.queued(),
+            "chat_queue": sum(bucket.queued() for bucket in self.chat_buckets.values()),
+            "active_chats": len(self.chat_buckets),
+            "retry_after_hits": self.retry_after_hits,
+            "lanes": {
+                LANE_NAMES[priority]: {
+                    "queued": len(self.global_bucket.waiters[priority])
+                    + sum(len(bucket.waiters[priority]) for bucket in self.chat_buckets.values()),
+                    "requests": stats.requests,
+                    "avg_wait": stats.waited / stats.requests if stats.requests else 0.0,
+                    "max_wait": stats.max_wait,
+                }
+                for priority, stats in enumerate(self.lanes)
+            },
+        }
@@ -0,0 +1,105 @@
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.filters import BaseFilter
+from aiogram.types import CallbackQuery, Message
+
+from callbacks import LEGACY_PREFIXES, PREFIX, decode
+from metrics import name_handler
+
+
+class CallbackRoutes:
+    # One dispatch table for every callback button instead of a chain of startswith
+    # filters. Compact playlist buttons are routed by their action byte, everything
+    # else by the text before the first ":". Handlers receive the usual aiogram data
+    # (state, bot, ...) plus what the route parsed.
+    def __init__(self, store):
+        self.store = store
+        self.actions = {}
+        self.prefixes = {}
+        self.stale = None
+
+    def action(self, *codes):
+        def register(callback):
+            for code in codes:
+                self.actions[code] = CallableObject(callback)
+            return callback
+        return register
+
+    def prefix(self, name):
+        def register(callback):
+            self.prefixes[name] = CallableObject(callback)
+            return callback
+        return register
+
+    def stale_button(self, callback):
+        self.stale = CallableObject(callback)
+        return callback
+
+    async def dispatch(self, query: CallbackQuery, data):
+        payload = query.data or ""
+        decoded = decode(payload)
+        if decoded is not None:
+            handler = self.actions.get(decoded[0])
+            _, playlist_id, aux, arg = decoded
+            user_id = str(query.from_user.id)
+            playlist_name = self.store.playlist_name(user_id, playlist_id)
+            # Song buttons name a stable entry id, so only a deleted playlist makes a button stale
+            if handler is not None and playlist_name is not None:
+                name_handler(handler.callback)
+                return await handler.call(query, playlist_name=playlist_name, arg=arg, aux=aux, **data)
+            name_handler(self.stale.callback)
+            return await self.stale.call(query, decoded=decoded, **data)
+
+        name, _, rest = payload.partition(":")
+        handler = self.prefixes.get(name)
+        if handler is not None:
+            name_handler(handler.callback)
+            return await handler.call(query, payload=rest, **data)
+        if payload.startswith(PREFIX) or payload.startswith(LEGACY_PREFIXES):
+            name_handler(self.stale.callback)
+            return await self.stale.call(query, decoded=None, **data)
+        return UNHANDLED
+
+
+class TextRoutes:
+    # Reply-keyboard buttons resolved with one dict lookup, plus a short list of
+    # prefix routes tried only when no button text matched and no flow is waiting
+    # for the user's text.
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = []
+
+    def text(self, value):
+        def register(callback):
+            self.exact[value] = CallableObject(callback)
+            return callback
+        return register
+
+    def prefix(self, value):
+        def register(callback):
+            self.prefixes.append((value, CallableObject(callback)))
+            return callback
+        return register
+
+    def resolve(self, text, prefixes=True):
+        handler = self.exact.get(text)
+        if handler is not None or not prefixes:
+            return handler
+        for value, handler in self.prefixes:
+            if text.startswith(value):
+                return handler
+        return None
+
+
+class TextRoute(BaseFilter):
+    def __init__(self, routes):
+        self.routes = routes
+
+    async def __call__(self, message: Message, raw_state=None):
+        if not message.text:
+            return False
+        # Menu buttons preempt a flow; prefixes such as "playlist_" could be the text it asked for
+        handler = self.routes.resolve(message.text, prefixes=raw_state is None)
+        if handler is None:
+            return False
+        return {"text_handler": handler}
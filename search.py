@@ -0,0 +1,155 @@
+import os
+import re
+from bisect import bisect_left, insort
+from itertools import islice
+
+# Inline results per answer; Telegram accepts at most 50
+RESULTS_PER_PAGE = 50
+
+_WORD = re.compile(r"\w+")
+
+# A prefix completing to more words than this is matched by scanning instead
+MAX_MERGED_POSTINGS = 64
+# Up to this many matches are sorted; more are picked from a newest-first walk
+SORTED_MATCHES = 2048
+
+
+def tokenize(text):
+    return _WORD.findall(text.casefold())
+
+
+def song_tokens(file_name):
+    # The extension would match every song of that type, so it isn't indexed
+    return tuple(set(tokenize(os.path.splitext(file_name)[0])))
+
+
+class SongIndex:
+    # Inverted index over song file names: token -> song ids, plus a sorted vocabulary
+    # so the word being typed matches as a prefix. A song added twice is indexed once
+    # and counted; adds and removes update it in place. Songs indexed later rank
+    # first: on a fresh index that is the order they were built from, after that the
+    # songs added since.
+    __slots__ = ("postings", "vocabulary", "entries", "stamp")
+
+    def __init__(self):
+        self.postings = {}
+        self.vocabulary = []
+        # song_id -> (times added, add stamp, tokens), oldest first. Tuples of strings
+        # and ints drop out of the garbage collector's passes; lists would not.
+        self.entries = {}
+        self.stamp = 0
+
+    @classmethod
+    def build(cls, songs):
+        # From (song_id, file_name) pairs, sorting the vocabulary once at the end
+        index = cls()
+        for song_id, file_name in songs:
+            index.add(song_id, file_name, sort=False)
+        index.vocabulary.sort()
+        return index
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, song_id, file_name, sort=True):
+        entry = self.entries.get(song_id)
+        if entry is not None:
+            self.entries[song_id] = (entry[0] + 1,) + entry[1:]
+            return
+        self.stamp += 1
+        tokens = song_tokens(file_name)
+        self.entries[song_id] = (1, self.stamp, tokens)
+        for token in tokens:
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = set()
+                if sort:
+                    insort(self.vocabulary, token)
+                else:
+                    self.vocabulary.append(token)
+            posting.add(song_id)
+
+    def discard(self, song_id):
+        entry = self.entries.get(song_id)
+        if entry is None:
+            return
+        if entry[0] > 1:
+            self.entries[song_id] = (entry[0] - 1,) + entry[1:]
+            return
+        del self.entries[song_id]
+        for token in entry[2]:
+            posting = self.postings[token]
+            posting.discard(song_id)
+            if not posting:
+                del self.postings[token]
+                del self.vocabulary[bisect_left(self.vocabulary, token)]
+
+    def _completions(self, prefix):
+        vocabulary = self.vocabulary
+        for position in range(bisect_left(vocabulary, prefix), len(vocabulary)):
+            if not vocabulary[position].startswith(prefix):
+                break
+            yield self.postings[vocabulary[position]]
+
+    def _match(self, words):
+        # Song ids containing every word, the last one as a prefix. Sets are combined
+        # with C-level set operations; only a prefix that completes to very many
+        # words is checked song by song. None means every song.
+        if not words:
+            return None
+        exact = sorted((self.postings.get(word, ()) for word in words[:-1]), key=len)
+        if exact and not exact[0]:
+            return set()
+        prefix = words[-1]
+        completions = list(self._completions(prefix))
+        if len(completions) > MAX_MERGED_POSTINGS:
+            if not exact:
+                return {song_id for song_id, entry in self.entries.items() if _completes(entry[2], prefix)}
+            matches = exact[0].intersection(*exact[1:])
+            return {song_id for song_id in matches if _completes(self.entries[song_id][2], prefix)}
+        if not completions:
+            return set()
+        if not exact and len(completions) == 1:
+            return completions[0]
+        matches = set().union(*completions)
+        matches.intersection_update(*exact)
+        return matches
+
+    def search(self, words, limit, within=None):
+        # Up to limit song ids containing every word (the last one as a prefix),
+        # newest first, optionally only among the ids in the set within
+        matches = self._match(words)
+        if within is not None:
+            matches = within if matches is None else matches & within
+        entries = self.entries
+        if matches is not None and len(matches) <= SORTED_MATCHES:
+            found = (song_id for song_id in matches if song_id in entries)
+            return sorted(found, key=lambda song_id: entries[song_id][1], reverse=True)[:limit]
+        # Many matches: walking all songs newest first meets enough of them soon
+        ordered = reversed(entries)
+        if matches is not None:
+            ordered = (song_id for song_id in ordered if song_id in matches)
+        return list(islice(ordered, limit))
+
+
+def _completes(tokens, prefix):
+    return any(token.startswith(prefix) for token in tokens)
+
+
+async def search_library(store, user_id, text, offset=0, limit=RESULTS_PER_PAGE):
+    # Songs in the user's own playlists, then in playlists shared with them, as
+    # (song_id, Song) pairs for one page, and the offset of the next page (or None)
+    words = tokenize(text)
+    want = offset + limit + 1
+    found = []
+    seen = set()
+    sources = [(user_id, None)] + [shared for shared in store.shares.received(user_id) if shared[0] != user_id]
+    for owner_id, playlist_name in sources:
+        for song_id, song in await store.search(owner_id, words, want, playlist_name):
+            if song_id not in seen:
+                seen.add(song_id)
+                found.append((song_id, song))
+        if len(found) >= want:
+            break
+    page = found[offset:offset + limit]
+    return page, (offset + limit if len(found) > offset + limit else None)
@@ -0,0 +1,2259 @@
+import asyncio
+import glob
+import hashlib
+import json
+import logging
+import mmap
+import os
+import random
+import re
+import struct
+import sys
+import time
+import uuid
+import zlib
+from array import array
+from collections.abc import Mapping, Sequence
+from collections import OrderedDict, deque
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
+
+from search import SongIndex
+
+# Bump this when the snapshot layout changes. Format 1 was one JSON document per
+# shard; format 2 is an indexed record file read on demand (see RecordFile); format 3
+# stores each song once in a per-shard catalog and playlists as catalog ids.
+SNAPSHOT_FORMAT = 3
+
+# Ops that change what a user's playlist views show
+PLAYLIST_OPS = {
+    "playlist_create", "playlist_delete", "song_append", "song_remove", "song_move", "song_transfer", "playlist_shuffle",
+}
+LIBRARY_OPS = {"playlist_create", "playlist_delete"}
+
+
+# Per-user interning table: playlist name <-> short numeric id, plus the seq of the
+# last change to each playlist (its version) and to the playlist list itself.
+def _playlist_ids(data, user_id):
+    return data.setdefault("playlist_ids", {}).setdefault(
+        user_id, {"next": 1, "version": 0, "names": {}, "ids": {}}
+    )
+
+
+def _intern(data, user_id, playlist_name, seq):
+    ids = _playlist_ids(data, user_id)
+    if playlist_name not in ids["names"]:
+        ids["names"][playlist_name] = [ids["next"], seq]
+        ids["ids"][str(ids["next"])] = playlist_name
+        ids["next"] += 1
+
+
+def _touch(data, user_id, playlist_name, seq):
+    entry = data.get("playlist_ids", {}).get(user_id, {}).get("names", {}).get(playlist_name)
+    if entry is not None:
+        entry[1] = seq
+
+
+class Song:
+    # Catalog entry for one track (keyed by Telegram's file_unique_id), shared by every
+    # playlist in the shard that holds it and dropped when the last one lets go
+    __slots__ = ("file_id", "file_name", "refs")
+
+    def __init__(self, file_id, file_name, refs=0):
+        self.file_id = file_id
+        self.file_name = sys.intern(file_name)
+        self.refs = refs
+
+    def record(self):
+        return [self.file_id, self.file_name, self.refs]
+
+
+class Playlist:
+    # A playlist's songs in order, each under an entry id that is never reused, so
+    # buttons can point at a song rather than a position. Removing leaves a hole that
+    # is squeezed out once holes outnumber songs: delete by id is amortized O(1) and
+    # positional reads skip the few holes left. Reordering rebuilds the order, O(n).
+    __slots__ = ("songs", "entries", "slots", "next", "holes")
+
+    def __init__(self, songs=(), entries=None, next_entry=None):
+        self.songs = list(songs)
+        self.entries = list(entries) if entries is not None else list(range(1, len(self.songs) + 1))
+        self.slots = {entry: slot for slot, entry in enumerate(self.entries)}
+        self.next = next_entry if next_entry is not None else len(self.songs) + 1
+        self.holes = 0
+
+    @classmethod
+    def from_record(cls, value):
+        # Playlists written before entry ids are a bare list of song ids
+        if isinstance(value, list):
+            return cls(value)
+        return cls(value["songs"], value["entries"], value["next"])
+
+    def record(self):
+        self._squeeze()
+        return {"songs": self.songs, "entries": self.entries, "next": self.next}
+
+    def __len__(self):
+        return len(self.songs) - self.holes
+
+    def __iter__(self):
+        # Song ids in order
+        return (song_id for song_id in self.songs if song_id is not None)
+
+    def items(self, start=0, stop=None):
+        # (entry id, song id) pairs for positions start..stop
+        if not self.holes:
+            return list(zip(self.entries[start:stop], self.songs[start:stop]))
+        live = ((entry, song_id) for entry, song_id in zip(self.entries, self.songs) if entry is not None)
+        return list(islice(live, start, stop))
+
+    def song(self, entry):
+        slot = self.slots.get(entry)
+        return None if slot is None else self.songs[slot]
+
+    def append(self, song_id):
+        entry = self.next
+        self.next += 1
+        self.slots[entry] = len(self.songs)
+        self.songs.append(song_id)
+        self.entries.append(entry)
+        return entry
+
+    def remove(self, entry):
+        slot = self.slots.pop(entry, None)
+        if slot is None:
+            return None
+        song_id = self.songs[slot]
+        self.songs[slot] = self.entries[slot] = None
+        self.holes += 1
+        if self.holes > max(16, len(self)):
+            self._squeeze()
+        return song_id
+
+    def move(self, entry, position):
+        slot = self.slots.get(entry)
+        if slot is None:
+            return False
+        self._squeeze()
+        slot = self.slots[entry]
+        song_id = self.songs.pop(slot)
+        self.entries.pop(slot)
+        position = min(max(position, 0), len(self.songs))
+        self.songs.insert(position, song_id)
+        self.entries.insert(position, entry)
+        self._index(min(slot, position))
+        return True
+
+    def shuffle(self, rng):
+        self._squeeze()
+        pairs = list(zip(self.entries, self.songs))
+        rng.shuffle(pairs)
+        self.entries = [entry for entry, _ in pairs]
+        self.songs = [song_id for _, song_id in pairs]
+        self._index(0)
+
+    def _squeeze(self):
+        if self.holes:
+            self.songs = [song_id for song_id in self.songs if song_id is not None]
+            self.entries = [entry for entry in self.entries if entry is not None]
+            self.holes = 0
+            self._index(0)
+
+    def _index(self, start):
+        for slot in range(start, len(self.entries)):
+            self.slots[self.entries[slot]] = slot
+
+
+def legacy_song_id(file_id):
+    # Songs saved before the catalog only have a file_id; "~" never starts a file_unique_id
+    return "~" + hashlib.blake2b(file_id.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def song_ref(op):
+    # (catalog id, file_id, file_name) of a song_append, whichever format it was journaled in
+    song = op["song"]
+    if isinstance(song, dict):
+        return legacy_song_id(song["file_id"]), song["file_id"], song["file_name"]
+    return song, op["file_id"], op["file_name"]
+
+
+def _release(data, song_id):
+    song = data.get("songs", {}).get(song_id)
+    if song is not None:
+        song.refs -= 1
+        if song.refs <= 0:
+            del data["songs"][song_id]
+    return song
+
+
+def _entry(playlist, op):
+    # Song removals name an entry id; ones journaled before entry ids name a position
+    if "entry" in op:
+        return op["entry"]
+    items = playlist.items(op["index"], op["index"] + 1) if op["index"] >= 0 else []
+    return items[0][0] if items else None
+
+
+# Opened share links remembered per user
+MAX_RECEIVED_SHARES = 50
+
+
+def _forget_share(data, token, entry):
+    ids = data.get("playlist_ids", {}).get(entry["user_id"])
+    tokens = ids and ids.get("shares", {}).get(entry["playlist_name"])
+    if tokens and token in tokens:
+        tokens.remove(token)
+        if not tokens:
+            del ids["shares"][entry["playlist_name"]]
+
+
+# Every mutation is journaled as one small record and applied with apply_op,
+# both live and when replaying the journal at startup.
+def apply_op(data, op):
+    kind = op["op"]
+    user_id = op.get("user")
+
+    if kind == "user":
+        data.setdefault(user_id, {})
+    elif kind == "playlist_create":
+        data.setdefault(user_id, {})[op["playlist"]] = Playlist()
+        _intern(data, user_id, op["playlist"], op["seq"])
+        _playlist_ids(data, user_id)["version"] = op["seq"]
+    elif kind == "intern":
+        _intern(data, user_id, op["playlist"], op["seq"])
+    elif kind == "playlist_delete":
+        for song_id in data.get(user_id, {}).pop(op["playlist"], None) or []:
+            _release(data, song_id)
+        ids = data.get("playlist_ids", {}).get(user_id)
+        entry = ids and ids["names"].pop(op["playlist"], None)
+        if entry:
+            ids["ids"].pop(str(entry[0]), None)
+            ids["version"] = op["seq"]
+    elif kind == "song_append":
+        song_id, file_id, file_name = song_ref(op)
+        catalog = data.setdefault("songs", {})
+        if song_id not in catalog:
+            catalog[song_id] = Song(file_id, file_name)
+        catalog[song_id].refs += 1
+        playlist = data.setdefault(user_id, {}).get(op["playlist"])
+        if playlist is None:
+            playlist = data[user_id][op["playlist"]] = Playlist()
+        _touch(data, user_id, op["playlist"], op["seq"])
+        return playlist.append(song_id)
+    elif kind == "song_remove":
+        playlist = data.get(user_id, {}).get(op["playlist"])
+        _touch(data, user_id, op["playlist"], op["seq"])
+        song_id = playlist.remove(_entry(playlist, op)) if playlist is not None else None
+        if song_id is not None:
+            return _release(data, song_id)
+    elif kind == "song_move":
+        playlist = data.get(user_id, {}).get(op["playlist"])
+        _touch(data, user_id, op["playlist"], op["seq"])
+        return playlist is not None and playlist.move(op["entry"], op["position"])
+    elif kind == "song_transfer":
+        # The catalog reference moves with the song, so refs don't change
+        playlists = data.get(user_id, {})
+        source = playlists.get(op["playlist"])
+        song_id = source.remove(op["entry"]) if source is not None else None
+        _touch(data, user_id, op["playlist"], op["seq"])
+        _touch(data, user_id, op["to"], op["seq"])
+        if song_id is not None:
+            target = playlists.get(op["to"])
+            if target is None:
+                target = playlists[op["to"]] = Playlist()
+            return target.append(song_id)
+    elif kind == "playlist_shuffle":
+        playlist = data.get(user_id, {}).get(op["playlist"])
+        _touch(data, user_id, op["playlist"], op["seq"])
+        if playlist:
+            # Seeded, so replaying the journal gives the same order
+            playlist.shuffle(random.Random(op["seed"]))
+    elif kind == "share":
+        data.setdefault("shared_playlists", {})[op["token"]] = {
+            "user_id": user_id,
+            "playlist_name": op["playlist"],
+        }
+        # The owner's record lists its tokens, so re-sharing reuses a link and deletes clean up
+        _playlist_ids(data, user_id).setdefault("shares", {}).setdefault(op["playlist"], []).append(op["token"])
+    elif kind == "unshare":
+        entry = data.get("shared_playlists", {}).pop(op["token"], None)
+        if entry:
+            _forget_share(data, op["token"], entry)
+    elif kind == "share_open":
+        # Share links the user has opened, most recent last; inline search covers them
+        data.setdefault(user_id, {})
+        received = _playlist_ids(data, user_id).setdefault("received", [])
+        if op["token"] in received:
+            received.remove(op["token"])
+        received.append(op["token"])
+        del received[:-MAX_RECEIVED_SHARES]
+    elif kind == "subscribe":
+        data.setdefault("subscribers", {}).setdefault(op["token"], {})[user_id] = op["chat"]
+    elif kind == "unsubscribe":
+        subscribers = data.get("subscribers", {}).get(op["token"])
+        if subscribers is not None:
+            subscribers.pop(user_id, None)
+            if not subscribers:
+                del data["subscribers"][op["token"]]
+    elif kind == "job_save":
+        data.setdefault("send_jobs", {})[op["job"]["id"]] = op["job"]
+    elif kind == "job_done":
+        data.get("send_jobs", {}).pop(op["id"], None)
+    elif kind == "fsm":
+        states = data.setdefault("fsm_states", {}).setdefault(user_id, {})
+        if op["state"] is None and not op["data"]:
+            states.pop(op["key"], None)
+        else:
+            states[op["key"]] = [op["state"], op["data"], op["expires"]]
+        if not states:
+            del data["fsm_states"][user_id]
+    else:
+        raise ValueError(f"Unknown journal op: {kind}")
+
+
+# Journal lines look like "<crc32> <json>\n" so a torn or garbled tail can be detected
+def encode_record(record):
+    payload = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+    return f"{zlib.crc32(payload.encode('utf-8')):08x} {payload}\n"
+
+
+def decode_record(line):
+    if not line.endswith("\n") or len(line) < 10 or line[8] != " ":
+        return None
+    payload = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(payload.encode("utf-8")):
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+# Snapshots before the record files were JSON documents: format 0 a bare dict of users
+# (some still in the pre-playlist shape, see legacy_user), format 1 that dict wrapped
+# with its format and seq. They are read a member at a time, so converting one never
+# holds more than a single user's value in memory.
+JSON_FORMAT = 1
+SNAPSHOT_CHUNK = 1 << 20
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class JsonStream:
+    # Incremental reader over one JSON document in a text file. members() yields the
+    # keys of the object at the current position; each member's value has to be read
+    # (value() or members()) before the next key is asked for.
+    def __init__(self, file, chunk_size=SNAPSHOT_CHUNK):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _more(self, size=0):
+        # Drops what was consumed and reads another chunk; False at end of file
+        if self.eof:
+            return False
+        chunk = self.file.read(max(self.chunk_size, size))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._more():
+                raise json.JSONDecodeError("Unexpected end of document", self.buffer, self.pos)
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise json.JSONDecodeError(f"Expected {char!r}", self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # Cut off by the end of the buffer: read as much again and retry
+                if not self._more(len(self.buffer) - self.pos):
+                    raise
+                continue
+            # A number ending the buffer may go on in the next chunk
+            if end == len(self.buffer) and self._more():
+                continue
+            self.pos = end
+            return value
+
+    def members(self):
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise json.JSONDecodeError("Expected an object key", self.buffer, self.pos)
+            self._expect(":")
+            yield key
+            char = self._peek()
+            self.pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise json.JSONDecodeError("Expected ',' or '}'", self.buffer, self.pos - 1)
+
+
+class SnapshotStream(JsonStream):
+    # The members of a format 0 or 1 snapshot's data dict; seq is known once they're read
+    def __init__(self, file, chunk_size=SNAPSHOT_CHUNK):
+        super().__init__(file, chunk_size)
+        self.seq = 0
+
+    def data(self):
+        for key in self.members():
+            if key == "format":
+                version = self.value()
+                if version > JSON_FORMAT:
+                    # Not corrupt, just newer than this code: refuse rather than misread it
+                    raise RuntimeError(f"{self.file.name} is snapshot format {version}, newer than this version reads")
+            elif key == "seq":
+                self.seq = self.value()
+            elif key == "data":
+                yield from self.members()
+            else:
+                yield key
+
+
+# Yields (record, end_offset) for every intact record after byte offset `start`,
+# stopping at a torn (or still being written) tail
+def read_journal(path, start=0):
+    offset = start
+    with open(path, "rb") as f:
+        f.seek(start)
+        for line in iter(f.readline, b""):
+            try:
+                record = decode_record(line.decode("utf-8"))
+            except UnicodeDecodeError:
+                record = None
+            if record is None:
+                return
+            offset += len(line)
+            yield record, offset
+
+
+# Record files hold one "<key>\t<json>\n" line per user, catalog song, share token,
+# old share link's owner, user with an unfinished FSM flow and the shard's send jobs,
+# followed by an index of (key hash, offset, length) sorted by hash and a fixed footer.
+# Opening one reads only the footer; a lookup is a binary search over the mmapped
+# index, so startup cost doesn't grow with the number of users.
+RECORDS_MAGIC = b"MUSREC%02d" % SNAPSHOT_FORMAT
+_INDEX_ENTRY = struct.Struct(">QQI")
+_FOOTER = struct.Struct(">QQQ8s")
+
+JOBS_KEY = "jobs"
+
+
+def user_key(user_id):
+    return f"u:{user_id}"
+
+
+def token_key(token):
+    return f"t:{token}"
+
+
+def subscribers_key(token):
+    # Subscribers of a share link who live in this shard
+    return f"b:{token}"
+
+
+def song_key(song_id):
+    return f"s:{song_id}"
+
+
+def fsm_key(user_id):
+    return f"f:{user_id}"
+
+
+def legacy_key(token):
+    # Owner of a share link minted before links carried the owner's hash (a legacy
+    # unique_id or an early uuid), kept in the shard of the link's own hash
+    return f"l:{token}"
+
+
+# Share links minted by ShareRegistry.share start with their owner's hash
+_HASHED_TOKEN = re.compile(r"([0-9a-f]{8})-[0-9a-f]{32}")
+
+
+def live_states(states, now):
+    # FSM entries are [state, data, expires]; abandoned flows run out and are dropped
+    return {key: entry for key, entry in states.items() if entry[2] is None or entry[2] > now}
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def record_value(key, line):
+    return json.loads(line[len(key.encode("utf-8")) + 1:])
+
+
+class RecordWriter:
+    # Records go to a temporary file that replaces `path` once the index is written.
+    # Index entries are kept packed (20 bytes a record rather than a tuple of ints),
+    # so writing a large file doesn't take memory in proportion to it.
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.hashes = array("Q")
+        self.offsets = array("Q")
+        self.lengths = array("I")
+        self.offset = 0
+
+    def add(self, key, value):
+        self.add_line(key, f"{key}\t{_dumps(value)}\n".encode("utf-8"))
+
+    def add_line(self, key, line):
+        self.hashes.append(key_hash(key))
+        self.offsets.append(self.offset)
+        self.lengths.append(len(line))
+        self.file.write(line)
+        self.offset += len(line)
+
+    def finish(self, seq):
+        # A stable sort keeps records with the same hash in file order
+        count = len(self.hashes)
+        index = bytearray(count * _INDEX_ENTRY.size)
+        for position, record in enumerate(sorted(range(count), key=self.hashes.__getitem__)):
+            _INDEX_ENTRY.pack_into(
+                index, position * _INDEX_ENTRY.size, self.hashes[record], self.offsets[record], self.lengths[record]
+            )
+        self.file.write(index)
+        self.file.write(_FOOTER.pack(seq, self.offset, count, RECORDS_MAGIC))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class RecordFile:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            stat = os.fstat(self.file.fileno())
+            self.id = (stat.st_dev, stat.st_ino)
+            if stat.st_size < _FOOTER.size:
+                raise ValueError(f"{path} is too short to be a record file")
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.seq, self.index_offset, self.count, magic = _FOOTER.unpack_from(self.map, stat.st_size - _FOOTER.size)
+            if (
+                not re.fullmatch(rb"MUSREC\d\d", magic) or not 2 <= int(magic[6:]) <= SNAPSHOT_FORMAT
+                or self.index_offset + self.count * _INDEX_ENTRY.size + _FOOTER.size != stat.st_size
+            ):
+                raise ValueError(f"{path} is not a format 2-{SNAPSHOT_FORMAT} record file")
+            # Older formats are migrated by the owning MusicStore on load
+            self.format = int(magic[6:])
+        except BaseException:
+            self.file.close()
+            raise
+
+    def _entry(self, position):
+        return _INDEX_ENTRY.unpack_from(self.map, self.index_offset + position * _INDEX_ENTRY.size)
+
+    def line(self, key):
+        wanted = key_hash(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        prefix = f"{key}\t".encode("utf-8")
+        # Different keys can share a hash; the line itself says which key it is
+        for position in range(low, self.count):
+            found, offset, length = self._entry(position)
+            if found != wanted:
+                break
+            if self.map[offset:offset + len(prefix)] == prefix:
+                return self.map[offset:offset + length]
+        return None
+
+    def get(self, key):
+        line = self.line(key)
+        return None if line is None else record_value(key, line)
+
+    def items(self):
+        # (key, raw line) in file order, without decoding the values
+        position = 0
+        while position < self.index_offset:
+            end = self.map.find(b"\n", position, self.index_offset) + 1
+            line = self.map[position:end]
+            yield line[:line.index(b"\t")].decode("utf-8"), line
+            position = end
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def open_records(path):
+    try:
+        return RecordFile(path)
+    except FileNotFoundError:
+        return None
+
+
+def empty_data():
+    return {"playlist_ids": {}, "shared_playlists": {}, "send_jobs": {}, "fsm_states": {}, "subscribers": {}, "songs": {}}
+
+
+def load_record(data, key, value):
+    # Puts one stored record into a working-set dict shaped like the format 1 data
+    if key == JOBS_KEY:
+        data["send_jobs"] = value or {}
+    elif key.startswith("u:"):
+        if value is not None:
+            data[key[2:]] = {name: Playlist.from_record(songs) for name, songs in value["playlists"].items()}
+            if value["ids"] is not None:
+                data["playlist_ids"][key[2:]] = value["ids"]
+    elif key.startswith("s:"):
+        if value is not None:
+            data["songs"][key[2:]] = Song(*value)
+    elif key.startswith("f:"):
+        if value is not None:
+            data["fsm_states"][key[2:]] = value
+    elif key.startswith("b:"):
+        if value is not None:
+            data["subscribers"][key[2:]] = value
+    elif value is not None:
+        data["shared_playlists"][key[2:]] = value
+
+
+def dump_record(data, key):
+    if key == JOBS_KEY:
+        return data["send_jobs"] or None
+    if key.startswith("u:"):
+        if key[2:] not in data:
+            return None
+        playlists = {name: playlist.record() for name, playlist in data[key[2:]].items()}
+        return {"playlists": playlists, "ids": data["playlist_ids"].get(key[2:])}
+    if key.startswith("s:"):
+        song = data["songs"].get(key[2:])
+        return song and song.record()
+    if key.startswith("f:"):
+        return live_states(data["fsm_states"].get(key[2:], {}), time.time()) or None
+    if key.startswith("b:"):
+        return data["subscribers"].get(key[2:]) or None
+    return data["shared_playlists"].get(key[2:])
+
+
+def load_op(op, data, load):
+    # Calls load(key) for every record the op changes and returns those keys
+    kind = op["op"]
+    if kind in ("job_save", "job_done"):
+        keys = [JOBS_KEY]
+    elif kind == "fsm":
+        keys = [fsm_key(op["user"])]
+    elif kind in ("subscribe", "unsubscribe"):
+        keys = [subscribers_key(op["token"])]
+    else:
+        keys = []
+        if kind in ("share", "unshare"):
+            keys.append(token_key(op["token"]))
+            load(keys[-1])
+        user_id = op.get("user")
+        if user_id is None and kind == "unshare":
+            # Unshare records from before they carried the owner
+            entry = data["shared_playlists"].get(op["token"])
+            user_id = entry and entry["user_id"]
+        if user_id is not None:
+            keys.append(user_key(user_id))
+            load(keys[-1])
+            keys.extend(song_key(song_id) for song_id in _released_songs(op, data, user_id))
+        if kind == "song_append":
+            keys.append(song_key(song_ref(op)[0]))
+    for key in keys:
+        load(key)
+    return keys
+
+
+def _released_songs(op, data, user_id):
+    # Catalog entries an op drops a reference to
+    playlist = data.get(user_id, {}).get(op.get("playlist"))
+    if not playlist:
+        return []
+    if op["op"] == "playlist_delete":
+        return set(playlist)
+    if op["op"] == "song_remove":
+        song_id = playlist.song(_entry(playlist, op))
+        return [song_id] if song_id is not None else []
+    return []
+
+
+def _catalog_playlists(playlists, catalog):
+    # Playlists before format 3 hold song dicts; swap them for catalog ids
+    converted = {}
+    for playlist_name, songs in playlists.items():
+        converted[playlist_name] = []
+        for song in songs:
+            song_id = legacy_song_id(song["file_id"])
+            if song_id not in catalog:
+                catalog[song_id] = [song["file_id"], song["file_name"], 0]
+            catalog[song_id][2] += 1
+            converted[playlist_name].append(song_id)
+    return converted
+
+
+# Before named playlists each user had a single "music" list and a unique_id that
+# /getlist looked them up by. The list becomes this playlist and the id a share link to it.
+LEGACY_PLAYLIST = "music"
+
+
+def legacy_user(playlists):
+    # (playlists, unique_id) of a stored user, in the playlist shape either way
+    unique_id = playlists.get("unique_id")
+    if not isinstance(unique_id, str):
+        return playlists, None
+    playlists = {name: songs for name, songs in playlists.items() if name != "unique_id"}
+    playlists.setdefault(LEGACY_PLAYLIST, [])
+    return playlists, unique_id
+
+
+def _user_records(user_id, playlists, ids, catalog):
+    # Records of one user from before the catalog, plus the share link and its index
+    # entry if the user is in the legacy shape
+    playlists, unique_id = legacy_user(playlists)
+    if unique_id is not None:
+        if ids is None:
+            ids = {"next": 1, "version": 0, "names": {}, "ids": {}}
+        tokens = ids.setdefault("shares", {}).setdefault(LEGACY_PLAYLIST, [])
+        if unique_id not in tokens:
+            tokens.append(unique_id)
+        yield token_key(unique_id), {"user_id": user_id, "playlist_name": LEGACY_PLAYLIST}
+        yield legacy_key(unique_id), user_id
+    yield user_key(user_id), {"playlists": _catalog_playlists(playlists, catalog), "ids": ids}
+
+
+def data_records(data):
+    # Format 0/1 data as (key, value) records
+    catalog = {}
+    shares = {}
+    for token, entry in data.get("shared_playlists", {}).items():
+        shares.setdefault(entry["user_id"], {}).setdefault(entry["playlist_name"], []).append(token)
+        yield token_key(token), entry
+        if not _HASHED_TOKEN.fullmatch(token):
+            yield legacy_key(token), entry["user_id"]
+    all_ids = data.get("playlist_ids", {})
+    for user_id, playlists in data.items():
+        if user_id in NAMESPACES:
+            continue
+        ids = all_ids.get(user_id)
+        if user_id in shares:
+            if ids is None:
+                ids = {"next": 1, "version": 0, "names": {}, "ids": {}}
+            ids["shares"] = shares[user_id]
+        yield from _user_records(user_id, playlists, ids, catalog)
+    for song_id, song in catalog.items():
+        yield song_key(song_id), song
+    if data.get("send_jobs"):
+        yield JOBS_KEY, data["send_jobs"]
+
+
+# One-time upgrade of a format 0/1 snapshot, streamed twice so that only one user is
+# decoded at a time. The first pass writes the namespaces and counts how many
+# playlists hold each song; the second writes the users, and each catalog song the
+# first time a user holds it. Memory grows with the share links, playlist ids and
+# distinct songs' reference counts, never with the size of the playlists.
+def convert_snapshot(path, records_path, chunk_size=SNAPSHOT_CHUNK):
+    writer = RecordWriter(records_path)
+    try:
+        shares = {}
+        all_ids = {}
+        refs = {}
+        with open(path, "r", encoding="utf-8") as f:
+            snapshot = SnapshotStream(f, chunk_size)
+            for key in snapshot.data():
+                if key == "shared_playlists":
+                    for token in snapshot.members():
+                        entry = snapshot.value()
+                        shares.setdefault(entry["user_id"], {}).setdefault(entry["playlist_name"], []).append(token)
+                        writer.add(token_key(token), entry)
+                        if not _HASHED_TOKEN.fullmatch(token):
+                            writer.add(legacy_key(token), entry["user_id"])
+                elif key == "playlist_ids":
+                    for user_id in snapshot.members():
+                        all_ids[user_id] = snapshot.value()
+                elif key == "send_jobs":
+                    jobs = snapshot.value()
+                    if jobs:
+                        writer.add(JOBS_KEY, jobs)
+                elif key in NAMESPACES:
+                    snapshot.value()
+                else:
+                    playlists, _ = legacy_user(snapshot.value())
+                    for songs in playlists.values():
+                        for song in songs:
+                            song_id = legacy_song_id(song["file_id"])
+                            refs[song_id] = refs.get(song_id, 0) + 1
+            seq = snapshot.seq
+
+        with open(path, "r", encoding="utf-8") as f:
+            snapshot = SnapshotStream(f, chunk_size)
+            for key in snapshot.data():
+                value = snapshot.value()
+                if key in NAMESPACES:
+                    continue
+                ids = all_ids.pop(key, None)
+                if key in shares:
+                    if ids is None:
+                        ids = {"next": 1, "version": 0, "names": {}, "ids": {}}
+                    ids["shares"] = shares.pop(key)
+                catalog = {}
+                for record_key, record in _user_records(key, value, ids, catalog):
+                    writer.add(record_key, record)
+                for song_id, (file_id, file_name, _) in catalog.items():
+                    if song_id in refs:
+                        writer.add(song_key(song_id), [file_id, file_name, refs.pop(song_id)])
+        writer.finish(seq)
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def migrate_records(path):
+    # Rewrites a format 2 record file with a song catalog (and users still in the legacy
+    # shape with their share link). The catalog is built in memory, so this costs one
+    # pass and memory for the distinct songs, once.
+    old = RecordFile(path)
+    try:
+        if old.format == SNAPSHOT_FORMAT:
+            return False
+        catalog = {}
+        writer = RecordWriter(path)
+        try:
+            for key, line in old.items():
+                if key.startswith("u:"):
+                    value = record_value(key, line)
+                    for record_key, record in _user_records(key[2:], value["playlists"], value["ids"], catalog):
+                        writer.add(record_key, record)
+                else:
+                    writer.add_line(key, line)
+            for song_id, song in catalog.items():
+                writer.add(song_key(song_id), song)
+            writer.finish(old.seq)
+        except BaseException:
+            writer.abort()
+            raise
+    finally:
+        old.close()
+    return True
+
+
+# Folds a sealed journal segment into the record file. Only the records the segment
+# touches are decoded; every other line is copied as is. It only touches files, never
+# the live working set, so it is safe to run in a worker thread or process.
+def compact_journal(records_path, sealed_path):
+    old = open_records(records_path)
+    try:
+        seq = old.seq if old else 0
+        data = empty_data()
+        touched = set()
+
+        def load(key):
+            if key not in touched:
+                touched.add(key)
+                load_record(data, key, old.get(key) if old else None)
+
+        for record, _ in read_journal(sealed_path):
+            if record["seq"] > seq:
+                load_op(record, data, load)
+                apply_op(data, record)
+                seq = record["seq"]
+
+        writer = RecordWriter(records_path)
+        now = time.time()
+        try:
+            if old:
+                for key, line in old.items():
+                    if key in touched:
+                        continue
+                    if key.startswith("f:"):
+                        # FSM records are small; rewriting them is what expires abandoned flows on disk
+                        states = record_value(key, line)
+                        live = live_states(states, now)
+                        if len(live) != len(states):
+                            if live:
+                                writer.add(key, live)
+                            continue
+                    writer.add_line(key, line)
+            for key in touched:
+                value = dump_record(data, key)
+                if value is not None:
+                    writer.add(key, value)
+            writer.finish(seq)
+        except BaseException:
+            writer.abort()
+            raise
+    finally:
+        if old:
+            old.close()
+    os.remove(sealed_path)
+    return seq
+
+
+# Shard files hold users at the top level next to these per-user namespaces
+NAMESPACES = ("playlist_ids", "shared_playlists", "send_jobs", "fsm_states", "subscribers")
+
+DEFAULT_SHARDS = 16
+
+# Users kept in memory per process; colder ones are read back from the record files
+DEFAULT_CACHE_USERS = 50000
+# Catalog songs kept in memory per cached user
+SONGS_PER_USER = 8
+
+
+def user_hash(user_id):
+    return zlib.crc32(str(user_id).encode("utf-8"))
+
+
+def shard_of(user_id, count):
+    return user_hash(user_id) % count
+
+
+def shard_path(path, index, count):
+    # A one-shard layout is the original single data file
+    if count == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{index}-of-{count}{ext}"
+
+
+def records_path(path):
+    return f"{path}.records"
+
+
+def layout_path(path, worker, workers):
+    return f"{path}.layout-{worker}-of-{workers}"
+
+
+def read_layout(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["shards"]
+
+
+def write_layout(path, count):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"shards": count}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def record_owner(record):
+    # The user whose shard a journal record belongs to (None if it doesn't say)
+    if record["op"] == "job_save":
+        return record["job"]["user"]
+    return record.get("user")
+
+
+# Splits the record files of the old shards into record files for the new shard
+# count. Lines are copied as they are; users are decoded only to count which songs
+# each new shard's catalog needs, and the send jobs are split by user. The new
+# catalogs are built in memory. Only files are touched, so it runs in a thread while
+# the old shards keep serving. Returns the seq each old file was at, so the journal
+# tail can be replayed on top.
+def split_records(sources, targets, count):
+    writers = {index: RecordWriter(records_path(path)) for index, path in targets.items()}
+    jobs = {index: {} for index in targets}
+    catalogs = {index: {} for index in targets}
+    subscribers = {index: {} for index in targets}
+    seqs = {}
+    try:
+        for index, source in sources.items():
+            old = open_records(records_path(source))
+            seqs[index] = old.seq if old else 0
+            if old is None:
+                continue
+            try:
+                refs = {target: {} for target in targets}
+                for key, line in old.items():
+                    if key == JOBS_KEY:
+                        for job_id, job in record_value(key, line).items():
+                            jobs[shard_of(job["user"], count)][job_id] = job
+                    elif key.startswith("u:"):
+                        target = shard_of(key[2:], count)
+                        writers[target].add_line(key, line)
+                        for songs in record_value(key, line)["playlists"].values():
+                            for song_id in Playlist.from_record(songs):
+                                refs[target][song_id] = refs[target].get(song_id, 0) + 1
+                    elif key.startswith("f:"):
+                        writers[shard_of(key[2:], count)].add_line(key, line)
+                    elif key.startswith("t:"):
+                        owner = record_value(key, line)["user_id"]
+                        writers[shard_of(owner, count)].add_line(key, line)
+                    elif key.startswith("l:"):
+                        writers[shard_of(key[2:], count)].add_line(key, line)
+                    elif key.startswith("b:"):
+                        for user_id, chat_id in record_value(key, line).items():
+                            subscribers[shard_of(user_id, count)].setdefault(key, {})[user_id] = chat_id
+                # A song's catalog entry is in the same old shard as every user holding it
+                for key, line in old.items():
+                    if not key.startswith("s:"):
+                        continue
+                    file_id, file_name, _ = record_value(key, line)
+                    for target, counted in refs.items():
+                        moved = counted.get(key[2:])
+                        if moved:
+                            song = catalogs[target].setdefault(key[2:], [file_id, file_name, 0])
+                            song[2] += moved
+            finally:
+                old.close()
+
+        # New shards continue after every old seq, so no old version number is reused
+        base_seq = max(seqs.values(), default=0)
+        for index, path in targets.items():
+            for leftover in (f"{path}.journal", f"{path}.journal.compacting"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            for song_id, song in catalogs[index].items():
+                writers[index].add(song_key(song_id), song)
+            for key, value in subscribers[index].items():
+                writers[index].add(key, value)
+            if jobs[index]:
+                writers[index].add(JOBS_KEY, jobs[index])
+            writers[index].finish(base_seq)
+    except BaseException:
+        for writer in writers.values():
+            if not writer.file.closed:
+                writer.abort()
+        raise
+    return seqs
+
+
+class ShareRegistry:
+    # Share tokens live in their own records (token -> owner and playlist, for deep
+    # links) and in the owner's record (playlist -> tokens, for reuse and cleanup).
+    def __init__(self, store):
+        self.store = store
+
+    def resolve(self, token):
+        entry = self.store.share_entry(token)
+        if entry is None:
+            return None
+        return entry["user_id"], entry["playlist_name"]
+
+    def tokens(self, user_id, playlist_name):
+        ids = self.store.ids(user_id)
+        return list(ids.get("shares", {}).get(playlist_name, [])) if ids else []
+
+    def share(self, user_id, playlist_name):
+        tokens = self.tokens(user_id, playlist_name)
+        if tokens:
+            return tokens[0]
+        # The owner's hash leads the token so any process can find the owning shard
+        token = f"{user_hash(user_id):08x}-{uuid.uuid4().hex}"
+        self.store._commit({"op": "share", "token": token, "user": user_id, "playlist": playlist_name})
+        return token
+
+    def forget(self, user_id, playlist_name):
+        for token in self.tokens(user_id, playlist_name):
+            self.store._commit({"op": "unshare", "token": token, "user": user_id})
+
+    # The recipient's side: links a user opened, kept in the recipient's record
+    def received(self, user_id):
+        ids = self.store.ids(user_id)
+        return list(ids.get("received", [])) if ids else []
+
+    def opened(self, user_id, token):
+        received = self.received(user_id)
+        if not received or received[-1] != token:
+            self.store._commit({"op": "share_open", "user": user_id, "token": token})
+
+
+class SongList(Sequence):
+    # A playlist as handlers read it: its catalog ids, resolved to Songs only for the
+    # items actually looked at (a page of buttons, the next album of a send)
+    __slots__ = ("shard", "playlist")
+
+    def __init__(self, shard, playlist):
+        self.shard = shard
+        self.playlist = playlist
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self.playlist))
+            items = self.playlist.items(start, stop) if step == 1 else self.playlist.items()[index]
+            return [self.shard.song(song_id) for _, song_id in items]
+        if index < 0:
+            index += len(self.playlist)
+        items = self.playlist.items(index, index + 1) if index >= 0 else []
+        if not items:
+            raise IndexError("playlist index out of range")
+        return self.shard.song(items[0][1])
+
+    def __len__(self):
+        return len(self.playlist)
+
+    def page(self, start, stop):
+        # (entry id, Song) for positions start..stop, for buttons that name the entry
+        return [(entry, self.shard.song(song_id)) for entry, song_id in self.playlist.items(start, stop)]
+
+    def entry(self, entry):
+        song_id = self.playlist.song(entry)
+        return None if song_id is None else self.shard.song(song_id)
+
+    def position(self, entry):
+        # 0-based position of an entry, or None
+        for position, (other, _) in enumerate(self.playlist.items()):
+            if other == entry:
+                return position
+        return None
+
+
+def index_catalog(path, dirty, catalog):
+    # SongIndex over a record file's catalog, with the songs of dirty keys taken from
+    # catalog (song_id -> Song) instead. Runs off the loop, on its own handle to the
+    # file, so a compaction swapping it out doesn't matter.
+    changed = {key[2:] for key in dirty if key.startswith("s:")}
+    records = open_records(path)
+    try:
+        stored = () if records is None else (
+            (key[2:], record_value(key, line)[1]) for key, line in records.items()
+            if key.startswith("s:") and key[2:] not in changed
+        )
+        current = ((song_id, catalog[song_id].file_name) for song_id in changed if song_id in catalog)
+        return SongIndex.build(chain(stored, current))
+    finally:
+        if records is not None:
+            records.close()
+
+
+class LazyShard:
+    # Working set of one shard's record file. Users and catalog songs are read on first
+    # access and kept in LRUs (max_users users, SONGS_PER_USER times as many songs);
+    # records changed since the record file was written are "dirty" and pinned in
+    # memory until a compaction folds them in, so evicting never loses a change. The
+    # shard's send jobs are small and always loaded.
+    def __init__(self, path, max_users=DEFAULT_CACHE_USERS):
+        self.path = path
+        self.records_path = records_path(path)
+        self.journal_path = f"{path}.journal"
+        self.sealed_path = f"{path}.journal.compacting"
+        self.limits = {"u": max_users, "s": max_users * SONGS_PER_USER}
+        self.records = None
+        self.data = empty_data()
+        self.seq = 0
+        # Clean cached users and songs by key kind, least recently used first
+        self.lru = {kind: OrderedDict() for kind in self.limits}
+        # key -> seq of its latest change not yet in the record file
+        self.dirty = {}
+        # user_id -> playlist -> set of its song ids, built when first asked
+        self.members = {}
+        # user_id -> set of the song ids in any of their playlists, built on their first search
+        self.libraries = {}
+        # SongIndex over the shard's whole catalog, built off the loop on the first
+        # search and kept up to date from then on; evictions don't touch it
+        self.index = None
+        self.index_stale = False
+        self._indexing = None
+        # Catalog ids changed while the index is being built
+        self._index_changes = None
+        self.shares = ShareRegistry(self)
+        self.cache = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _reset(self, records):
+        if self.records is not None:
+            self.records.close()
+        self.records = records
+        self.seq = records.seq if records else 0
+        self.data = empty_data()
+        self.lru = {kind: OrderedDict() for kind in self.limits}
+        self.dirty = {}
+        self.members = {}
+        self.libraries = {}
+        # Changes made between the old record file and the new one went unseen
+        self.index_stale = self.index is not None or self._indexing is not None
+        if records:
+            load_record(self.data, JOBS_KEY, records.get(JOBS_KEY))
+
+    def _load(self, key):
+        if key == JOBS_KEY or key in self.dirty:
+            return
+        lru = self.lru.get(key[0])
+        if lru is not None:
+            if key[2:] in lru:
+                lru.move_to_end(key[2:])
+                if key[0] == "u":
+                    self.cache["hits"] += 1
+                return
+            if key[0] == "u":
+                self.cache["misses"] += 1
+        value = self.records.get(key) if self.records else None
+        load_record(self.data, key, value)
+        if lru is not None and value is not None:
+            lru[key[2:]] = None
+            self._evict(key[0])
+
+    def _evict(self, kind):
+        lru = self.lru[kind]
+        while len(lru) > self.limits[kind]:
+            name, _ = lru.popitem(last=False)
+            if kind == "u":
+                self.data.pop(name, None)
+                self.data["playlist_ids"].pop(name, None)
+                self.members.pop(name, None)
+                self.libraries.pop(name, None)
+                self.cache["evictions"] += 1
+            else:
+                self.data["songs"].pop(name, None)
+
+    def _apply(self, op):
+        keys = load_op(op, self.data, self._load)
+        song_ids = [key[2:] for key in keys if key.startswith("s:")]
+        result = apply_op(self.data, op)
+        for key in keys:
+            self.dirty[key] = op["seq"]
+            lru = self.lru.get(key[0])
+            if lru is not None:
+                lru.pop(key[2:], None)
+        if op["op"] in PLAYLIST_OPS:
+            self._track_members(op, song_ids)
+            self._track_index(song_ids)
+        return result
+
+    def _track_members(self, op, song_ids):
+        if op["op"] in ("song_move", "playlist_shuffle"):
+            return
+        self.libraries.pop(op["user"], None)
+        members = self.members.get(op["user"], {})
+        if op["op"] == "song_transfer":
+            # Rebuilt from the playlists on the next has_song
+            members.pop(op["playlist"], None)
+            members.pop(op["to"], None)
+        elif op["playlist"] not in members:
+            return
+        elif op["op"] == "song_append":
+            members[op["playlist"]].update(song_ids)
+        elif op["op"] == "song_remove":
+            members[op["playlist"]].difference_update(song_ids)
+        else:
+            del members[op["playlist"]]
+
+    def _track_index(self, song_ids):
+        # Catalog entries an op created or released, added to or dropped from the index
+        if self._index_changes is not None:
+            self._index_changes.update(song_ids)
+        if self.index is None:
+            return
+        for song_id in song_ids:
+            song = self.song(song_id)
+            if song is None:
+                self.index.discard(song_id)
+            elif song_id not in self.index.entries:
+                self.index.add(song_id, song.file_name)
+
+    def _clean(self, seq):
+        # The record file now holds every change up to seq
+        for key, changed in list(self.dirty.items()):
+            if changed > seq:
+                continue
+            del self.dirty[key]
+            if key[0] in self.lru:
+                self.lru[key[0]][key[2:]] = None
+            elif key.startswith("t:"):
+                self.data["shared_playlists"].pop(key[2:], None)
+            elif key.startswith("f:"):
+                self.data["fsm_states"].pop(key[2:], None)
+            elif key.startswith("b:"):
+                self.data["subscribers"].pop(key[2:], None)
+        for kind in self.lru:
+            self._evict(kind)
+
+    def user(self, user_id):
+        key = user_key(user_id)
+        if key in self.dirty:
+            self.cache["hits"] += 1
+        else:
+            self._load(key)
+        return self.data.get(user_id)
+
+    def ids(self, user_id):
+        self.user(user_id)
+        return self.data["playlist_ids"].get(user_id)
+
+    def song(self, song_id):
+        self._load(song_key(song_id))
+        return self.data["songs"].get(song_id)
+
+    def songs(self, user_id, playlist_name):
+        playlist = (self.user(user_id) or {}).get(playlist_name)
+        return None if playlist is None else SongList(self, playlist)
+
+    def playlist_members(self, user_id, playlist_name):
+        members = self.members.setdefault(user_id, {}).get(playlist_name)
+        if members is None:
+            members = self.members[user_id][playlist_name] = set((self.user(user_id) or {}).get(playlist_name, ()))
+        return members
+
+    def has_song(self, user_id, playlist_name, song_id):
+        return song_id in self.playlist_members(user_id, playlist_name)
+
+    async def search_index(self):
+        # Later searches keep using a stale index while its replacement is built
+        if self.index is None or self.index_stale:
+            if self._indexing is None:
+                self._indexing = asyncio.ensure_future(self._build_index())
+            if self.index is None:
+                await asyncio.shield(self._indexing)
+        return self.index
+
+    async def _build_index(self):
+        # Songs changed since the record file was written are taken from (copies of)
+        # memory; those changed while it is read are caught up once it has been
+        dirty, catalog = list(self.dirty), dict(self.data["songs"])
+        self.index_stale = False
+        self._index_changes = set()
+        loop = asyncio.get_running_loop()
+        try:
+            index = await loop.run_in_executor(None, index_catalog, self.records_path, dirty, catalog)
+        except Exception as e:
+            if self.index is None:
+                raise
+            logging.error(f"Could not rebuild the search index of {self.path}: {e}")
+            self.index_stale = True
+            return
+        finally:
+            changes, self._index_changes = self._index_changes, None
+            self._indexing = None
+        self.index = index
+        self._track_index(changes)
+
+    async def search(self, user_id, words, limit, playlist_name=None):
+        # (song_id, Song) of the user's songs matching words, newest first, optionally
+        # only those in one playlist. The index covers every song of the shard, so the
+        # matches are narrowed to the ones the user's playlists hold.
+        playlists = self.user(user_id)
+        if not playlists or (playlist_name is not None and playlist_name not in playlists):
+            return []
+        index = await self.search_index()
+        # The playlists can have changed while the index was built
+        playlists = self.user(user_id) or {}
+        if playlist_name is not None:
+            within = self.playlist_members(user_id, playlist_name) if playlist_name in playlists else set()
+        else:
+            within = self.libraries.get(user_id)
+            if within is None:
+                within = self.libraries[user_id] = set().union(*(self.playlist_members(user_id, name) for name in playlists))
+        return [(song_id, self.song(song_id)) for song_id in index.search(words, limit, within)]
+
+    def share_entry(self, token):
+        key = token_key(token)
+        if key in self.dirty:
+            return self.data["shared_playlists"].get(token)
+        return self.records.get(key) if self.records else None
+
+    def legacy_owner(self, token):
+        # Written only when converting old snapshots, so never dirty
+        return self.records.get(legacy_key(token)) if self.records else None
+
+    def subscribers(self, token):
+        # user_id -> chat_id of this shard's subscribers to a share link
+        key = subscribers_key(token)
+        if key in self.dirty:
+            return self.data["subscribers"].get(token, {})
+        return (self.records.get(key) if self.records else None) or {}
+
+    def fsm_entry(self, user_id, key):
+        # [state, data, expires] of one FSM key, or None once it has expired
+        states = self._fsm_states(user_id)
+        entry = states.get(key) if states else None
+        if entry is None or (entry[2] is not None and entry[2] <= time.time()):
+            return None
+        return entry
+
+    def _fsm_states(self, user_id):
+        key = fsm_key(user_id)
+        if key in self.dirty:
+            return self.data["fsm_states"].get(user_id)
+        return self.records.get(key) if self.records else None
+
+    def user_ids(self):
+        if self.records:
+            for key, _ in self.records.items():
+                if key.startswith("u:"):
+                    yield key[2:]
+        for key in list(self.dirty):
+            if key.startswith("u:") and key[2:] in self.data and (not self.records or self.records.line(key) is None):
+                yield key[2:]
+
+    def send_jobs(self):
+        return list(self.data["send_jobs"].values())
+
+    def cache_stats(self):
+        stats = dict(self.cache)
+        stats["cached"] = len(self.lru["u"])
+        stats["cached_songs"] = len(self.lru["s"])
+        stats["pinned"] = sum(1 for key in self.dirty if key.startswith("u:"))
+        return stats
+
+    def memory_stats(self):
+        # Users, playlists and playlist entries held in memory, and catalog songs
+        stats = {"users": 0, "playlists": 0, "entries": 0, "songs": len(self.data["songs"])}
+        for key, playlists in self.data.items():
+            if key in NAMESPACES or key == "songs":
+                continue
+            stats["users"] += 1
+            stats["playlists"] += len(playlists)
+            stats["entries"] += sum(len(playlist) for playlist in playlists.values())
+        return stats
+
+
+class MusicStore(LazyShard):
+    # Handlers mutate the working set and return at once; run() batches the queued
+    # journal records and appends them off the event loop, flushing after at most
+    # max_latency seconds or as soon as max_batch records are waiting.
+    def __init__(self, path, compact_every=1000, max_latency=0.5, max_batch=500, executor=None,
+                 max_users=DEFAULT_CACHE_USERS):
+        super().__init__(path, max_users)
+        self.compact_every = compact_every
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        # Compaction runs here; pass a ProcessPoolExecutor to keep it off this process entirely
+        self.executor = executor
+        self.journal_records = 0
+        self._journal = None
+        self._pending = []
+        self._dirty = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        # A single writer thread keeps journal appends and rotations in order
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+        self._task = None
+        self._compaction = None
+        # Set while a reshard reads this shard's journal, which must not be rotated then
+        self.hold_compaction = False
+        # Called as listener(user_id, playlist_name) when a playlist changes and
+        # listener(user_id, None) when the user's playlist list does
+        self.listeners = []
+        self.stats = {
+            "mutations": 0,
+            "flushes": 0,
+            "flushed_mutations": 0,
+            "max_batch": 0,
+            "flush_seconds": 0.0,
+            "journal_bytes": 0,
+            "compactions": 0,
+            "compaction_seconds": 0.0,
+            "records_bytes": 0,
+        }
+        self.recent_batches = deque(maxlen=100)
+
+    def load(self):
+        # Only the record file's footer is read here; users come in on first access
+        if os.path.exists(self.path):
+            try:
+                if not os.path.exists(self.records_path):
+                    convert_snapshot(self.path, self.records_path)
+                    logging.info(f"Converted {self.path} to {self.records_path}")
+                # Keep the format 1 file around rather than deleting user data
+                os.replace(self.path, f"{self.path}.v1")
+            except (json.JSONDecodeError, KeyError) as e:
+                # Never silently overwrite a file we couldn't read: move it aside
+                corrupt_path = f"{self.path}.corrupt-{int(time.time())}"
+                os.replace(self.path, corrupt_path)
+                logging.error(f"Could not decode {self.path} ({e}); moved it to {corrupt_path}")
+
+        # A crash during compaction leaves a sealed segment behind; finish folding it first
+        if os.path.exists(self.sealed_path):
+            try:
+                compact_journal(self.records_path, self.sealed_path)
+            except Exception as e:
+                logging.error(f"Could not finish interrupted compaction of {self.records_path}: {e}")
+
+        try:
+            records = open_records(self.records_path)
+            if records is not None and records.format < SNAPSHOT_FORMAT:
+                records.close()
+                migrate_records(self.records_path)
+                logging.info(f"Migrated {self.records_path} to format {SNAPSHOT_FORMAT}")
+                records = open_records(self.records_path)
+        except ValueError as e:
+            corrupt_path = f"{self.records_path}.corrupt-{int(time.time())}"
+            os.replace(self.records_path, corrupt_path)
+            logging.error(f"Could not read {self.records_path} ({e}); moved it to {corrupt_path}")
+            records = None
+        self._reset(records)
+        self._replay_journal()
+        self._journal = open(self.journal_path, "a", encoding="utf-8", newline="\n")
+
+    def _replay_journal(self):
+        self.journal_records = 0
+        if not os.path.exists(self.journal_path):
+            return
+
+        replayed = 0
+        good_offset = 0
+        for record, good_offset in read_journal(self.journal_path):
+            self.journal_records += 1
+            # Records already folded into the record file are skipped
+            if record["seq"] <= self.seq:
+                continue
+            self._apply(record)
+            self.seq = record["seq"]
+            replayed += 1
+
+        if good_offset != os.path.getsize(self.journal_path):
+            logging.error(f"Discarding torn journal tail in {self.journal_path} at byte {good_offset}")
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(good_offset)
+        if replayed:
+            logging.info(f"Replayed {replayed} journal records from {self.journal_path}")
+
+    def _commit(self, op):
+        self.seq += 1
+        op["seq"] = self.seq
+        result = self._apply(op)
+        self._changed(op)
+        self._pending.append(encode_record(op))
+        self.stats["mutations"] += 1
+        self._dirty.set()
+        if len(self._pending) >= self.max_batch:
+            self._batch_full.set()
+        return result
+
+    def _changed(self, op):
+        keys = []
+        if op["op"] in PLAYLIST_OPS:
+            keys.append((op["user"], op["playlist"]))
+        if op["op"] == "song_transfer":
+            keys.append((op["user"], op["to"]))
+        if op["op"] in LIBRARY_OPS:
+            keys.append((op["user"], None))
+        for key in keys:
+            for listener in self.listeners:
+                listener(*key)
+
+    def version(self, user_id, playlist_name=None):
+        ids = self.ids(user_id)
+        if ids is None:
+            return 0
+        if playlist_name is None:
+            return ids["version"]
+        entry = ids["names"].get(playlist_name)
+        return entry[1] if entry else 0
+
+    def playlist_id(self, user_id, playlist_name):
+        # Playlists created before ids existed are interned the first time they're needed
+        entry = (self.ids(user_id) or {}).get("names", {}).get(playlist_name)
+        if entry is None:
+            self._commit({"op": "intern", "user": user_id, "playlist": playlist_name})
+            entry = self.ids(user_id)["names"][playlist_name]
+        return entry[0]
+
+    def playlist_name(self, user_id, playlist_id):
+        return (self.ids(user_id) or {}).get("ids", {}).get(str(playlist_id))
+
+    def add_user(self, user_id):
+        return self._commit({"op": "user", "user": user_id})
+
+    def create_playlist(self, user_id, playlist_name):
+        return self._commit({"op": "playlist_create", "user": user_id, "playlist": playlist_name})
+
+    def delete_playlist(self, user_id, playlist_name):
+        self.shares.forget(user_id, playlist_name)
+        return self._commit({"op": "playlist_delete", "user": user_id, "playlist": playlist_name})
+
+    def add_song(self, user_id, playlist_name, song_id, file_id, file_name):
+        # song_id is the file's file_unique_id; a playlist holds each song once
+        if self.has_song(user_id, playlist_name, song_id):
+            return False
+        self._commit({
+            "op": "song_append", "user": user_id, "playlist": playlist_name,
+            "song": song_id, "file_id": file_id, "file_name": file_name,
+        })
+        return True
+
+    def add_songs(self, user_id, playlist_name, songs):
+        # songs are (song_id, file_id, file_name); committed back to back, so the batch
+        # goes to the journal in one write. Returns whether each one was added.
+        return [self.add_song(user_id, playlist_name, *song) for song in songs]
+
+    # Songs in a playlist are addressed by entry id (see Playlist), which stays put
+    # while the songs around it are removed or reordered
+    def remove_song(self, user_id, playlist_name, entry):
+        return self._commit({"op": "song_remove", "user": user_id, "playlist": playlist_name, "entry": entry})
+
+    def move_song(self, user_id, playlist_name, entry, position):
+        return self._commit({"op": "song_move", "user": user_id, "playlist": playlist_name, "entry": entry, "position": position})
+
+    def transfer_song(self, user_id, playlist_name, entry, target_name):
+        # False when the song is gone or the target playlist already holds it
+        playlists = self.user(user_id) or {}
+        song_id = playlists[playlist_name].song(entry) if playlist_name in playlists else None
+        if song_id is None or target_name not in playlists or self.has_song(user_id, target_name, song_id):
+            return False
+        self._commit({"op": "song_transfer", "user": user_id, "playlist": playlist_name, "entry": entry, "to": target_name})
+        return True
+
+    def shuffle_playlist(self, user_id, playlist_name):
+        return self._commit({"op": "playlist_shuffle", "user": user_id, "playlist": playlist_name, "seed": random.getrandbits(32)})
+
+    # Send-job cursors are journaled next to the playlists so an interrupted send can resume
+    def save_job(self, job):
+        return self._commit({"op": "job_save", "job": job})
+
+    def finish_job(self, user_id, job_id):
+        return self._commit({"op": "job_done", "user": user_id, "id": job_id})
+
+    # Subscriptions are kept in the subscriber's shard, so subscribing and pruning write
+    # only where the subscriber lives; a fan-out reads the token's record in every shard
+    def subscribe(self, user_id, token, chat_id):
+        return self._commit({"op": "subscribe", "user": user_id, "token": token, "chat": chat_id})
+
+    def unsubscribe(self, user_id, token):
+        if user_id in self.subscribers(token):
+            self._commit({"op": "unsubscribe", "user": user_id, "token": token})
+
+    def drop_subscribers(self, token):
+        # The link is gone; one unsubscribe per subscriber keeps each record with its user
+        for user_id in list(self.subscribers(token)):
+            self.unsubscribe(user_id, token)
+
+    # FSM state of an unfinished flow (e.g. a playlist picked for an upload), with the
+    # time it is abandoned at; state None and empty data removes the entry
+    def set_fsm(self, user_id, key, state, data, expires):
+        return self._commit({"op": "fsm", "user": user_id, "key": key, "state": state, "data": data, "expires": expires})
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self._dirty.wait()
+            # Let more mutations pile into this batch, up to the latency budget. Not
+            # wait_for: it swallows a cancel that arrives as the batch fills up
+            # (Python < 3.12), and close() would then wait for this task forever.
+            full = asyncio.ensure_future(self._batch_full.wait())
+            try:
+                await asyncio.wait((full,), timeout=self.max_latency)
+            finally:
+                full.cancel()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing journal {self.journal_path}: {e}")
+
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        async with self._flush_lock:
+            batch, self._pending = self._pending, []
+            self._dirty.clear()
+            self._batch_full.clear()
+            if batch:
+                started = time.perf_counter()
+                try:
+                    written = await loop.run_in_executor(self._io, self._append, "".join(batch))
+                except Exception:
+                    # Put the batch back so the next flush retries it in order
+                    self._pending[:0] = batch
+                    self._dirty.set()
+                    raise
+                self.journal_records += len(batch)
+                self.stats["flushes"] += 1
+                self.stats["flushed_mutations"] += len(batch)
+                self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+                self.stats["flush_seconds"] += time.perf_counter() - started
+                self.stats["journal_bytes"] += written
+                self.recent_batches.append(len(batch))
+                logging.debug(f"Flushed {len(batch)} mutations to {self.journal_path}")
+
+            if self.journal_records >= self.compact_every and self._compaction is None and not self.hold_compaction:
+                await self._seal()
+                self._compaction = asyncio.create_task(self._compact())
+
+    def _append(self, chunk):
+        # Returns the bytes written
+        start = self._journal.tell()
+        self._journal.write(chunk)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        return self._journal.tell() - start
+
+    async def _seal(self):
+        # A segment left over from a failed compaction must be folded before sealing another
+        if not os.path.exists(self.sealed_path):
+            await asyncio.get_running_loop().run_in_executor(self._io, self._rotate)
+
+    def _rotate(self):
+        # Seal the current journal for compaction and start a fresh one
+        self._journal.close()
+        os.replace(self.journal_path, self.sealed_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8", newline="\n")
+        self.journal_records = 0
+
+    async def _compact(self):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            seq = await loop.run_in_executor(self.executor, compact_journal, self.records_path, self.sealed_path)
+            self._swap_records(seq)
+            self.stats["compactions"] += 1
+            self.stats["compaction_seconds"] += time.perf_counter() - started
+            # Every compaction rewrites the whole record file
+            self.stats["records_bytes"] += os.path.getsize(self.records_path)
+        except Exception as e:
+            logging.error(f"Error compacting {self.records_path}: {e}")
+        finally:
+            self._compaction = None
+
+    def _swap_records(self, seq):
+        # Serve from the new record file; users it now covers become evictable
+        records = open_records(self.records_path)
+        if self.records is not None:
+            self.records.close()
+        self.records = records
+        self._clean(seq)
+
+    async def checkpoint(self):
+        # Fold everything written so far into the record file and start an empty journal
+        await self.flush()
+        if self._compaction is not None:
+            await self._compaction
+        if self.journal_records or os.path.exists(self.sealed_path):
+            await self._seal()
+            await self._compact()
+
+    def abandon(self):
+        # Stop a shard whose users have moved elsewhere, without another flush
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._journal.close()
+        self._io.shutdown(wait=False)
+        if self.records is not None:
+            self.records.close()
+            self.records = None
+
+    def flush_stats(self):
+        stats = dict(self.stats)
+        stats["pending"] = len(self._pending)
+        stats["avg_batch"] = stats["flushed_mutations"] / stats["flushes"] if stats["flushes"] else 0.0
+        stats["recent_batches"] = list(self.recent_batches)
+        return stats
+
+    async def close(self):
+        # Forced flush on shutdown: drain the queue and leave a fresh record file behind
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.checkpoint()
+        self._journal.close()
+        self._io.shutdown()
+        if self.records is not None:
+            self.records.close()
+            self.records = None
+        logging.debug(f"Storage closed: {self.flush_stats()}")
+
+
+class ShardReplica(LazyShard):
+    # Read-only view of a shard that another process owns: its record file plus
+    # whatever the journal has gained since, caught up on every access. Nothing is
+    # locked, so readers never slow the owner down.
+    def __init__(self, path, max_users=DEFAULT_CACHE_USERS):
+        super().__init__(path, max_users)
+        self._journal_id = None
+        self._offset = 0
+
+    def exists(self):
+        return os.path.exists(self.records_path) or os.path.exists(self.journal_path)
+
+    def refresh(self):
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            stat = None
+        if (
+            stat is None or (stat.st_dev, stat.st_ino) != self._journal_id or stat.st_size < self._offset
+            or self._records_id() != (self.records and self.records.id)
+        ):
+            # First read, or the owner compacted and started a new journal
+            self._reload()
+        elif stat.st_size > self._offset:
+            self._catch_up(self.journal_path, self._offset)
+        return self
+
+    def _records_id(self):
+        try:
+            stat = os.stat(self.records_path)
+            return stat.st_dev, stat.st_ino
+        except FileNotFoundError:
+            return None
+
+    def _reload(self):
+        # A compaction can replace the record file while we read; start over if it did
+        for _ in range(5):
+            try:
+                self._reset(open_records(self.records_path))
+            except FileNotFoundError:
+                self._reset(None)
+            try:
+                self._catch_up(self.sealed_path, 0)
+            except FileNotFoundError:
+                pass
+            try:
+                stat = os.stat(self.journal_path)
+                self._journal_id = (stat.st_dev, stat.st_ino)
+                self._offset = 0
+                self._catch_up(self.journal_path, 0)
+            except FileNotFoundError:
+                self._journal_id, self._offset = None, 0
+            if self._records_id() == (self.records and self.records.id):
+                break
+
+    def _catch_up(self, path, start):
+        offset = start
+        for record, offset in read_journal(path, start):
+            if record["seq"] > self.seq:
+                self._apply(record)
+                self.seq = record["seq"]
+        if path == self.journal_path:
+            self._offset = offset
+
+
+class UserView(Mapping):
+    # users_music as handlers see it: user_id -> {playlist_name: songs}, wherever
+    # the user's shard lives. Iterating covers the users of the shards owned here.
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, user_id):
+        if user_id in NAMESPACES:
+            raise KeyError(user_id)
+        playlists = self.store.reader(user_id).user(user_id)
+        if playlists is None:
+            raise KeyError(user_id)
+        return playlists
+
+    def __iter__(self):
+        # Walks the record files without loading every user into the cache
+        for shard in list(self.store.shards.values()):
+            yield from shard.user_ids()
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class ShardedShares:
+    # Share links live with the owner's playlists in the owner's shard; the token
+    # starts with the owner's hash, so resolving one reads a single shard.
+    def __init__(self, store):
+        self.store = store
+
+    def share(self, user_id, playlist_name):
+        return self.store.shard(user_id).shares.share(user_id, playlist_name)
+
+    def forget(self, user_id, playlist_name):
+        self.store.shard(user_id).shares.forget(user_id, playlist_name)
+
+    def tokens(self, user_id, playlist_name):
+        return self.store.reader(user_id).shares.tokens(user_id, playlist_name)
+
+    def opened(self, user_id, token):
+        self.store.shard(user_id).shares.opened(user_id, token)
+
+    def received(self, user_id):
+        # (owner, playlist) of the links the user opened that still resolve
+        shared = (self.resolve(token) for token in self.store.reader(user_id).shares.received(user_id))
+        return [entry for entry in shared if entry is not None]
+
+    def resolve(self, token):
+        match = _HASHED_TOKEN.fullmatch(token)
+        if match:
+            return self.store.reader_for_hash(int(match.group(1), 16)).shares.resolve(token)
+        # Links minted before sharding don't say where they live. Those converted from
+        # an old snapshot have an index entry in the shard of their own hash; the rest
+        # are looked for in every shard.
+        owner = self.store.reader_for_hash(user_hash(token)).legacy_owner(token)
+        if owner is not None:
+            return self.store.reader(owner).shares.resolve(token)
+        for shard in self.store.all_readers():
+            shared = shard.shares.resolve(token)
+            if shared is not None:
+                return shared
+        return None
+
+
+class ShardedStore:
+    # Users are spread over `shards` MusicStores by a hash of their id. Each shard has
+    # its own files, journal writer and flush task, so flush cost follows the shard,
+    # not the whole user base. With several webhook workers, worker i owns the shards
+    # with index % workers == i and only reads the others (ShardReplica), so no two
+    # processes ever write the same files. When the configured shard count differs
+    # from the one on disk, start() reshards in the background while serving.
+    def __init__(self, path, shards=DEFAULT_SHARDS, worker=0, workers=1, cache_users=DEFAULT_CACHE_USERS,
+                 **store_options):
+        self.path = path
+        self.target = shards
+        self.worker = worker
+        self.workers = workers
+        self.cache_users = cache_users
+        self.store_options = store_options
+        self.layout_path = layout_path(path, worker, workers)
+        self.count = None
+        self.shards = {}
+        self.replicas = {}
+        self.foreign_counts = {}
+        self.listeners = []
+        self.users = UserView(self)
+        self.shares = ShardedShares(self)
+        self.reshards = 0
+        # How long load() took: layout, footers and journal replay
+        self.load_seconds = 0.0
+        self._reshard = None
+        self._finishing = None
+
+    def owns(self, index):
+        return index % self.workers == self.worker
+
+    def _cache_per_shard(self, count):
+        # The process-wide cache budget split over the shards it owns
+        return max(1, self.cache_users * self.workers // count)
+
+    def _open(self, index, count):
+        shard = MusicStore(
+            shard_path(self.path, index, count), max_users=self._cache_per_shard(count), **self.store_options
+        )
+        shard.listeners = self.listeners
+        return shard
+
+    def load(self):
+        started = time.perf_counter()
+        self.count = self._layout()
+        self.shards = {
+            index: self._open(index, self.count) for index in range(self.count) if self.owns(index)
+        }
+        for shard in self.shards.values():
+            shard.load()
+        write_layout(self.layout_path, self.count)
+        self.load_seconds = time.perf_counter() - started
+        return self.users
+
+    def _layout(self):
+        if os.path.exists(self.layout_path):
+            count = read_layout(self.layout_path)
+        elif self.workers == 1 and (os.path.exists(self.path) or os.path.exists(records_path(self.path))):
+            # The single data file from before sharding
+            count = 1
+        else:
+            # No layout recorded for this worker slot (e.g. the worker count changed):
+            # use whichever shard files are there
+            root, ext = os.path.splitext(self.path)
+            pattern = re.compile(re.escape(root) + r"\.\d+-of-(\d+)" + re.escape(ext) + r"(\.records)?$")
+            names = glob.glob(f"{glob.escape(root)}.*-of-*{ext}")
+            found = {int(match.group(1)) for match in map(pattern.match, names) if match}
+            if len(found) > 1:
+                raise RuntimeError(f"Shard files for several layouts {sorted(found)} exist next to {self.path}")
+            count = found.pop() if found else self.target
+        if count % self.workers:
+            raise RuntimeError(f"{count} shards can't be split evenly across {self.workers} workers")
+        return count
+
+    # Owned shard a user's changes go to
+    def shard(self, user_id):
+        index = shard_of(user_id, self.count)
+        shard = self.shards.get(index)
+        if shard is None:
+            raise RuntimeError(f"User {user_id} is in shard {index}, which this process does not own")
+        return shard
+
+    # Owned shard or read-only replica, for reading any user
+    def reader(self, user_id):
+        return self.reader_for_hash(user_hash(user_id))
+
+    def reader_for_hash(self, value):
+        shard = self.shards.get(value % self.count)
+        if shard is not None:
+            return shard
+        worker = value % self.workers
+        count = self._foreign_count(worker)
+        replica = self.replicas.get((count, value % count))
+        if replica is None:
+            replica = self.replicas[(count, value % count)] = ShardReplica(
+                shard_path(self.path, value % count, count), self._cache_per_shard(count)
+            )
+        if not replica.exists():
+            # The other worker may have resharded; look its layout up again next time
+            self.foreign_counts.pop(worker, None)
+        return replica.refresh()
+
+    def _foreign_count(self, worker):
+        count = self.foreign_counts.get(worker)
+        if count is None:
+            try:
+                count = read_layout(layout_path(self.path, worker, self.workers))
+            except FileNotFoundError:
+                count = self.count
+            self.foreign_counts[worker] = count
+        return count
+
+    def all_readers(self):
+        yield from list(self.shards.values())
+        for index in range(self.count):
+            if not self.owns(index):
+                yield self.reader_for_hash(index)
+
+    def version(self, user_id, playlist_name=None):
+        return self.shard(user_id).version(user_id, playlist_name)
+
+    def playlist_id(self, user_id, playlist_name):
+        return self.shard(user_id).playlist_id(user_id, playlist_name)
+
+    def playlist_name(self, user_id, playlist_id):
+        return self.shard(user_id).playlist_name(user_id, playlist_id)
+
+    def add_user(self, user_id):
+        return self.shard(user_id).add_user(user_id)
+
+    def create_playlist(self, user_id, playlist_name):
+        return self.shard(user_id).create_playlist(user_id, playlist_name)
+
+    def delete_playlist(self, user_id, playlist_name):
+        return self.shard(user_id).delete_playlist(user_id, playlist_name)
+
+    def add_song(self, user_id, playlist_name, song_id, file_id, file_name):
+        return self.shard(user_id).add_song(user_id, playlist_name, song_id, file_id, file_name)
+
+    def add_songs(self, user_id, playlist_name, songs):
+        return self.shard(user_id).add_songs(user_id, playlist_name, songs)
+
+    def songs(self, user_id, playlist_name):
+        return self.reader(user_id).songs(user_id, playlist_name)
+
+    async def search(self, user_id, words, limit, playlist_name=None):
+        return await self.reader(user_id).search(user_id, words, limit, playlist_name)
+
+    def remove_song(self, user_id, playlist_name, entry):
+        return self.shard(user_id).remove_song(user_id, playlist_name, entry)
+
+    def move_song(self, user_id, playlist_name, entry, position):
+        return self.shard(user_id).move_song(user_id, playlist_name, entry, position)
+
+    def transfer_song(self, user_id, playlist_name, entry, target_name):
+        return self.shard(user_id).transfer_song(user_id, playlist_name, entry, target_name)
+
+    def shuffle_playlist(self, user_id, playlist_name):
+        return self.shard(user_id).shuffle_playlist(user_id, playlist_name)
+
+    def save_job(self, job):
+        return self.shard(job["user"]).save_job(job)
+
+    def finish_job(self, user_id, job_id):
+        return self.shard(user_id).finish_job(user_id, job_id)
+
+    def fsm_entry(self, user_id, key):
+        return self.shard(user_id).fsm_entry(user_id, key)
+
+    def set_fsm(self, user_id, key, state, data, expires):
+        return self.shard(user_id).set_fsm(user_id, key, state, data, expires)
+
+    def subscribe(self, user_id, token, chat_id):
+        return self.shard(user_id).subscribe(user_id, token, chat_id)
+
+    def unsubscribe(self, user_id, token):
+        return self.shard(user_id).unsubscribe(user_id, token)
+
+    def drop_subscribers(self, token):
+        # Only the owned shards; the other workers drop theirs
+        for shard in self.shards.values():
+            shard.drop_subscribers(token)
+
+    def subscribed(self, user_id, token):
+        return user_id in self.reader(user_id).subscribers(token)
+
+    def subscribers(self, token):
+        # Every subscriber of a share link, from every shard
+        subscribers = {}
+        for shard in self.all_readers():
+            subscribers.update(shard.subscribers(token))
+        return subscribers
+
+    def send_jobs(self):
+        return [job for shard in self.shards.values() for job in shard.send_jobs()]
+
+    def start(self):
+        for shard in self.shards.values():
+            shard.start()
+        if self.count != self.target and self._reshard is None:
+            if self.target % self.workers:
+                logging.error(f"Not resharding to {self.target}: it can't be split across {self.workers} workers")
+            else:
+                self._reshard = asyncio.create_task(self.reshard(self.target))
+
+    async def reshard(self, count):
+        # Moves the owned users from self.count shards to `count` shards while serving:
+        # 1. checkpoint the old shards and split their record files into new ones (thread)
+        # 2. replay what the old journals gained meanwhile onto the new shards
+        # 3. with the old writers held, replay the last few records and switch over
+        #    without yielding to the loop, so no handler sees a half-moved user
+        # 4. persist the new shards, record the layout, then remove the old files
+        loop = asyncio.get_running_loop()
+        old = dict(self.shards)
+        old_count = self.count
+        started = time.perf_counter()
+        logging.info(f"Resharding {self.path} from {old_count} to {count} shards")
+
+        new = {}
+        held = []
+        for shard in old.values():
+            shard.hold_compaction = True
+        try:
+            for shard in old.values():
+                await shard.checkpoint()
+            new = {index: self._open(index, count) for index in range(count) if self.owns(index)}
+            seqs = await loop.run_in_executor(
+                None, split_records, {index: shard.path for index, shard in old.items()},
+                {index: shard.path for index, shard in new.items()}, count,
+            )
+            for shard in new.values():
+                await loop.run_in_executor(None, shard.load)
+            offsets = dict.fromkeys(old, 0)
+
+            def replay(records):
+                for record in records:
+                    target = self._reshard_target(record, new, count)
+                    if target is not None:
+                        op = dict(record)
+                        del op["seq"]
+                        target._commit(op)
+
+            def read_tail(index):
+                records = []
+                for record, offsets[index] in read_journal(old[index].journal_path, offsets[index]):
+                    if record["seq"] > seqs[index]:
+                        records.append(record)
+                return records
+
+            # Catch up in the background until little is left
+            for index, shard in old.items():
+                await shard.flush()
+                replay(await loop.run_in_executor(None, read_tail, index))
+
+            try:
+                for shard in old.values():
+                    await shard._flush_lock.acquire()
+                    held.append(shard)
+                # No awaits from here until the switch: the tail is small now
+                for index, shard in old.items():
+                    replay(read_tail(index))
+                    replay(decode_record(line) for line in shard._pending)
+                    # The old files stay complete in case we stop before the layout is written
+                    if shard._pending:
+                        shard._append("".join(shard._pending))
+                        shard._pending = []
+                self.shards = new
+                self.count = count
+                for shard in new.values():
+                    shard.start()
+            finally:
+                for shard in held:
+                    shard._flush_lock.release()
+        except BaseException:
+            for shard in old.values():
+                shard.hold_compaction = False
+            if self.shards is not new:
+                for shard in new.values():
+                    if shard._journal is not None:
+                        shard.abandon()
+            raise
+
+        # Past the switch there is no going back; finish even if we're being cancelled
+        self._finishing = asyncio.ensure_future(self._finish_reshard(old, new, count))
+        await asyncio.shield(self._finishing)
+        self.reshards += 1
+        logging.info(f"Resharded {self.path} to {count} shards in {time.perf_counter() - started:.2f}s")
+
+    def _reshard_target(self, record, new, count):
+        user_id = record_owner(record)
+        if user_id is not None:
+            return new[shard_of(user_id, count)]
+        # Records from before they carried the user: find whoever holds the token / job
+        for shard in new.values():
+            if record["op"] == "unshare" and shard.share_entry(record["token"]) is not None:
+                return shard
+            if record["op"] == "job_done" and record["id"] in shard.data["send_jobs"]:
+                return shard
+        return None
+
+    async def _finish_reshard(self, old, new, count):
+        for shard in new.values():
+            await shard.flush()
+        write_layout(self.layout_path, count)
+        for shard in old.values():
+            shard.abandon()
+            for leftover in (shard.records_path, shard.journal_path, shard.sealed_path):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    def flush_stats(self):
+        stats = {}
+        for shard in self.shards.values():
+            for key, value in shard.flush_stats().items():
+                if key == "max_batch":
+                    stats[key] = max(stats.get(key, 0), value)
+                elif isinstance(value, (int, float)):
+                    stats[key] = stats.get(key, 0) + value
+        stats["avg_batch"] = stats["flushed_mutations"] / stats["flushes"] if stats.get("flushes") else 0.0
+        stats["shards"] = len(self.shards)
+        stats["reshards"] = self.reshards
+        return stats
+
+    def cache_stats(self):
+        stats = {}
+        for shard in list(self.shards.values()) + list(self.replicas.values()):
+            for key, value in shard.cache_stats().items():
+                stats[key] = stats.get(key, 0) + value
+        return stats
+
+    def memory_stats(self):
+        stats = {}
+        for shard in list(self.shards.values()) + list(self.replicas.values()):
+            for key, value in shard.memory_stats().items():
+                stats[key] = stats.get(key, 0) + value
+        return stats
+
+    async def close(self):
+        if self._reshard is not None and not self._reshard.done():
+            self._reshard.cancel()
+            try:
+                await self._reshard
+            except asyncio.CancelledError:
+                pass
+        if self._finishing is not None:
+            await self._finishing
+        # Shards close independently: each drains its own queue and compacts its own file
+        await asyncio.gather(*(shard.close() for shard in self.shards.values()))
+        logging.info(f"Storage closed: {self.flush_stats()}, user cache: {self.cache_stats()}")
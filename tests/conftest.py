@@ -0,0 +1,139 @@
+# Handler tests drive the real dispatcher: updates are fed to Bot.dp one at a time and
+# every Bot API call lands in bench/fake_session.py's FakeSession instead of Telegram.
+# Bot.py keeps its state in module globals, so it is imported once, in a scratch
+# directory, and all tests share it; each test uses its own user ids.
+import asyncio
+import datetime
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# The repo goes first so bench scripts can't shadow the bot's modules
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN")
+os.environ["STORAGE_SHARDS"] = "1"
+os.environ.pop("WORKER_INDEX", None)
+os.environ.pop("WORKER_COUNT", None)
+os.environ["METRICS_PORT"] = "0"
+
+from aiogram import methods
+from aiogram.types import Audio, CallbackQuery, Chat, Message, Update, User
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+query_ids = itertools.count(1)
+file_ids = itertools.count(1)
+
+
+def sender(user_id):
+    return User(id=user_id, is_bot=False, first_name=f"user{user_id}")
+
+
+def message(user_id, **fields):
+    return Update(update_id=next(update_ids), message=Message(
+        message_id=next(message_ids), date=datetime.datetime.now(),
+        chat=Chat(id=user_id, type="private"), from_user=sender(user_id), **fields,
+    ))
+
+
+def audio(user_id):
+    number = next(file_ids)
+    return message(user_id, audio=Audio(
+        file_id=f"file{number}", file_unique_id=f"unique{number}", duration=1, file_name=f"song{number}.mp3",
+    ))
+
+
+def press(user_id, data):
+    return Update(update_id=next(update_ids), callback_query=CallbackQuery(
+        id=str(next(query_ids)), from_user=sender(user_id), chat_instance="tests", data=data,
+        message=Message(message_id=next(message_ids), date=datetime.datetime.now(), chat=Chat(id=user_id, type="private")),
+    ))
+
+
+class Client:
+    # One simulated user talking to the bot
+    def __init__(self, app, user_id):
+        self.app = app
+        self.user_id = user_id
+        self.queries = set()
+
+    def feed(self, update):
+        bot = self.app.Bot
+        return self.app.loop.run_until_complete(bot.dp.feed_update(bot.bot, update))
+
+    def send(self, text):
+        return self.feed(message(self.user_id, text=text))
+
+    def send_audio(self):
+        return self.feed(audio(self.user_id))
+
+    def press(self, data):
+        update = press(self.user_id, data)
+        self.queries.add(update.callback_query.id)
+        return self.feed(update)
+
+    def settle(self, seconds=1.5):
+        # Lets Add Music batches pass their debounce and get saved
+        self.app.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def state(self):
+        context = self.app.Bot.dp.fsm.get_context(self.app.Bot.bot, self.user_id, self.user_id)
+        return self.app.loop.run_until_complete(context.get_state())
+
+    def replies(self):
+        # Messages sent or edited in the user's chat and the texts of their button answers, in order
+        return [
+            call.text for call in self.app.session.calls
+            if isinstance(call, (methods.SendMessage, methods.EditMessageText)) and call.chat_id == self.user_id
+            or isinstance(call, methods.AnswerCallbackQuery) and call.callback_query_id in self.queries and call.text
+        ]
+
+
+class App:
+    def __init__(self, loop, bot_module, session):
+        self.loop = loop
+        self.Bot = bot_module
+        self.session = session
+        self.user_ids = itertools.count(1000)
+
+    def client(self):
+        client = Client(self, next(self.user_ids))
+        client.send("/start")
+        return client
+
+
+@pytest.fixture(scope="session")
+def app():
+    os.chdir(tempfile.mkdtemp(prefix="playlist-tests-"))
+    import ratelimit
+
+    # Outbound throttling is not what the handler tests check
+    ratelimit.GLOBAL_RATE = ratelimit.PRIVATE_CHAT_RATE = 1e9
+
+    import Bot
+    from fake_session import FakeSession, install
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    session = FakeSession()
+    install(Bot.bot, session)
+    Bot.dp.include_router(Bot.router)
+
+    async def start():
+        Bot.store.start()
+
+    async def stop():
+        await Bot.bulk_add.shutdown()
+        await Bot.broadcasts.shutdown()
+        await Bot.jobs.shutdown()
+        await Bot.store.close()
+
+    loop.run_until_complete(start())
+    yield App(loop, Bot, session)
+    loop.run_until_complete(stop())
+    loop.close()
@@ -0,0 +1,61 @@
+from callbacks import FINISH_ADD, SELECT_PLAYLIST, SONGS_PAGE, VIEW_PLAYLIST, encode
+
+
+def make_playlists(app, client, *names):
+    user_id = str(client.user_id)
+    for name in names:
+        client.send("➕ Create Playlist")
+        client.send(name)
+    return [app.Bot.store.playlist_id(user_id, name) for name in names]
+
+
+def test_burst_is_saved_as_one_batch(app):
+    client = app.client()
+    user_id = str(client.user_id)
+    (rock,) = make_playlists(app, client, "Rock")
+
+    client.press(encode(SELECT_PLAYLIST, rock, 0))
+    for _ in range(3):
+        client.send_audio()
+    client.settle()
+    assert client.replies()[-1] == "✅ Added 3 songs to <b>Rock</b>.\nSend more, or tap ✅ Done."
+    assert client.state() == "Form:audio"
+
+    client.press(encode(FINISH_ADD, rock, 0))
+    assert len(app.Bot.store.songs(user_id, "Rock")) == 3
+    assert client.replies()[-1] == "✅ Done. 3 songs added to <b>Rock</b>."
+    assert client.state() is None
+
+
+def test_session_keeps_its_playlist_while_browsing(app):
+    client = app.client()
+    user_id = str(client.user_id)
+    rock, jazz = make_playlists(app, client, "Rock", "Jazz")
+    app.Bot.store.add_songs(user_id, "Jazz", [("jazz1", "jazzfile1", "jazz.mp3")])
+
+    client.press(encode(SELECT_PLAYLIST, rock, 0))
+    client.send_audio()
+    client.send_audio()
+    client.press(encode(VIEW_PLAYLIST, jazz, 0))
+    client.press(encode(SONGS_PAGE, jazz, 0))
+    client.send_audio()
+    client.settle()
+    client.press(encode(FINISH_ADD, rock, 0))
+
+    assert len(app.Bot.store.songs(user_id, "Rock")) == 3
+    assert len(app.Bot.store.songs(user_id, "Jazz")) == 1
+    assert client.replies()[-1] == "✅ Done. 3 songs added to <b>Rock</b>."
+    assert client.state() is None
+
+
+def test_browsing_outside_a_session_stores_no_state(app):
+    client = app.client()
+    user_id = str(client.user_id)
+    (jazz,) = make_playlists(app, client, "Jazz")
+    app.Bot.store.add_songs(user_id, "Jazz", [("jazz2", "jazzfile2", "jazz.mp3")])
+
+    client.press(encode(VIEW_PLAYLIST, jazz, 0))
+    client.press(encode(SONGS_PAGE, jazz, 0))
+
+    key = app.Bot.dp.fsm.get_context(app.Bot.bot, client.user_id, client.user_id).key
+    assert app.loop.run_until_complete(app.Bot.dp.storage.get_data(key)) == {}
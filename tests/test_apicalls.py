@@ -0,0 +1,90 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.methods import AnswerCallbackQuery, GetChat, GetMe, SendMessage
+
+from apicalls import CallSaver
+
+bot = SimpleNamespace(id=1)
+
+
+class FakeApi:
+    # Counts the requests that reach it; each takes a moment so concurrent calls overlap
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+
+    async def __call__(self, bot, method):
+        self.calls.append(method)
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise TelegramNetworkError(method, "down")
+        return f"result {len(self.calls)}"
+
+
+def test_get_me_is_answered_from_the_cache():
+    api, saver = FakeApi(), CallSaver()
+
+    async def scenario():
+        return [await saver(api, bot, GetMe()) for _ in range(3)]
+
+    assert asyncio.run(scenario()) == ["result 1"] * 3
+    assert len(api.calls) == 1
+    assert saver.stats()["cached"] == 2
+
+
+def test_a_failed_refresh_keeps_the_cached_answer():
+    api, saver = FakeApi(), CallSaver(cached={"getMe": 0})
+
+    async def scenario():
+        first = await saver(api, bot, GetMe())
+        api.fail = True
+        return first, await saver(api, bot, GetMe())
+
+    assert asyncio.run(scenario()) == ("result 1", "result 1")
+    assert len(api.calls) == 2
+
+
+def test_a_second_answer_to_a_callback_query_is_dropped():
+    api, saver = FakeApi(), CallSaver()
+
+    async def scenario():
+        await saver(api, bot, AnswerCallbackQuery(callback_query_id="q1", text="Done"))
+        return await saver(api, bot, AnswerCallbackQuery(callback_query_id="q1", text="Again"))
+
+    assert asyncio.run(scenario()) is True
+    assert [method.text for method in api.calls] == ["Done"]
+
+
+def test_identical_reads_in_flight_share_one_request():
+    api, saver = FakeApi(), CallSaver()
+
+    async def scenario():
+        return await asyncio.gather(*(saver(api, bot, GetChat(chat_id=42)) for _ in range(5)))
+
+    assert asyncio.run(scenario()) == ["result 1"] * 5
+    assert len(api.calls) == 1
+    assert saver.stats()["coalesced"] == 4
+
+
+def test_writes_are_never_shared():
+    api, saver = FakeApi(), CallSaver()
+
+    async def scenario():
+        await asyncio.gather(*(saver(api, bot, SendMessage(chat_id=42, text="hi")) for _ in range(2)))
+
+    asyncio.run(scenario())
+    assert len(api.calls) == 2
+
+
+def test_followers_see_the_leaders_error():
+    api, saver = FakeApi(), CallSaver()
+    api.fail = True
+
+    async def scenario():
+        return await asyncio.gather(*(saver(api, bot, GetChat(chat_id=42)) for _ in range(2)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, TelegramNetworkError) for result in results)
+    assert len(api.calls) == 1
@@ -0,0 +1,139 @@
+import asyncio
+
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import SendMessage
+from aiohttp import web
+
+import webhook
+from broadcast import Broadcaster
+from storage import ShardedStore, shard_of
+from webhook import Peers, update_app
+
+
+class BlockedBot:
+    # Every subscriber has blocked the bot
+    async def send_message(self, chat_id, text, **kwargs):
+        raise TelegramForbiddenError(SendMessage(chat_id=chat_id, text=text), "Forbidden: bot was blocked by the user")
+
+
+def user_of_worker(worker, workers):
+    return next(str(user_id) for user_id in range(1000, 2000) if shard_of(user_id, workers) == worker)
+
+
+def open_store(tmp_path, worker, workers=2):
+    store = ShardedStore(str(tmp_path / "music_data.json"), shards=2, worker=worker, workers=workers)
+    store.load()
+    return store
+
+
+def test_adds_in_quick_succession_make_one_notice(app, monkeypatch):
+    owner, subscriber = app.client(), app.client()
+    owner_id, subscriber_id = str(owner.user_id), str(subscriber.user_id)
+    owner.send("➕ Create Playlist")
+    owner.send("Rock")
+    token = app.Bot.store.shares.share(owner_id, "Rock")
+    app.Bot.store.subscribe(subscriber_id, token, subscriber.user_id)
+    monkeypatch.setattr(app.Bot.broadcasts, "delay", 0.05)
+
+    async def add_twice():
+        app.Bot.broadcasts.added(owner_id, "Rock", [("rock1", "rockfile1", "one.mp3")])
+        app.Bot.broadcasts.added(owner_id, "Rock", [("rock2", "rockfile2", "two.mp3")])
+        await asyncio.sleep(0.3)
+
+    app.loop.run_until_complete(add_twice())
+
+    assert [text for text in subscriber.replies() if text.startswith("🔔")] == ["🔔 <b>Rock</b> has 2 new songs."]
+    assert not [text for text in owner.replies() if text.startswith("🔔")]
+
+
+def test_blocked_subscriber_is_unsubscribed(tmp_path):
+    store = ShardedStore(str(tmp_path / "music_data.json"), shards=1)
+    store.load()
+    store.add_user("2")
+    store.subscribe("2", "abcdefgh", 2)
+
+    async def notify():
+        broadcasts = Broadcaster(BlockedBot(), store)
+        await broadcasts._notify("2", 2, "abcdefgh", "Rock", [])
+        await store.close()
+        return broadcasts.counters["pruned"]
+
+    assert asyncio.run(notify()) == 1
+    reopened = ShardedStore(str(tmp_path / "music_data.json"), shards=1)
+    reopened.load()
+    assert reopened.subscribers("abcdefgh") == {}
+
+
+def test_deleting_a_playlist_drops_its_subscriptions(tmp_path):
+    store = ShardedStore(str(tmp_path / "music_data.json"), shards=2)
+    store.load()
+    store.add_user("1")
+    store.create_playlist("1", "Rock")
+    token = store.shares.share("1", "Rock")
+    for user_id in ("2", "3", "4"):
+        store.add_user(user_id)
+        store.subscribe(user_id, token, int(user_id))
+
+    async def delete():
+        tokens = store.shares.tokens("1", "Rock")
+        store.delete_playlist("1", "Rock")
+        await Broadcaster(BlockedBot(), store).forget(tokens)
+        await store.close()
+
+    asyncio.run(delete())
+    reopened = ShardedStore(str(tmp_path / "music_data.json"), shards=2)
+    reopened.load()
+    assert reopened.subscribers(token) == {}
+
+
+def test_blocked_subscriber_in_another_workers_shard_is_unsubscribed_by_its_owner(tmp_path, monkeypatch):
+    subscriber = user_of_worker(1, 2)
+    token = "abcdefgh"
+
+    async def scenario():
+        worker1 = open_store(tmp_path, 1)
+        worker1.add_user(subscriber)
+        worker1.subscribe(subscriber, token, 42)
+        for shard in worker1.shards.values():
+            await shard.flush()
+
+        runner = web.AppRunner(update_app(webhook.WORKER_PATH, "secret", None, Broadcaster(None, worker1).peer_request))
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(webhook, "WORKER_BASE_PORT", port - 1)
+
+        worker0 = open_store(tmp_path, 0)
+        peers = Peers(0, 2, secret="secret")
+        broadcasts = Broadcaster(BlockedBot(), worker0, peers=peers)
+        assert worker0.subscribers(token) == {subscriber: 42}
+        await broadcasts._notify(subscriber, 42, token, "Rock", [])
+
+        assert broadcasts.gone == set()
+        assert worker1.subscribers(token) == {}
+        await peers.close()
+        await runner.cleanup()
+        await worker0.close()
+        await worker1.close()
+
+    asyncio.run(scenario())
+    # The unsubscribe is in worker 1's journal, so it outlives a restart
+    assert open_store(tmp_path, 1).subscribers(token) == {}
+
+
+def test_unreachable_owner_skips_the_subscriber_until_restart(tmp_path, monkeypatch):
+    subscriber = user_of_worker(1, 2)
+
+    class DownPeers(Peers):
+        async def send(self, index, message):
+            return False
+
+    async def scenario():
+        worker0 = open_store(tmp_path, 0)
+        broadcasts = Broadcaster(BlockedBot(), worker0, peers=DownPeers(0, 2))
+        await broadcasts._notify(subscriber, 42, "abcdefgh", "Rock", [])
+        await worker0.close()
+        return broadcasts.gone
+
+    assert asyncio.run(scenario()) == {subscriber}
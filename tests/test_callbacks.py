@@ -0,0 +1,34 @@
+import base64
+
+import pytest
+
+from callbacks import CALLBACK_FORMAT, PREFIX, VIEW_PLAYLIST, decode, encode
+
+
+def test_round_trip():
+    data = encode(VIEW_PLAYLIST, 123456, 70000, 42)
+
+    assert len(data) == 17
+    assert decode(data) == (VIEW_PLAYLIST, 123456, 70000 & 0xFFFF, 42)
+
+
+@pytest.mark.parametrize("data", [
+    None,
+    "",
+    PREFIX + "=" * 16,
+    PREFIX + "A" * 12 + "=" * 4,
+    PREFIX + "!" * 16,
+    PREFIX + "A" * 15,
+    PREFIX + "A" * 17,
+    "view_playlist:Rock",
+])
+def test_malformed_data_is_rejected(data):
+    assert decode(data) is None
+
+
+def test_other_formats_are_rejected():
+    data = encode(VIEW_PLAYLIST, 1, 0)
+    raw = bytearray(base64.urlsafe_b64decode(data[1:]))
+    raw[0] = CALLBACK_FORMAT + 1
+
+    assert decode(PREFIX + base64.urlsafe_b64encode(bytes(raw)).decode()) is None
@@ -0,0 +1,39 @@
+import asyncio
+
+from aiogram.types import User
+
+from concurrency import UserOrderingMiddleware
+
+
+def run_updates(middleware, updates):
+    # updates are (user id, number) pairs fed at once; returns what the handlers saw, in order
+    events = []
+
+    async def handler(update, data):
+        events.append((update, "start"))
+        await asyncio.sleep(0.01)
+        events.append((update, "end"))
+
+    async def main():
+        await asyncio.gather(*(
+            middleware(handler, update, {"event_from_user": User(id=update[0], is_bot=False, first_name="user")})
+            for update in updates
+        ))
+
+    asyncio.run(main())
+    return events
+
+
+def test_one_users_updates_run_one_at_a_time_in_order():
+    middleware = UserOrderingMiddleware()
+    updates = [(1, number) for number in range(3)]
+    events = run_updates(middleware, updates)
+
+    assert events == [(update, step) for update in updates for step in ("start", "end")]
+    assert middleware.locks == {}
+
+
+def test_different_users_run_in_parallel():
+    events = run_updates(UserOrderingMiddleware(), [(1, 0), (2, 0)])
+
+    assert events[:2] == [((1, 0), "start"), ((2, 0), "start")]
@@ -0,0 +1,51 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from fsm import StoreStorage
+from storage import ShardedStore
+
+
+def key(user_id):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def run_fsm(tmp_path, scenario, ttl=60):
+    async def main():
+        store = ShardedStore(str(tmp_path / "music_data.json"), shards=1)
+        store.load()
+        store.start()
+        try:
+            return await scenario(store, StoreStorage(store, ttl=ttl))
+        finally:
+            await store.close()
+
+    return asyncio.run(main())
+
+
+def test_flow_survives_a_restart(tmp_path):
+    async def begin(store, storage):
+        store.add_user("1")
+        await storage.set_state(key(1), "Form:audio")
+        await storage.set_data(key(1), {"playlist_name": "Rock"})
+
+    async def resume(store, storage):
+        return await storage.get_state(key(1)), await storage.get_data(key(1))
+
+    run_fsm(tmp_path, begin)
+    assert run_fsm(tmp_path, resume) == ("Form:audio", {"playlist_name": "Rock"})
+
+
+def test_reads_add_nothing_and_expired_flows_read_as_empty(tmp_path):
+    async def scenario(store, storage):
+        store.add_user("1")
+        pending = len(store.shards[0]._pending)
+        assert await storage.get_state(key(1)) is None
+        await storage.set_state(key(1), None)
+        assert len(store.shards[0]._pending) == pending
+
+        await storage.set_state(key(1), "Form:audio")
+        await asyncio.sleep(0.05)
+        return await storage.get_state(key(1))
+
+    assert run_fsm(tmp_path, scenario, ttl=0.01) is None
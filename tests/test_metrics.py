@@ -0,0 +1,27 @@
+from metrics import Registry
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.histogram("x_seconds", "X", ("method",), buckets=(0.1, 1.0))
+    latency.observe(0.05, "sendMessage")
+    latency.observe(0.5, "sendMessage")
+    latency.observe(5, "sendMessage")
+
+    lines = registry.render().splitlines()
+    assert 'playlist_bot_x_seconds_bucket{method="sendMessage",le="0.1"} 1' in lines
+    assert 'playlist_bot_x_seconds_bucket{method="sendMessage",le="1.0"} 2' in lines
+    assert 'playlist_bot_x_seconds_bucket{method="sendMessage",le="+Inf"} 3' in lines
+    assert 'playlist_bot_x_seconds_count{method="sendMessage"} 3' in lines
+
+
+def test_routed_handlers_are_timed_under_their_own_name(app):
+    client = app.client()
+    client.send("➕ Create Playlist")
+    client.send("Metrics")
+
+    text = app.Bot.metrics.render()
+    assert 'playlist_bot_handler_seconds_count{handler="create_playlist_handler"}' in text
+    assert 'handler="route_text"' not in text
+    assert 'playlist_bot_api_call_seconds_count{method="sendMessage"}' in text
+    assert "playlist_bot_storage_mutations_total" in text
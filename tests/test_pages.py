@@ -0,0 +1,118 @@
+import base64
+import struct
+
+from aiogram import methods
+from aiogram.exceptions import TelegramBadRequest
+
+from callbacks import DELETE_SONG, PREFIX, SONGS_PAGE, VIEW_PLAYLIST, encode
+
+
+def last_keyboard(app, client):
+    pages = [
+        call for call in app.session.calls
+        if isinstance(call, (methods.SendMessage, methods.EditMessageText)) and call.chat_id == client.user_id
+    ]
+    return [[button.text for button in row] for row in pages[-1].reply_markup.inline_keyboard]
+
+
+def test_song_list_is_paged(app):
+    client = app.client()
+    user_id = str(client.user_id)
+    client.send("➕ Create Playlist")
+    client.send("Rock")
+    for number in range(25):
+        app.Bot.store.add_song(user_id, "Rock", f"unique-rock{number}", f"rock{number}", f"rock{number}.mp3")
+
+    playlist_id = app.Bot.store.playlist_id(user_id, "Rock")
+    client.press(encode(VIEW_PLAYLIST, playlist_id, 0))
+    assert client.replies()[-1] == "Songs in <b>Rock</b>:"
+    rows = last_keyboard(app, client)
+    assert rows[1][0] == "🎵 1. rock0.mp3"
+    assert ["1/3", "▶️"] in rows
+
+    client.press(encode(SONGS_PAGE, playlist_id, 0, 2))
+    rows = last_keyboard(app, client)
+    assert [row[0] for row in rows[1:-2]] == [f"🎵 {number}. rock{number - 1}.mp3" for number in range(21, 26)]
+    assert ["◀️", "3/3"] in rows
+
+
+def test_cached_page_follows_changes(app):
+    client = app.client()
+    user_id = str(client.user_id)
+    client.send("➕ Create Playlist")
+    client.send("Jazz")
+    app.Bot.store.add_song(user_id, "Jazz", "unique-jazz0", "jazz0", "jazz0.mp3")
+
+    playlist_id = app.Bot.store.playlist_id(user_id, "Jazz")
+    client.press(encode(VIEW_PLAYLIST, playlist_id, 0))
+    app.Bot.store.add_song(user_id, "Jazz", "unique-jazz1", "jazz1", "jazz1.mp3")
+    client.press(encode(SONGS_PAGE, playlist_id, 0, 0))
+    rows = last_keyboard(app, client)
+    assert [row[0] for row in rows[1:-1]] == ["🎵 1. jazz0.mp3", "🎵 2. jazz1.mp3"]
+
+
+def test_names_are_escaped(app):
+    client = app.client()
+    user_id = str(client.user_id)
+    client.send("➕ Create Playlist")
+    client.send("Rock & <Roll>")
+    assert client.replies()[-1] == "Playlist <b>Rock &amp; &lt;Roll&gt;</b> created!"
+    app.Bot.store.add_song(user_id, "Rock & <Roll>", "unique-escaped1", "escaped1", "<b>loud</b>.mp3")
+
+    client.press(encode(VIEW_PLAYLIST, app.Bot.store.playlist_id(user_id, "Rock & <Roll>"), 0))
+    assert client.replies()[-1] == "Songs in <b>Rock &amp; &lt;Roll&gt;</b>:"
+
+
+def test_page_that_cannot_be_parsed_is_sent_as_plain_text(app, monkeypatch):
+    client = app.client()
+    user_id = str(client.user_id)
+    client.send("➕ Create Playlist")
+    client.send("Blues")
+    app.Bot.store.add_song(user_id, "Blues", "unique-plain1", "plain1", "blues.mp3")
+    make_request = app.session.make_request
+
+    async def reject_edits(bot, method, timeout=None):
+        if isinstance(method, methods.EditMessageText):
+            raise TelegramBadRequest(method, "Bad Request: can't parse entities")
+        return await make_request(bot, method, timeout)
+
+    monkeypatch.setattr(app.session, "make_request", reject_edits)
+    client.press(encode(VIEW_PLAYLIST, app.Bot.store.playlist_id(user_id, "Blues"), 0))
+
+    sent = [call for call in app.session.calls if isinstance(call, methods.SendMessage) and call.chat_id == client.user_id]
+    assert sent[-1].text == "Songs in <b>Blues</b>:"
+    assert sent[-1].parse_mode is None
+
+
+def test_song_button_follows_its_song(app):
+    client = app.client()
+    user_id = str(client.user_id)
+    client.send("➕ Create Playlist")
+    client.send("Folk")
+    app.Bot.store.add_song(user_id, "Folk", "unique-folk0", "folk0", "folk0.mp3")
+    app.Bot.store.add_song(user_id, "Folk", "unique-folk1", "folk1", "folk1.mp3")
+    playlist_id = app.Bot.store.playlist_id(user_id, "Folk")
+    (first, _), (second, _) = app.Bot.store.songs(user_id, "Folk").page(0, 2)
+    app.Bot.store.remove_song(user_id, "Folk", first)
+
+    client.press(encode(DELETE_SONG, playlist_id, 0, second))
+    assert client.replies()[-1] == "✅ Song <b>folk1.mp3</b> deleted from <b>Folk</b>!"
+    client.press(encode(DELETE_SONG, playlist_id, 0, second))
+    assert client.replies()[-1] == "This song is no longer in the playlist."
+
+
+def test_outdated_buttons_are_not_acted_on(app):
+    client = app.client()
+    user_id = str(client.user_id)
+    client.send("➕ Create Playlist")
+    client.send("Soul")
+    app.Bot.store.add_song(user_id, "Soul", "unique-soul0", "soul0", "soul0.mp3")
+    # A song button from before entry ids, which carried a position
+    raw = struct.pack(">BBIHI", 1, DELETE_SONG, app.Bot.store.playlist_id(user_id, "Soul"), 0, 1)
+
+    client.press(PREFIX + base64.urlsafe_b64encode(raw).decode())
+    assert client.replies()[-1] == "This menu is out of date. Open 🎶 My Playlists again."
+    assert len(app.Bot.users_music[user_id]["Soul"]) == 1
+
+    client.press("view_playlist:Soul")
+    assert client.replies()[-1] == "This menu is out of date. Open 🎶 My Playlists again."
@@ -0,0 +1,33 @@
+def test_profiler_switches_and_reports(app, monkeypatch):
+    client = app.client()
+    monkeypatch.setattr(app.Bot, "ADMIN_IDS", {str(client.user_id)})
+    monkeypatch.setattr(app.Bot.profiler, "enabled", True)
+    monkeypatch.setattr(app.Bot.profiler, "threshold", app.Bot.profiler.threshold)
+
+    client.send("/profiler off 5")
+
+    assert not app.Bot.profiler.enabled
+    assert app.Bot.profiler.threshold == 5
+    assert client.replies()[-1].startswith("Profiler is off, threshold 5s.")
+    assert "worker" not in client.replies()[-1]
+
+
+def test_profiler_says_it_only_switches_its_own_worker(app, monkeypatch):
+    client = app.client()
+    monkeypatch.setattr(app.Bot, "ADMIN_IDS", {str(client.user_id)})
+    monkeypatch.setattr(app.Bot, "WORKER_INDEX", 1)
+    monkeypatch.setattr(app.Bot, "WORKER_COUNT", 4)
+    monkeypatch.setattr(app.Bot.profiler, "enabled", True)
+
+    client.send("/profiler off")
+
+    assert client.replies()[-1].endswith("This only affects webhook worker 1 of 4; "
+                                         "PROFILER and SLOW_UPDATE_SECONDS set every worker at startup.")
+
+
+def test_profiler_ignores_other_users(app):
+    client = app.client()
+    client.send("/profiler off")
+
+    assert app.Bot.profiler.enabled
+    assert not client.replies()[-1].startswith("Profiler")
@@ -0,0 +1,103 @@
+import asyncio
+import time
+
+from aiogram.methods import GetMe, SendAudio, SendMediaGroup, SendMessage
+from aiogram.types import InputMediaAudio
+
+import ratelimit
+
+
+def test_interactive_replies_go_before_queued_bulk_sends(monkeypatch):
+    monkeypatch.setattr(ratelimit, "GLOBAL_RATE", 10)
+    limiter = ratelimit.RateLimiter()
+    limiter.global_bucket.tokens = 0
+    sent = []
+
+    async def make_request(bot, method):
+        sent.append(type(method).__name__)
+
+    async def send():
+        bulk = [asyncio.create_task(limiter(make_request, None, SendAudio(chat_id=chat_id, audio="file"))) for chat_id in range(3)]
+        await asyncio.sleep(0)
+        reply = asyncio.create_task(limiter(make_request, None, SendMessage(chat_id=42, text="reply")))
+        await asyncio.gather(*bulk, reply)
+
+    asyncio.run(send())
+    assert sent == ["SendMessage", "SendAudio", "SendAudio", "SendAudio"]
+
+
+def album(chat_id, size):
+    return SendMediaGroup(chat_id=chat_id, media=[InputMediaAudio(media=f"file{i}") for i in range(size)])
+
+
+def test_album_costs_a_token_per_message(monkeypatch):
+    monkeypatch.setattr(ratelimit, "GLOBAL_RATE", 30)
+    limiter = ratelimit.RateLimiter()
+
+    async def make_request(bot, method):
+        return True
+
+    async def send():
+        await limiter(make_request, None, album(42, 10))
+
+    asyncio.run(send())
+    # Refills during the call are far below one token
+    assert round(limiter.global_bucket.tokens) == 20
+    assert round(limiter.chat_buckets[42].tokens) == ratelimit.CHAT_BURST - 10
+
+
+def test_album_waits_for_the_chat_limit(monkeypatch):
+    monkeypatch.setattr(ratelimit, "PRIVATE_CHAT_RATE", 10)
+    limiter = ratelimit.RateLimiter()
+
+    async def make_request(bot, method):
+        return True
+
+    async def send():
+        await limiter(make_request, None, album(42, 10))
+        started = time.monotonic()
+        await limiter(make_request, None, SendMessage(chat_id=42, text="after the album"))
+        return time.monotonic() - started
+
+    # The album left the chat 7 tokens in debt: the next message waits for 8 to come back
+    assert asyncio.run(send()) >= 0.7
+
+
+async def requests_in(limiters, seconds):
+    # Every limiter sends as fast as it is allowed to; returns how many got through
+    sent = 0
+
+    async def make_request(bot, method):
+        nonlocal sent
+        sent += 1
+
+    async def flood(limiter):
+        while True:
+            await limiter(make_request, None, GetMe())
+
+    tasks = [asyncio.create_task(flood(limiter)) for limiter in limiters]
+    await asyncio.sleep(seconds)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return sent
+
+
+def test_workers_share_the_global_limit(monkeypatch):
+    monkeypatch.setattr(ratelimit, "GLOBAL_RATE", 30)
+    workers = 3
+    limiters = [ratelimit.RateLimiter(workers=workers) for _ in range(workers)]
+
+    assert sum(limiter.global_bucket.rate for limiter in limiters) == 30
+    started = time.monotonic()
+    sent = asyncio.run(requests_in(limiters, 1))
+    # One full bucket plus a second's worth of tokens, as a single process would get
+    assert sent <= 30 + 30 * (time.monotonic() - started) + workers
+
+
+def test_single_process_keeps_the_full_limit(monkeypatch):
+    monkeypatch.setattr(ratelimit, "GLOBAL_RATE", 30)
+    limiter = ratelimit.RateLimiter()
+
+    assert limiter.global_bucket.rate == 30
+    assert limiter.global_bucket.capacity == 30
@@ -0,0 +1,23 @@
+def test_menu_button_preempts_a_flow(app):
+    client = app.client()
+    client.send("➕ Create Playlist")
+    client.send("🎶 My Playlists")
+
+    assert client.replies()[-1] == "You don't have any playlists."
+
+
+def test_prefix_route_is_the_text_a_flow_asked_for(app):
+    client = app.client()
+    client.send("➕ Create Playlist")
+    client.send("playlist_rock")
+
+    assert client.replies()[-1] == "Playlist <b>playlist_rock</b> created!"
+    assert "playlist_rock" in app.Bot.users_music[str(client.user_id)]
+    assert client.state() is None
+
+
+def test_prefix_route_outside_a_flow(app):
+    client = app.client()
+    client.send("playlist_nosuchlink")
+
+    assert client.replies()[-1] == "Playlist not found."
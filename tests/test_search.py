@@ -0,0 +1,155 @@
+import asyncio
+
+from search import search_library
+from storage import ShardReplica, ShardedStore
+
+
+def run_store(tmp_path, scenario, **options):
+    async def main():
+        store = ShardedStore(str(tmp_path / "music_data.json"), shards=1, **options)
+        store.load()
+        store.start()
+        try:
+            await scenario(store, store.shards[0])
+        finally:
+            await store.close()
+
+    asyncio.run(main())
+
+
+async def names(store, user_id, text, playlist_name=None):
+    return sorted(song.file_name for _, song in await store.search(user_id, text.split(), 50, playlist_name))
+
+
+def test_every_word_matches_and_the_last_as_a_prefix(tmp_path):
+    async def scenario(store, shard):
+        store.add_user("1")
+        store.create_playlist("1", "rock")
+        store.create_playlist("1", "drive")
+        store.add_song("1", "rock", "a", "file-a", "Thunder Road.mp3")
+        store.add_song("1", "rock", "b", "file-b", "Road Trip.mp3")
+        store.add_song("1", "drive", "c", "file-c", "Thunderstruck.mp3")
+        assert await names(store, "1", "thunder") == ["Thunder Road.mp3", "Thunderstruck.mp3"]
+        assert await names(store, "1", "road thu") == ["Thunder Road.mp3"]
+        assert await names(store, "1", "thunder", "drive") == ["Thunderstruck.mp3"]
+        assert await names(store, "1", "jazz") == []
+
+    run_store(tmp_path, scenario)
+
+
+def test_opened_shares_are_searched_after_the_users_own_songs(tmp_path):
+    async def scenario(store, shard):
+        store.add_user("1")
+        store.add_user("2")
+        for playlist_name in ("shared", "private"):
+            store.create_playlist("1", playlist_name)
+            store.add_song("1", playlist_name, playlist_name, f"file-{playlist_name}", f"Night {playlist_name}.mp3")
+        store.create_playlist("2", "mine")
+        store.add_song("2", "mine", "own", "file-own", "Night own.mp3")
+        store.shares.opened("2", store.shares.share("1", "shared"))
+        page, next_offset = await search_library(store, "2", "night")
+        assert [song.file_name for _, song in page] == ["Night own.mp3", "Night shared.mp3"]
+        assert next_offset is None
+
+    run_store(tmp_path, scenario)
+
+
+def test_index_follows_changes(tmp_path):
+    async def scenario(store, shard):
+        store.add_user("1")
+        store.create_playlist("1", "rock")
+        store.add_song("1", "rock", "a", "file-a", "Thunder Road.mp3")
+        store.add_song("1", "rock", "b", "file-b", "Road Trip.mp3")
+        await shard.checkpoint()
+        assert await names(store, "1", "road") == ["Road Trip.mp3", "Thunder Road.mp3"]
+        index = shard.index
+
+        store.remove_song("1", "rock", 1)
+        store.add_song("1", "rock", "c", "file-c", "Back Road.mp3")
+        assert await names(store, "1", "ro") == ["Back Road.mp3", "Road Trip.mp3"]
+        store.delete_playlist("1", "rock")
+        assert await names(store, "1", "road") == []
+        # Kept up to date in place, never rebuilt
+        assert shard.index is index and len(index) == 0
+
+    run_store(tmp_path, scenario)
+
+
+def test_index_outlives_evictions(tmp_path):
+    async def scenario(store, shard):
+        for user_id in ("1", "2", "3"):
+            store.add_user(user_id)
+            store.create_playlist(user_id, "mix")
+            store.add_song(user_id, "mix", f"song{user_id}", f"file{user_id}", f"Song {user_id}.mp3")
+        await shard.checkpoint()
+        assert await names(store, "1", "song") == ["Song 1.mp3"]
+        index = shard.index
+        for user_id in ("2", "3"):
+            assert await names(store, user_id, "song") == [f"Song {user_id}.mp3"]
+        assert "1" not in shard.lru["u"]
+        assert await names(store, "1", "so") == ["Song 1.mp3"]
+        assert shard.index is index
+
+    run_store(tmp_path, scenario, cache_users=1)
+
+
+def test_build_catches_up_with_changes_made_meanwhile(tmp_path):
+    async def scenario(store, shard):
+        store.add_user("1")
+        store.create_playlist("1", "mix")
+        store.add_song("1", "mix", "a", "file-a", "Early Bird.mp3")
+        store.add_song("1", "mix", "b", "file-b", "Early Riser.mp3")
+        await shard.checkpoint()
+        # Not yet in the record file when the build starts
+        store.add_song("1", "mix", "c", "file-c", "Early Hours.mp3")
+        searching = asyncio.ensure_future(names(store, "1", "early"))
+        await asyncio.sleep(0)
+        assert shard.index is None
+        store.remove_song("1", "mix", 1)
+        store.add_song("1", "mix", "d", "file-d", "Early Days.mp3")
+        await searching
+        assert await names(store, "1", "early") == ["Early Days.mp3", "Early Hours.mp3", "Early Riser.mp3"]
+        assert sorted(shard.index.entries) == ["b", "c", "d"]
+
+    run_store(tmp_path, scenario)
+
+
+def test_shared_playlist_search_stays_in_the_playlist(tmp_path):
+    async def scenario(store, shard):
+        store.add_user("1")
+        store.add_user("2")
+        for playlist_name in ("shared", "private"):
+            store.create_playlist("1", playlist_name)
+            store.add_song("1", playlist_name, playlist_name, f"file-{playlist_name}", f"Night {playlist_name}.mp3")
+        store.shares.opened("2", store.shares.share("1", "shared"))
+        page, _ = await search_library(store, "2", "night")
+        assert [song.file_name for _, song in page] == ["Night shared.mp3"]
+        # Only the shared playlist's songs were looked at, not the owner's whole library
+        assert "1" not in shard.libraries
+
+    run_store(tmp_path, scenario)
+
+
+def test_replica_rebuilds_its_index_after_a_compaction(tmp_path):
+    async def scenario(store, shard):
+        store.add_user("1")
+        store.create_playlist("1", "mix")
+        store.add_song("1", "mix", "a", "file-a", "Blue Moon.mp3")
+        await shard.checkpoint()
+        replica = ShardReplica(shard.path)
+        assert await names(replica.refresh(), "1", "blue") == ["Blue Moon.mp3"]
+        index = replica.index
+
+        # Changes the replica never reads from a journal, only from the new record file
+        store.remove_song("1", "mix", 1)
+        store.add_song("1", "mix", "b", "file-b", "Blue Sky.mp3")
+        await shard.checkpoint()
+        replica.refresh()
+        assert replica.index_stale
+        # The old index answers until its replacement is ready
+        assert await names(replica, "1", "blue") == []
+        await replica._indexing
+        assert replica.index is not index and not replica.index_stale
+        assert await names(replica, "1", "blue") == ["Blue Sky.mp3"]
+
+    run_store(tmp_path, scenario)
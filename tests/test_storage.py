@@ -0,0 +1,163 @@
+import asyncio
+import json
+
+import pytest
+
+from storage import LEGACY_PLAYLIST, ShardedStore
+
+
+def run_store(tmp_path, scenario, **options):
+    async def main():
+        store = ShardedStore(str(tmp_path / "music_data.json"), shards=1, **options)
+        store.load()
+        store.start()
+        await scenario(store)
+        # close() cancels the flush loop; it must not wait for that forever
+        closing = asyncio.ensure_future(store.close())
+        done, _ = await asyncio.wait((closing,), timeout=5)
+        assert done, "close() is stuck waiting for the flush loop"
+
+    asyncio.run(main())
+    reopened = ShardedStore(str(tmp_path / "music_data.json"), shards=1)
+    reopened.load()
+    return reopened
+
+
+def test_close_while_idle(tmp_path):
+    async def idle(store):
+        store.add_user("1")
+        await asyncio.sleep(0.1)
+
+    reopened = run_store(tmp_path, idle, max_latency=0.01)
+    assert reopened.users["1"] == {}
+
+
+def test_close_as_a_batch_fills(tmp_path):
+    async def filling(store):
+        await asyncio.sleep(0)
+        store.add_user("1")
+        # The flush loop is waiting for the batch; now it is full and the cancel arrives together
+        await asyncio.sleep(0)
+        store.add_user("2")
+
+    reopened = run_store(tmp_path, filling, max_latency=60, max_batch=2)
+    assert reopened.users["2"] == {}
+
+
+def test_resharding_keeps_every_user(tmp_path):
+    path = str(tmp_path / "music_data.json")
+
+    async def main():
+        store = ShardedStore(path, shards=1)
+        store.load()
+        store.start()
+        for user_id in map(str, range(20)):
+            store.add_user(user_id)
+            store.create_playlist(user_id, "Rock")
+        await store.close()
+
+        store = ShardedStore(path, shards=4)
+        store.load()
+        store.start()
+        # Changes made while the users are being moved
+        store.create_playlist("3", "Jazz")
+        await store._reshard
+        store.create_playlist("5", "Jazz")
+        await store.close()
+
+    asyncio.run(main())
+    reopened = ShardedStore(path, shards=4)
+    reopened.load()
+    assert reopened.count == 4
+    assert {user_id: list(reopened.users[user_id]) for user_id in map(str, range(20))} == {
+        user_id: ["Rock", "Jazz"] if user_id in ("3", "5") else ["Rock"] for user_id in map(str, range(20))
+    }
+
+
+def test_evicted_users_are_read_back_from_the_record_file(tmp_path):
+    async def many_users(store):
+        shard = store.shards[0]
+        for user_id in map(str, range(10)):
+            store.add_user(user_id)
+            store.create_playlist(user_id, f"Rock {user_id}")
+        # Changed users stay pinned until a compaction has written them
+        assert shard.cache_stats()["pinned"] == 10
+        await shard.checkpoint()
+        assert shard.cache_stats()["cached"] == 2
+
+        assert [list(store.users[user_id]) for user_id in map(str, range(10))] == [
+            [f"Rock {user_id}"] for user_id in range(10)
+        ]
+        assert shard.cache_stats()["cached"] == 2
+        assert shard.cache_stats()["evictions"] >= 10
+
+    reopened = run_store(tmp_path, many_users, cache_users=2)
+    assert list(reopened.users["7"]) == ["Rock 7"]
+
+
+def test_a_song_is_stored_once_per_shard(tmp_path):
+    async def shared_song(store):
+        for user_id in ("1", "2"):
+            store.add_user(user_id)
+            store.create_playlist(user_id, "Rock")
+            assert store.add_song(user_id, "Rock", "unique1", "file1", "song.mp3")
+        assert not store.add_song("1", "Rock", "unique1", "file1", "song.mp3")
+        assert store.shards[0].song("unique1").refs == 2
+
+        store.delete_playlist("1", "Rock")
+        assert store.shards[0].song("unique1").refs == 1
+        (entry, _), = store.songs("2", "Rock").page(0, 1)
+        store.remove_song("2", "Rock", entry)
+        assert store.shards[0].song("unique1") is None
+
+    run_store(tmp_path, shared_song)
+
+
+def test_song_order_changes_are_replayed(tmp_path):
+    orders = {}
+
+    def names(store, playlist_name):
+        songs = store.songs("1", playlist_name)
+        return [song.file_name for _, song in songs.page(0, len(songs))]
+
+    async def reorder(store):
+        store.add_user("1")
+        store.create_playlist("1", "Rock")
+        store.create_playlist("1", "Jazz")
+        for number in range(5):
+            store.add_song("1", "Rock", f"unique{number}", f"file{number}", f"song{number}.mp3")
+        entries = [entry for entry, _ in store.songs("1", "Rock").page(0, 5)]
+        store.remove_song("1", "Rock", entries[1])
+        store.move_song("1", "Rock", entries[4], 0)
+        store.transfer_song("1", "Rock", entries[2], "Jazz")
+        assert names(store, "Rock") == ["song4.mp3", "song0.mp3", "song3.mp3"]
+        store.shuffle_playlist("1", "Rock")
+        orders.update(Rock=names(store, "Rock"), Jazz=names(store, "Jazz"))
+
+    reopened = run_store(tmp_path, reorder)
+    assert sorted(orders["Rock"]) == ["song0.mp3", "song3.mp3", "song4.mp3"]
+    assert orders["Jazz"] == ["song2.mp3"]
+    assert {name: names(reopened, name) for name in orders} == orders
+
+
+def test_users_in_the_oldest_shape_get_a_music_playlist(tmp_path):
+    (tmp_path / "music_data.json").write_text(json.dumps({
+        "1": {"music": [{"file_id": "f1", "file_name": "one.mp3"}, {"file_id": "f2", "file_name": "two.mp3"}],
+              "unique_id": "oldlink1"},
+        "2": {"music": [], "unique_id": "oldlink2"},
+    }))
+    store = ShardedStore(str(tmp_path / "music_data.json"), shards=2)
+    store.load()
+
+    assert [song.file_name for song in store.songs("1", LEGACY_PLAYLIST)] == ["one.mp3", "two.mp3"]
+    assert store.shares.resolve("oldlink1") == ("1", LEGACY_PLAYLIST)
+    assert store.shares.resolve("oldlink2") == ("2", LEGACY_PLAYLIST)
+
+
+def test_a_snapshot_newer_than_the_code_is_refused(tmp_path):
+    (tmp_path / "music_data.json").write_text(json.dumps({"format": 99, "users": {}}))
+    store = ShardedStore(str(tmp_path / "music_data.json"), shards=1)
+
+    with pytest.raises(RuntimeError):
+        store.load()
+    assert (tmp_path / "music_data.json").exists()
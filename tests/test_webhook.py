@@ -0,0 +1,31 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from storage import shard_of
+from webhook import SECRET_HEADER, update_app, worker_of
+
+
+def test_updates_go_to_the_worker_owning_their_senders_shard():
+    message = {"update_id": 1, "message": {"message_id": 1, "from": {"id": 7}, "chat": {"id": 7}}}
+    answer = {"update_id": 2, "poll_answer": {"poll_id": "1", "user": {"id": 8}}}
+    poll = {"update_id": 3, "poll": {"id": "1"}}
+
+    assert [worker_of(update, 4) for update in (message, answer, poll)] == [shard_of(7, 4), shard_of(8, 4), 0]
+
+
+def test_update_app_checks_the_secret():
+    received = []
+
+    async def handle(update, body):
+        received.append(update["update_id"])
+
+    async def main():
+        async with TestClient(TestServer(update_app("/webhook", "secret", handle))) as client:
+            wrong = await client.post("/webhook", data=b'{"update_id": 1}', headers={SECRET_HEADER: "guess"})
+            right = await client.post("/webhook", data=b'{"update_id": 2}', headers={SECRET_HEADER: "secret"})
+            garbled = await client.post("/webhook", data=b"{", headers={SECRET_HEADER: "secret"})
+            return wrong.status, right.status, garbled.status
+
+    assert asyncio.run(main()) == (401, 200, 400)
+    assert received == [2]
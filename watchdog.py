@@ -0,0 +1,235 @@
+# Finds out why the bot "freezes". LoopMonitor measures event-loop lag all the time
+# and, from a thread, samples the loop thread's stack while the loop is stuck (a big
+# synchronous write, a CPU-bound loop). SlowUpdateProfiler samples the await chain of
+# updates that run past a threshold. Both write JSON reports to a rotating file.
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from logging.handlers import RotatingFileHandler
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from metrics import current_span
+
+# How often the loop's heartbeat is taken (and the lag with it)
+LAG_INTERVAL = 0.1
+# The loop counts as stuck once its heartbeat is this late
+STALL_SECONDS = 0.5
+# Updates slower than this get a report
+SLOW_UPDATE_SECONDS = 2.0
+# Stack samples are taken this often while an update is slow or the loop is stuck
+SAMPLE_INTERVAL = 0.05
+# Innermost frames kept per sampled stack, and distinct stacks kept per report
+TOP_FRAMES = 8
+TOP_STACKS = 5
+
+REPORT_MAX_BYTES = 5 * 1024 * 1024
+REPORT_BACKUPS = 3
+
+
+class ReportFile:
+    # One JSON object per line, rotated by size
+    def __init__(self, path, max_bytes=REPORT_MAX_BYTES, backups=REPORT_BACKUPS):
+        self.path = path
+        self.logger = logging.getLogger(f"reports.{path}")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        if not self.logger.handlers:
+            self.logger.addHandler(RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True))
+        self.written = 0
+
+    def write(self, report):
+        report = dict(report, time=round(time.time(), 3))
+        self.logger.info(json.dumps(report, ensure_ascii=False))
+        self.written += 1
+
+
+def frame_lines(frames):
+    # Innermost TOP_FRAMES of a stack (oldest first) as "file:line function"
+    summary = traceback.StackSummary.extract(((frame, frame.f_lineno) for frame in frames), lookup_lines=False)
+    return tuple(f"{entry.filename}:{entry.lineno} {entry.name}" for entry in summary[-TOP_FRAMES:])
+
+
+def top_stacks(samples):
+    return [{"samples": count, "frames": list(stack)} for stack, count in samples.most_common(TOP_STACKS)]
+
+
+class UpdateTrace:
+    __slots__ = ("kind", "user_id", "span", "started", "samples", "timer")
+
+    def __init__(self, kind, user_id, span):
+        self.kind = kind
+        self.user_id = user_id
+        self.span = span
+        self.started = time.perf_counter()
+        self.samples = Counter()
+        self.timer = None
+
+    def describe(self):
+        return {
+            "update": self.kind,
+            "user": self.user_id,
+            "handler": self.span.handler if self.span is not None else None,
+        }
+
+
+class SlowUpdateProfiler(BaseMiddleware):
+    # Inner middleware, registered after HandlerMetrics so the handler name is known.
+    # Nothing is sampled for updates that finish within the threshold; past it the
+    # update's await chain is sampled every sample_interval until it ends.
+    def __init__(self, reports, threshold=SLOW_UPDATE_SECONDS, sample_interval=SAMPLE_INTERVAL, enabled=True):
+        self.reports = reports
+        self.threshold = threshold
+        self.sample_interval = sample_interval
+        self.enabled = enabled
+        # Running task -> its UpdateTrace, so the loop monitor can tell whose code is stuck
+        self.active = {}
+        self.slow = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not self.enabled:
+            return await handler(event, data)
+        user = data.get("event_from_user")
+        trace = UpdateTrace(type(event).__name__, user.id if user else None, current_span.get())
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        self.active[task] = trace
+        trace.timer = loop.call_later(self.threshold, self._sample, task, trace)
+        try:
+            return await handler(event, data)
+        finally:
+            trace.timer.cancel()
+            del self.active[task]
+            elapsed = time.perf_counter() - trace.started
+            if elapsed >= self.threshold:
+                self.slow += 1
+                self.reports.write(dict(
+                    trace.describe(), kind="slow_update", seconds=round(elapsed, 3), stacks=top_stacks(trace.samples),
+                ))
+
+    def _sample(self, task, trace):
+        # Where the update is waiting right now (it isn't running, or this couldn't run)
+        trace.samples[frame_lines(_await_chain(task.get_coro()))] += 1
+        trace.timer = asyncio.get_running_loop().call_later(self.sample_interval, self._sample, task, trace)
+
+
+class LoopMonitor:
+    # A task wakes every interval and records how late it was (the loop lag). A daemon
+    # thread watches that heartbeat: once it is stall seconds old the loop is stuck
+    # in synchronous code, and the thread samples the loop thread's stack until it
+    # moves again. The stall is reported with the update that was running, if any.
+    def __init__(self, reports, profiler=None, histogram=None, interval=LAG_INTERVAL, stall=STALL_SECONDS,
+                 sample_interval=SAMPLE_INTERVAL):
+        self.reports = reports
+        self.profiler = profiler
+        self.histogram = histogram
+        self.interval = interval
+        self.stall = stall
+        self.sample_interval = sample_interval
+        self.beat = time.monotonic()
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self.stalls = 0
+        self._stalled = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._task = None
+        self._thread = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self._tick())
+        self._thread = threading.Thread(
+            target=self._watch, args=(loop, threading.get_ident()), name="loop-watchdog", daemon=True
+        )
+        self._thread.start()
+
+    async def _tick(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.beat = now
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if self.histogram is not None:
+                self.histogram.observe(lag)
+            with self._lock:
+                stalled, self._stalled = self._stalled, None
+            if stalled is not None:
+                self._report(stalled, lag)
+
+    def _report(self, stalled, lag):
+        self.stalls += 1
+        if self.profiler is not None and not self.profiler.enabled:
+            return
+        trace = stalled["trace"]
+        report = trace.describe() if trace is not None else {}
+        self.reports.write(dict(report, kind="stall", seconds=round(lag, 3), stacks=top_stacks(stalled["samples"])))
+
+    def _watch(self, loop, thread_id):
+        while not self._stop.wait(self.sample_interval):
+            if time.monotonic() - self.beat < self.stall + self.interval:
+                continue
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = frame_lines(_frames(frame))
+            with self._lock:
+                if self._stalled is None:
+                    # Whatever task the loop is running is the one holding it up
+                    task = asyncio.current_task(loop)
+                    trace = self.profiler.active.get(task) if self.profiler is not None else None
+                    self._stalled = {"trace": trace, "samples": Counter()}
+                self._stalled["samples"][stack] += 1
+                if self._stalled["trace"] is not None:
+                    self._stalled["trace"].samples[stack] += 1
+
+    def stats(self):
+        return {"last_lag": self.last_lag, "max_lag": self.max_lag, "stalls": self.stalls}
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def _await_chain(coro):
+    # Frames of a suspended coroutine and of everything it is awaiting, outermost first
+    # (Task.get_stack() stops at the task's own coroutine)
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return frames
+
+
+def _frames(frame):
+    # A thread's frames, oldest first
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
@@ -0,0 +1,272 @@
+# Webhook serving. Telegram POSTs each update to an aiohttp server instead of the
+# bot pulling them with getUpdates.
+#
+#   python Bot.py webhook   one process: the server feeds its own dispatcher
+#   python webhook.py       front server that shards updates by user_id across
+#                           WEBHOOK_WORKERS Bot.py processes, each owning its storage shards
+import asyncio
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+import sys
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+
+from storage import DEFAULT_SHARDS, shard_of
+
+# Where this process listens, and the public URL Telegram should call (if set, the
+# webhook is registered on startup; leave empty when a front process does that)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Front process: worker count and the local ports the workers listen on
+# The worker count must divide STORAGE_SHARDS
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+WORKER_BASE_PORT = int(os.getenv("WEBHOOK_WORKER_BASE_PORT", "8100"))
+WORKER_PATH = "/update"
+# Requests between workers, e.g. an unsubscribe for a user whose shard another worker owns
+PEER_PATH = "/peer"
+WORKER_START_TIMEOUT = 30
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Bot.py")
+
+
+def update_user_id(update):
+    # Every update kind that has a sender carries it as "from" (or "user" for poll
+    # answers) on its payload object
+    for payload in update.values():
+        if isinstance(payload, dict):
+            user = payload.get("from") or payload.get("user")
+            if user:
+                return user["id"]
+    return None
+
+
+def worker_of(update, workers):
+    # Same hash as the storage shards, so a worker's users are exactly its shards' users
+    user_id = update_user_id(update)
+    return shard_of(user_id, workers) if user_id is not None else 0
+
+
+def worker_url(index, path=WORKER_PATH):
+    return f"http://127.0.0.1:{WORKER_BASE_PORT + index}{path}"
+
+
+def update_app(path, secret, handle, peer=None):
+    # handle(update, body) is awaited before answering; raising an HTTP error there
+    # makes Telegram retry the update later. peer(message), if given, serves PEER_PATH.
+    def receiver(handle):
+        async def receive(request):
+            if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+                raise web.HTTPUnauthorized()
+            body = await request.read()
+            try:
+                update = json.loads(body)
+            except ValueError:
+                raise web.HTTPBadRequest()
+            await handle(update, body)
+            return web.Response()
+        return receive
+
+    app = web.Application()
+    app.router.add_post(path, receiver(handle))
+    if peer is not None:
+        app.router.add_post(PEER_PATH, receiver(lambda message, body: peer(message)))
+    return app
+
+
+async def serve(app, host, port):
+    # Run the app until SIGINT/SIGTERM, then stop accepting updates
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Listening for updates on {host}:{port}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+async def serve_webhook(bot, dp, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                        secret=WEBHOOK_SECRET, url=WEBHOOK_URL, peer=None):
+    # Updates are answered with 200 as soon as they are queued, like polling hands
+    # them to tasks; per-user ordering is kept by the dispatcher's middleware
+    pending = set()
+
+    async def feed(update):
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception:
+            logging.exception(f"Error handling update {update.get('update_id')}")
+
+    async def handle(update, body):
+        task = asyncio.create_task(feed(update))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    if url:
+        await bot.set_webhook(
+            url, secret_token=secret or None, max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    try:
+        await serve(update_app(path, secret, handle, peer), host, port)
+    finally:
+        if pending:
+            await asyncio.wait(pending, timeout=10)
+
+
+class Peers:
+    # The other workers of the same front process, as seen from a worker. Changes to a
+    # user this worker can't write (their shard is another worker's) are sent to the owner.
+    def __init__(self, worker, workers, secret=WEBHOOK_SECRET):
+        self.worker = worker
+        self.workers = workers
+        self.secret = secret
+        self.session = None
+
+    def owner(self, user_id):
+        return shard_of(user_id, self.workers)
+
+    async def send(self, index, message):
+        # True once the worker has applied the message
+        if self.session is None:
+            self.session = ClientSession(timeout=ClientTimeout(total=10))
+        try:
+            async with self.session.post(
+                worker_url(index, PEER_PATH), json=message, headers={SECRET_HEADER: self.secret}
+            ) as response:
+                return response.status == 200
+        except (ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Could not reach worker {index}: {e!r}")
+            return False
+
+    async def send_all(self, message):
+        others = [index for index in range(self.workers) if index != self.worker]
+        return all(await asyncio.gather(*(self.send(index, message) for index in others)))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class Worker:
+    # One Bot.py process serving the users of its storage shards on a local port
+    def __init__(self, index, count, secret, argv):
+        self.index = index
+        self.count = count
+        self.secret = secret
+        self.argv = argv
+        self.port = WORKER_BASE_PORT + index
+        self.url = worker_url(index)
+        self.process = None
+
+    async def start(self):
+        env = dict(
+            os.environ,
+            WEBHOOK_HOST="127.0.0.1",
+            WEBHOOK_PORT=str(self.port),
+            WEBHOOK_PATH=WORKER_PATH,
+            WEBHOOK_SECRET=self.secret,
+            WEBHOOK_URL="",
+            WORKER_INDEX=str(self.index),
+            WORKER_COUNT=str(self.count),
+        )
+        self.process = await asyncio.create_subprocess_exec(*self.argv, env=env)
+
+    async def ready(self):
+        deadline = asyncio.get_running_loop().time() + WORKER_START_TIMEOUT
+        while True:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", self.port)
+            except OSError:
+                if self.process.returncode is not None or asyncio.get_running_loop().time() > deadline:
+                    raise RuntimeError(f"Worker {self.index} did not start")
+                await asyncio.sleep(0.1)
+                continue
+            writer.close()
+            return
+
+    async def supervise(self):
+        # Restart a worker that dies; updates for its shard get 503s meanwhile and
+        # Telegram retries them
+        while True:
+            code = await self.process.wait()
+            logging.error(f"Worker {self.index} exited with code {code}, restarting")
+            await asyncio.sleep(1)
+            await self.start()
+
+    async def stop(self):
+        if self.process is None or self.process.returncode is not None:
+            return
+        # SIGTERM lets the worker finish queued updates and flush its store
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=30)
+        except asyncio.TimeoutError:
+            self.process.kill()
+
+
+async def run_front(workers=WEBHOOK_WORKERS, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                    secret=WEBHOOK_SECRET, url=WEBHOOK_URL, worker_argv=None):
+    # Every update of a user goes to the same worker, so FSM state, ordering locks,
+    # jobs and the user's playlists all live in one process
+    shards = int(os.getenv("STORAGE_SHARDS", DEFAULT_SHARDS))
+    if shards % workers:
+        raise SystemExit(f"STORAGE_SHARDS ({shards}) must be a multiple of WEBHOOK_WORKERS ({workers})")
+    internal_secret = secrets.token_urlsafe(32)
+    argv = worker_argv or [sys.executable, BOT_SCRIPT, "webhook"]
+    pool = [Worker(index, workers, internal_secret, argv) for index in range(workers)]
+    for worker in pool:
+        await worker.start()
+    supervisors = []
+    session = ClientSession(timeout=ClientTimeout(total=10))
+    try:
+        for worker in pool:
+            await worker.ready()
+        supervisors = [asyncio.create_task(worker.supervise()) for worker in pool]
+
+        async def forward(update, body):
+            worker = pool[worker_of(update, workers)]
+            try:
+                async with session.post(worker.url, data=body, headers={SECRET_HEADER: internal_secret}) as response:
+                    if response.status != 200:
+                        raise web.HTTPServiceUnavailable()
+            except (ClientError, asyncio.TimeoutError):
+                raise web.HTTPServiceUnavailable()
+
+        if url:
+            from aiogram import Bot
+
+            bot = Bot(token=os.getenv("BOT_TOKEN", ""))
+            try:
+                await bot.set_webhook(url, secret_token=secret or None, max_connections=WEBHOOK_MAX_CONNECTIONS)
+            finally:
+                await bot.session.close()
+        await serve(update_app(path, secret, forward), host, port)
+    finally:
+        for task in supervisors:
+            task.cancel()
+        await asyncio.gather(*(worker.stop() for worker in pool))
+        await session.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_front())